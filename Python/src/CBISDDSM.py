@@ -1,12 +1,19 @@
 from __future__ import annotations
 
 import io
+import itertools
 import os
+import contextlib
+import copy
 import json
 import math
 import re
 import hashlib
+import shutil
 import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
@@ -17,18 +24,24 @@ from PIL import Image, ImageFile, ImageOps
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler
-import torchvision.transforms as T
-import torchvision.models as models
+
+from src.dataset_manifest import iter_files, load_manifest, save_manifest, scan_tree
+from src.env import _env, _env_bool, _env_float, _env_int, _env_list
+from src.fusion import optimize_for_inference
+from src.image_cache import ImageCache, build_cache, remove_caches, stale_caches
+from src.label_index import LabelIndex, write_index
+from src.metrics import BATCH_SIZE, MODEL_EVICTIONS, MODEL_LOAD_FAILURES, MODEL_LOADS, STAGE_SECONDS
+from src.preprocess import IMAGENET_MEAN, IMAGENET_STD, get_preprocessor, hist_quantile, normalize
+from src.sample_table import ORIGINS, SampleTable, as_table, first_seen_order, select_groups
+from src.sample_table import Sample  # noqa: F401  re-exported; Sample used to be defined here
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 LABELS = ["BENIGN", "MALIGNANT"]
+_LABEL_NAMES = np.array(LABELS)
 LABEL_TO_IDX = {"BENIGN": 0, "MALIGNANT": 1}
 IDX_TO_LABEL = {0: "BENIGN", 1: "MALIGNANT"}
 
-IMAGENET_MEAN = [0.485, 0.456, 0.406]
-IMAGENET_STD = [0.229, 0.224, 0.225]
-
 SUPPORTED_IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".dcm"}
 
 _LOAD_LOCK = threading.Lock()
@@ -52,66 +65,95 @@ _TRAIN_STATE = {
     "hash_map_size": 0,
 }
 
-_MODEL: Optional[nn.Module] = None
-_DEV: Optional[torch.device] = None
-_META: Dict = {}
-_SIG: Optional[Dict] = None
-
-_PATH_MAP: Dict[str, str] = {}
-_NAME_MAP: Dict[str, str] = {}
-_HASH_MAP: Dict[str, str] = {}
+_THREADS_SET = False
+_SERVED: "OrderedDict[str, ServedModel]" = OrderedDict()
+_SERVED_LOCK = threading.Lock()
+_EVICTIONS = 0
+_REGISTRY_CACHE: Optional[Tuple[Tuple, Dict[str, Path]]] = None
+_WATCHER: Optional[threading.Thread] = None
+_WATCH_STOP = threading.Event()
+_WATCH_EXTERNAL = False
+
+_PATH_MAP: "Dict[str, str] | LabelIndex" = {}
+_NAME_MAP: "Dict[str, str] | LabelIndex" = {}
+_HASH_MAP: "Dict[str, str] | LabelIndex" = {}
 _MAP_SIG: Optional[Dict] = None
+_MAP_CHECKED = 0.0
+_MAP_CHECK_S = 0.0
+_MAP_KINDS = ("path_map", "name_map", "hash_map")
+_PHASH_MAP: Optional[np.ndarray] = None
 
 
-def _env(key: str, default: str = "") -> str:
-    v = os.getenv(key, "").strip()
-    return v if v else default
+def _sha1(b: bytes) -> str:
+    return hashlib.sha1(b).hexdigest()
 
 
-def _env_bool(key: str, default: bool = False) -> bool:
-    v = os.getenv(key, "").strip().lower()
-    if not v:
-        return default
-    return v in ("1", "true", "yes", "y", "on")
+def _device() -> torch.device:
+    if not torch.cuda.is_available():
+        raise RuntimeError(
+            "CUDA GPU is required, but torch.cuda.is_available() is False. "
+            "Install a CUDA-enabled PyTorch build and make sure NVIDIA driver/CUDA are working."
+        )
+    return torch.device("cuda")
 
+def _serving_device(cfg: Optional[CbisDdsmConfig] = None) -> torch.device:
+    want = _env("ML_DEVICE", cfg.serve_device if cfg is not None else "auto").strip().lower()
+    if want in ("cuda", "gpu"):
+        return _device()
+    if want == "cpu":
+        return torch.device("cpu")
+    return torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 
-def _env_int(key: str, default: int) -> int:
-    v = os.getenv(key, "").strip()
-    try:
-        return int(v)
-    except Exception:
-        return default
 
-
-def _env_float(key: str, default: float) -> float:
-    v = os.getenv(key, "").strip()
+def _cpu_count() -> int:
     try:
-        return float(v)
+        return max(1, len(os.sched_getaffinity(0)))
     except Exception:
-        return default
-
+        return max(1, os.cpu_count() or 1)
 
-def _env_list(key: str, default: Tuple[str, ...]) -> Tuple[str, ...]:
-    v = _env(key, "").strip()
-    if not v:
-        return default
-    parts = [x.strip().lower() for x in v.split(",") if x.strip()]
-    return tuple(parts) if parts else default
 
+def _configure_cpu_threads(force: bool = False) -> Dict:
+    global _THREADS_SET
+    n = _cpu_count()
+    intra = _env_int("ML_TORCH_THREADS", 0)
+    inter = _env_int("ML_TORCH_INTEROP_THREADS", 0)
+    if intra <= 0:
+        intra = n
+    if inter <= 0:
+        inter = max(1, min(4, n // 4))
 
+    if force or not _THREADS_SET:
+        try:
+            torch.set_num_threads(int(intra))
+        except Exception:
+            pass
+        try:
+            torch.set_num_interop_threads(int(inter))
+        except Exception:
+            pass
+        _THREADS_SET = True
 
+    return {
+        "cpus": int(n),
+        "intra_op_threads": int(torch.get_num_threads()),
+        "inter_op_threads": int(torch.get_num_interop_threads()),
+    }
 
-def _sha1(b: bytes) -> str:
-    return hashlib.sha1(b).hexdigest()
 
+def get_serving_info() -> Dict:
+    with _SERVED_LOCK:
+        items = list(_SERVED.items())
+        evictions = _EVICTIONS
+    loaded = dict(items)
+    default = dict(loaded[""].info) if "" in loaded else {}
+    default["models"] = {
+        k or "default": {**v.info, "bytes": v.nbytes, "last_used": v.last_used} for k, v in items
+    }
+    default["models_bytes"] = int(sum(v.nbytes for _, v in items))
+    default["memory_budget_bytes"] = _memory_budget()
+    default["evictions"] = int(evictions)
+    return default
 
-def _device() -> torch.device:
-    if not torch.cuda.is_available():
-        raise RuntimeError(
-            "CUDA GPU is required, but torch.cuda.is_available() is False. "
-            "Install a CUDA-enabled PyTorch build and make sure NVIDIA driver/CUDA are working."
-        )
-    return torch.device("cuda")
 
 def _speed_flags(dev: torch.device) -> None:
     if dev.type == "cuda":
@@ -154,8 +196,10 @@ def _json_safe(x):
 
 def _save_json(path: Path, obj) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(_json_safe(obj), f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
 
 
 def _load_json(path: Path):
@@ -190,6 +234,8 @@ class CbisDdsmConfig:
     mm_val_from_original_only: bool = False
     mm_use_cache: bool = True
     mm_cache_dir_name: str = "Cache224"
+    use_image_cache: bool = True
+    image_cache_dir: Optional[Path] = None
 
     preset: str = "best"
     max_samples: int = 0
@@ -205,12 +251,18 @@ class CbisDdsmConfig:
 
     build_path_map: bool = True
     build_name_map: bool = True
-    build_hash_map: bool = False
+    build_hash_map: bool = True
+    build_phash_map: bool = False
+    build_image_cache: bool = False
 
     folder_class0_names: Tuple[str, ...] = ("benign", "non-cancer", "noncancer", "normal", "negative", "neg", "0")
     folder_class1_names: Tuple[str, ...] = ("malignant", "cancer", "positive", "pos", "1")
     preprocess: str = "auto"
 
+    serve_device: str = "auto"
+    serve_backend: str = "torch"
+    serve_precision: str = "fp32"
+
 
 
 def _default_mm_base(project_root: Path) -> Path:
@@ -242,24 +294,34 @@ def _resolve_dirs(cfg: CbisDdsmConfig) -> Tuple[Path, Path]:
     return dsd, ad
 
 
-def _artifact_paths(ad: Path) -> Dict[str, Path]:
-    return {
-        "model": ad / "model.pt",
-        "meta": ad / "meta.json",
-        "label_map": ad / "label_map.json",
-        "path_map": ad / "path_label_map.json",
-        "name_map": ad / "name_label_map.json",
-        "hash_map": ad / "hash_label_map.json",
-    }
+def _current_version(ad: Path) -> Optional[str]:
+    try:
+        v = (ad / "CURRENT").read_text(encoding="utf-8").strip()
+    except Exception:
+        return None
+    return v if v and (ad / "versions" / v).is_dir() else None
 
 
-@dataclass(frozen=True)
-class Sample:
-    path: str
-    y: int
-    group_id: str
-    rel: str
-    origin: str
+def _artifact_paths(ad: Path, version: Optional[str] = None) -> Dict[str, Path]:
+    version = version or _current_version(ad)
+    vd = ad / "versions" / version if version else ad
+    return {
+        "version_dir": vd,
+        "model": vd / "model.pt",
+        "meta": vd / "meta.json",
+        "label_map": vd / "label_map.json",
+        "path_map": ad / "path_label_map.idx",
+        "name_map": ad / "name_label_map.idx",
+        "hash_map": ad / "hash_label_map.idx",
+        "phash_map": ad / "phash_label_map.npy",
+        "hash_cache": ad / "hash_cache.json",
+        "manifest": ad / "dataset_manifest.json",
+        "path_map_json": ad / "path_label_map.json",
+        "name_map_json": ad / "name_label_map.json",
+        "hash_map_json": ad / "hash_label_map.json",
+        "onnx": vd / "model.onnx",
+        "int8": vd / "model_int8.pt",
+    }
 
 
 def _mm_label_from_folder(name: str) -> Optional[int]:
@@ -311,7 +373,44 @@ def _label_from_path_parts(
     return None
 
 
-def build_samples_mm(cfg: CbisDdsmConfig) -> List[Sample]:
+def _group_annotation(rel_dir: str, name: str) -> str:
+    return _mm_group_key(Path(name))
+
+
+def _scan_dataset(cfg: CbisDdsmConfig, roots: List[Path]) -> Dict[str, Dict]:
+    # Directory listings and group keys persist in dataset_manifest.json;
+    # a rerun stats every directory but only lists the changed ones.
+    _, ad = _resolve_dirs(cfg)
+    path = _artifact_paths(ad)["manifest"]
+    use = _env_bool("MM_USE_MANIFEST", True)
+    key = {"exts": sorted(SUPPORTED_IMAGE_EXTS)}
+    cached = load_manifest(path, key) if use else {}
+    workers = max(1, _env_int("MM_SCAN_WORKERS", 16))
+
+    trees: Dict[str, Dict] = {}
+    dirs = rescanned = files = 0
+    t0 = time.perf_counter()
+    for root in roots:
+        entries, st = scan_tree(root, cached.get(str(root)), SUPPORTED_IMAGE_EXTS, _group_annotation, workers)
+        trees[str(root)] = entries
+        dirs += st["dirs"]
+        rescanned += st["rescanned"]
+        files += st["files"]
+
+    if use and (rescanned or not set(trees) <= set(cached)):
+        try:
+            save_manifest(path, key, {**cached, **trees})
+        except OSError as e:
+            print(f"dataset manifest: not saved: {e}", flush=True)
+    print(
+        f"dataset manifest: {files} files in {dirs} dirs, {rescanned} dirs rescanned "
+        f"in {time.perf_counter() - t0:.2f}s",
+        flush=True,
+    )
+    return trees
+
+
+def build_samples_mm(cfg: CbisDdsmConfig) -> SampleTable:
     dsd, _ = _resolve_dirs(cfg)
     base = Path(dsd)
 
@@ -341,92 +440,58 @@ def build_samples_mm(cfg: CbisDdsmConfig) -> List[Sample]:
     if not has_original:
         cfg.mm_val_from_original_only = False
 
-    samples: List[Sample] = []
-    max_samples = int(cfg.max_samples) if int(cfg.max_samples) > 0 else 0
-
+    class_dirs: List[Tuple[Path, str, int]] = []
     for root, tag in roots:
-        for class_dir in root.iterdir():
+        for class_dir in sorted(root.iterdir()):
             if not class_dir.is_dir():
                 continue
-
             y = _mm_label_from_folder(class_dir.name)
             if y is None:
                 continue
+            class_dirs.append((class_dir, tag, int(y)))
 
-            for p in class_dir.rglob("*"):
-                if not p.is_file():
-                    continue
-                if p.suffix.lower() not in SUPPORTED_IMAGE_EXTS:
-                    continue
-
-                gid = _mm_group_key(p)
+    trees = _scan_dataset(cfg, [d for d, _, _ in class_dirs])
+    max_samples = int(cfg.max_samples) if int(cfg.max_samples) > 0 else None
 
-                if cache_root is not None:
-                    rel = p.relative_to(cache_root).as_posix()
-                else:
-                    rel = p.relative_to(base).as_posix()
+    def _rows():
+        for class_dir, tag, y in class_dirs:
+            prefix = class_dir.relative_to(scan_base).as_posix()
+            root_s = str(class_dir)
+            for rel, gid in iter_files(trees[root_s]):
+                yield os.path.join(root_s, rel.replace("/", os.sep)), y, str(gid), f"{prefix}/{rel}", tag
 
-                samples.append(
-                    Sample(
-                        path=str(p),
-                        y=int(y),
-                        group_id=str(gid),
-                        rel=str(rel),
-                        origin=tag,
-                    )
-                )
-
-                if max_samples and len(samples) >= max_samples:
-                    break
-
-            if max_samples and len(samples) >= max_samples:
-                break
-
-        if max_samples and len(samples) >= max_samples:
-            break
-
-    if not samples:
+    samples = SampleTable.from_rows(itertools.islice(_rows(), max_samples))
+    if not len(samples):
         raise ValueError("No images found in Mammogram Mastery folders.")
 
     return samples
 
 
-def build_samples_folder_binary(cfg: CbisDdsmConfig) -> List[Sample]:
+def build_samples_folder_binary(cfg: CbisDdsmConfig) -> SampleTable:
     dsd, _ = _resolve_dirs(cfg)
     base = Path(dsd)
 
     class0 = _env_list("FOLDER_CLASS0_NAMES", cfg.folder_class0_names)
     class1 = _env_list("FOLDER_CLASS1_NAMES", cfg.folder_class1_names)
 
-    samples: List[Sample] = []
-    max_samples = int(cfg.max_samples) if int(cfg.max_samples) > 0 else 0
+    max_samples = int(cfg.max_samples) if int(cfg.max_samples) > 0 else None
+    tree = _scan_dataset(cfg, [base])[str(base)]
+    base_s = str(base)
 
-    for p in base.rglob("*"):
-        if not p.is_file():
-            continue
-        if p.suffix.lower() not in SUPPORTED_IMAGE_EXTS:
-            continue
-
-        rel = p.relative_to(base).as_posix()
-        parts = list(Path(rel).parts)
-
-        y = _label_from_path_parts(parts[:-1], class0=class0, class1=class1)
-        if y is None:
-            continue
+    def _rows():
+        for rel, gid in iter_files(tree):
+            y = _label_from_path_parts(rel.split("/")[:-1], class0=class0, class1=class1)
+            if y is not None:
+                yield os.path.join(base_s, rel.replace("/", os.sep)), int(y), str(gid), rel, "folder"
 
-        gid = _mm_group_key(p)
-        samples.append(Sample(path=str(p), y=int(y), group_id=str(gid), rel=str(rel), origin="folder"))
-
-        if max_samples and len(samples) >= max_samples:
-            break
-
-    if not samples:
+    samples = SampleTable.from_rows(itertools.islice(_rows(), max_samples))
+    if not len(samples):
         raise ValueError(f"No labeled images found under: {base}")
 
     return samples
 
 
-def build_samples(cfg: CbisDdsmConfig) -> List[Sample]:
+def build_samples(cfg: CbisDdsmConfig) -> SampleTable:
     kind = (cfg.dataset_kind or "").strip().lower()
     if kind == "mammogram_mastery":
         return build_samples_mm(cfg)
@@ -487,9 +552,11 @@ def _safe_weights(enum_cls):
         return None
 
 
-def _create_model(arch: str, n_classes: int = 2) -> nn.Module:
+def _create_model(arch: str, n_classes: int = 2, pretrained: bool = True) -> nn.Module:
+    import torchvision.models as models
+
     a = (arch or "").strip().lower()
-    no_pretrain = _env_bool("ML_NO_PRETRAIN", False)
+    no_pretrain = (not pretrained) or _env_bool("ML_NO_PRETRAIN", False)
 
     if a == "mobilenet_v3_large":
         w = None if no_pretrain else _safe_weights(models.MobileNet_V3_Large_Weights)
@@ -524,7 +591,16 @@ def _set_backbone_trainable(model: nn.Module, trainable: bool) -> None:
             p.requires_grad = False
 
 
-def _decode_dicom_bytes(file_bytes: bytes) -> Image.Image:
+_GRAY_MODES = ("1", "L", "LA", "I", "I;16", "I;16B", "I;16L", "F")
+
+
+def _reduce_factor(w: int, h: int, max_side: int) -> int:
+    if max_side <= 0:
+        return 1
+    return max(1, int(max(w, h)) // int(max_side))
+
+
+def _decode_dicom_bytes(file_bytes: bytes, max_side: int = 0) -> Image.Image:
     try:
         import pydicom
     except Exception as e:
@@ -532,50 +608,148 @@ def _decode_dicom_bytes(file_bytes: bytes) -> Image.Image:
 
     ds = pydicom.dcmread(io.BytesIO(file_bytes), force=True)
     arr = ds.pixel_array
-    if arr.ndim == 2:
-        arr = np.stack([arr, arr, arr], axis=-1)
-    if arr.shape[-1] != 3:
-        arr = arr[..., :3]
-    arr = arr.astype(np.float32)
+    if arr.ndim == 3 and arr.shape[-1] != 3:
+        arr = arr[..., :3] if arr.shape[-1] > 3 else arr[..., 0]
+
+    src_size = (int(arr.shape[1]), int(arr.shape[0]))
+    f = _reduce_factor(arr.shape[1], arr.shape[0], max_side)
+    if f > 1:
+        h2, w2 = arr.shape[0] // f, arr.shape[1] // f
+        arr = arr[: h2 * f, : w2 * f].reshape(h2, f, w2, f, *arr.shape[2:]).mean(axis=(1, 3), dtype=np.float32)
+    else:
+        arr = arr.astype(np.float32)
+
     mn = float(arr.min())
     mx = float(arr.max())
     if mx > mn:
         arr = (arr - mn) / (mx - mn)
     arr = (arr * 255.0).clip(0, 255).astype(np.uint8)
-    return Image.fromarray(arr, mode="RGB")
+    im = Image.fromarray(arr, mode="L").convert("RGB") if arr.ndim == 2 else Image.fromarray(arr, mode="RGB")
+    im.info["src_size"] = src_size
+    return im
 
 
-def decode_image_bytes_safe(file_bytes: bytes, filename: str = "") -> Image.Image:
+def _shrink(im: Image.Image, max_side: int) -> Image.Image:
+    if max_side <= 0 or max(im.size) <= max_side:
+        return im
+    im = im.copy()
+    try:
+        im.thumbnail((max_side, max_side), Image.BILINEAR)
+    except ValueError:
+        im = im.convert("I")
+        im.thumbnail((max_side, max_side), Image.BILINEAR)
+    return im
+
+
+def decode_image_bytes_reduced(file_bytes: bytes, filename: str = "", max_side: int = 0) -> Tuple[Image.Image, Dict]:
     ext = (Path(filename).suffix or "").lower().strip()
     if ext == ".dcm":
-        im = _decode_dicom_bytes(file_bytes)
-        return im.convert("RGB")
+        im = _decode_dicom_bytes(file_bytes, max_side=max_side)
+        src_w, src_h = im.info.get("src_size", im.size)
+        info = {"format": "DICOM", "src_w": int(src_w), "src_h": int(src_h)}
+        im = _shrink(im, max_side)
+        info.update({"w": int(im.size[0]), "h": int(im.size[1])})
+        return im, info
+
     im = Image.open(io.BytesIO(file_bytes))
+    w, h = im.size
+    if im.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+        w, h = h, w
+    info = {"format": im.format, "src_w": int(w), "src_h": int(h)}
+    if max_side > 0 and max(im.size) > max_side:
+        if im.format == "JPEG":
+            s = float(max_side) / float(max(im.size))
+            im.draft(None, (max(1, int(im.size[0] * s)), max(1, int(im.size[1] * s))))
+        if im.mode in ("1", "P", "PA"):
+            im = im.convert("RGB")
+        im = _shrink(im, max_side)
     im = ImageOps.exif_transpose(im)
-    return im.convert("RGB")
+    info.update({"w": int(im.size[0]), "h": int(im.size[1])})
+    return im.convert("L" if im.mode in _GRAY_MODES else "RGB"), info
+
+
+def decode_image_bytes_safe(file_bytes: bytes, filename: str = "") -> Image.Image:
+    return decode_image_bytes_reduced(file_bytes, filename=filename, max_side=0)[0].convert("RGB")
+
+
+_GRAY_GAIN = 0.2989 + 0.5870 + 0.1140
+
+
+def _gray_u8(im: Image.Image) -> np.ndarray:
+    g = np.asarray(im.convert("L"), dtype=np.uint8)
+    if g.size == 0:
+        return np.zeros((1, 1), dtype=np.uint8)
+    return g
+
+
+def _hist256(gray: np.ndarray) -> np.ndarray:
+    return np.bincount(gray.ravel(), minlength=256).astype(np.int64)
 
 
-def _to_gray01(im: Image.Image) -> np.ndarray:
-    g = im.convert("L")
-    a = np.asarray(g).astype(np.float32)
-    if a.size == 0:
-        return np.zeros((1, 1), dtype=np.float32)
-    a /= 255.0
-    return a
+_hist_quantile = hist_quantile
 
 
-def _laplacian_var(gray01: np.ndarray) -> float:
-    if gray01.ndim != 2:
+def _hist_frac_below(hist: np.ndarray, t: float) -> float:
+    return float(hist[: max(0, min(256, int(math.ceil(t))))].sum()) / max(1, int(hist.sum()))
+
+
+def _hist_frac_above(hist: np.ndarray, t: float) -> float:
+    return float(hist[max(0, min(256, int(math.floor(t)) + 1)):].sum()) / max(1, int(hist.sum()))
+
+
+def _laplacian_var_u8(gray: np.ndarray) -> float:
+    if gray.ndim != 2:
         return 0.0
-    h, w = gray01.shape
+    h, w = gray.shape
     if h < 3 or w < 3:
         return 0.0
-    c = gray01[1:-1, 1:-1]
-    lap = (-4.0 * c) + gray01[:-2, 1:-1] + gray01[2:, 1:-1] + gray01[1:-1, :-2] + gray01[1:-1, 2:]
-    return float(lap.var())
+    g = gray.astype(np.int16)
+    lap = g[:-2, 1:-1] + g[2:, 1:-1]
+    lap += g[1:-1, :-2]
+    lap += g[1:-1, 2:]
+    lap -= 4 * g[1:-1, 1:-1]
+    return float(lap.var(dtype=np.float64)) / (255.0 * 255.0)
+
+
+def _edge_density_u8(gray: np.ndarray, thr: float) -> float:
+    g = gray.astype(np.int16)
+    e = np.zeros(g.shape, dtype=np.int16)
+    e[:, 1:] = np.abs(g[:, 1:] - g[:, :-1])
+    e[1:, :] += np.abs(g[1:, :] - g[:-1, :])
+    return float(np.count_nonzero(e > float(thr) * 255.0 / _GRAY_GAIN)) / max(1, e.size)
+
+
+def _color_stats(im: Image.Image) -> Tuple[float, float]:
+    if im.mode in _GRAY_MODES:
+        return 0.0, 0.0
+    arr = np.asarray(im.convert("RGB"), dtype=np.uint8)
+    mx = np.maximum(np.maximum(arr[..., 0], arr[..., 1]), arr[..., 2])
+    mn = np.minimum(np.minimum(arr[..., 0], arr[..., 1]), arr[..., 2])
+    d = mx - mn
+    n = max(1, int(d.size))
+    # |r-g| + |g-b| + |r-b| == 2 * (max - min)
+    colorfulness = 2.0 * float(d.sum(dtype=np.int64)) / (3.0 * 255.0 * n)
+    counts = np.bincount((mx.astype(np.int32) << 8 | d).ravel(), minlength=65536).reshape(256, 256)
+    lv = np.arange(256, dtype=np.float64) / 255.0
+    sat = lv[None, :] / (lv[:, None] + 1e-6)
+    return colorfulness, float((counts * sat).sum()) / n
+
+
+def gray_stats(gray: np.ndarray, hist: Optional[np.ndarray] = None) -> Dict:
+    hist = _hist256(gray) if hist is None else hist
+    n = max(1, int(hist.sum()))
+    lv = np.arange(256, dtype=np.float64)
+    mean = float((hist * lv).sum()) / n
+    var = max(0.0, float((hist * lv * lv).sum()) / n - mean * mean)
+    return {
+        "hist": hist,
+        "mean": mean / 255.0,
+        "std": math.sqrt(var) / 255.0,
+        "lapvar": _laplacian_var_u8(gray),
+    }
 
 
-def assess_quality(im: Image.Image) -> Dict:
+def _quality_from_stats(st: Dict, w: int, h: int) -> Dict:
     min_dim_req = _env_int("Q_MIN_DIM", 256)
     dyn_req = _env_float("Q_MIN_DYN", 0.06)
     std_req = _env_float("Q_MIN_STD", 0.03)
@@ -583,19 +757,17 @@ def assess_quality(im: Image.Image) -> Dict:
     black_req = _env_float("Q_MAX_BLACK_FRAC", 0.93)
     white_req = _env_float("Q_MAX_WHITE_FRAC", 0.93)
 
-    w, h = im.size
-    gray = _to_gray01(im)
+    hist = st["hist"]
+    mean = float(st["mean"])
+    std = float(st["std"])
 
-    mean = float(gray.mean())
-    std = float(gray.std())
-
-    p01 = float(np.quantile(gray, 0.01))
-    p99 = float(np.quantile(gray, 0.99))
+    p01 = _hist_quantile(hist, 0.01) / 255.0
+    p99 = _hist_quantile(hist, 0.99) / 255.0
     dyn = float(max(0.0, p99 - p01))
 
-    black_frac = float((gray < 0.05).mean())
-    white_frac = float((gray > 0.95).mean())
-    lapvar = _laplacian_var(gray)
+    black_frac = _hist_frac_below(hist, 0.05 * 255.0)
+    white_frac = _hist_frac_above(hist, 0.95 * 255.0)
+    lapvar = float(st["lapvar"])
 
     issues: List[str] = []
     if min(w, h) < min_dim_req:
@@ -642,7 +814,13 @@ def assess_quality(im: Image.Image) -> Dict:
         },
     }
 
-def assess_domain_mammogram_like(im: Image.Image) -> Dict:
+
+def assess_quality(im: Image.Image, src_size: Optional[Tuple[int, int]] = None) -> Dict:
+    w, h = src_size or im.size
+    return _quality_from_stats(gray_stats(_gray_u8(im)), int(w), int(h))
+
+
+def _domain_from_stats(st: Dict, gray: np.ndarray, color: Tuple[float, float]) -> Dict:
     color_max = _env_float("D_COLOR_MAX", 0.10)
     sat_max = _env_float("D_SAT_MAX", 0.08)
     edge_max = _env_float("D_EDGE_MAX", 0.22)
@@ -651,27 +829,9 @@ def assess_domain_mammogram_like(im: Image.Image) -> Dict:
     edge_thr = _env_float("D_EDGE_THR", 0.10)
     black_thr = _env_float("D_BLACK_THR", 0.08)
 
-    arr = np.asarray(im.convert("RGB"), dtype=np.float32) / 255.0
-    r = arr[..., 0]
-    g = arr[..., 1]
-    b = arr[..., 2]
-
-    colorfulness = float((np.abs(r - g) + np.abs(g - b) + np.abs(r - b)).mean() / 3.0)
-
-    mx = np.maximum(np.maximum(r, g), b)
-    mn = np.minimum(np.minimum(r, g), b)
-    sat = (mx - mn) / (mx + 1e-6)
-    sat_mean = float(sat.mean())
-
-    gray = (0.2989 * r + 0.5870 * g + 0.1140 * b).astype(np.float32)
-    dx = np.abs(gray[:, 1:] - gray[:, :-1])
-    dy = np.abs(gray[1:, :] - gray[:-1, :])
-    e = np.zeros_like(gray, dtype=np.float32)
-    e[:, 1:] += dx
-    e[1:, :] += dy
-    edge_density = float((e > float(edge_thr)).mean())
-
-    black_frac = float((gray < float(black_thr)).mean())
+    colorfulness, sat_mean = color
+    edge_density = _edge_density_u8(gray, edge_thr)
+    black_frac = _hist_frac_below(st["hist"], float(black_thr) * 255.0 / _GRAY_GAIN)
 
     issues: List[str] = []
     if colorfulness > float(color_max):
@@ -706,111 +866,290 @@ def assess_domain_mammogram_like(im: Image.Image) -> Dict:
         },
     }
 
+
+def assess_domain_mammogram_like(im: Image.Image) -> Dict:
+    gray = _gray_u8(im)
+    return _domain_from_stats(gray_stats(gray), gray, _color_stats(im))
+
+
+# Quality and domain checks from one uint8 grayscale pass. Quantiles and
+# fractions come from a 256-bin histogram; the Laplacian and edge maps use int16.
+# Tolerance against the previous float32 implementation: every metric within
+# 1e-6 on grayscale inputs; on colour inputs edge_density and black_frac may
+# differ by up to ~1e-3 (Pillow's rounded "L" conversion replaces the float
+# gray), the rest within 1e-6. MMPreprocess output is unchanged.
+def analyze_image(im: Image.Image, src_size: Optional[Tuple[int, int]] = None, timings: Optional[Dict] = None) -> Dict:
+    w, h = src_size or im.size
+    t0 = time.perf_counter()
+    gray = _gray_u8(im)
+    st = gray_stats(gray)
+    t1 = time.perf_counter()
+    q = _quality_from_stats(st, int(w), int(h))
+    t2 = time.perf_counter()
+    dom = _domain_from_stats(st, gray, _color_stats(im))
+    if timings is not None:
+        timings.update(stats=t1 - t0, quality=t2 - t1, domain=time.perf_counter() - t2)
+    return {"q": q, "dom": dom, "gray": gray, "hist": st["hist"]}
+
+
 class PadToSquareResize:
     def __init__(self, size: int):
         self.size = int(size)
 
-    def __call__(self, im: Image.Image) -> Image.Image:
-        im = im.convert("L")
-        im = ImageOps.autocontrast(im)
+    def from_gray(self, gray: np.ndarray, hist: Optional[np.ndarray] = None) -> np.ndarray:
+        im = ImageOps.autocontrast(Image.fromarray(gray, mode="L"))
         im = ImageOps.pad(im, (self.size, self.size), method=Image.BILINEAR, color=0, centering=(0.5, 0.5))
-        return im.convert("RGB")
+        return np.array(im, dtype=np.uint8)
+
+    def __call__(self, im: Image.Image) -> Image.Image:
+        return Image.fromarray(self.from_gray(_gray_u8(im)), mode="L").convert("RGB")
 
 
 class MMPreprocess:
     def __init__(self, size: int):
         self.size = int(size)
 
-    def __call__(self, im: Image.Image) -> Image.Image:
-        im = ImageOps.exif_transpose(im).convert("L")
-        arr = np.asarray(im, dtype=np.float32) / 255.0
-
-        thr = max(0.02, float(np.quantile(arr, 0.80) * 0.15))
-        m = arr > thr
-        if m.any():
-            ys, xs = np.where(m)
-            y0, y1 = int(ys.min()), int(ys.max())
-            x0, x1 = int(xs.min()), int(xs.max())
+    def from_gray(self, gray: np.ndarray, hist: Optional[np.ndarray] = None) -> np.ndarray:
+        hist = _hist256(gray) if hist is None else hist
+
+        thr = max(0.02, float(_hist_quantile(hist, 0.80) / 255.0 * 0.15))
+        m = gray > int(math.floor(thr * 255.0))
+        rows = np.flatnonzero(m.any(axis=1))
+        if rows.size:
+            cols = np.flatnonzero(m.any(axis=0))
+            y0, y1 = int(rows[0]), int(rows[-1])
+            x0, x1 = int(cols[0]), int(cols[-1])
             pad = int(0.03 * max(1, max(y1 - y0, x1 - x0)))
             y0 = max(0, y0 - pad)
             x0 = max(0, x0 - pad)
-            y1 = min(arr.shape[0] - 1, y1 + pad)
-            x1 = min(arr.shape[1] - 1, x1 + pad)
-            arr = arr[y0 : y1 + 1, x0 : x1 + 1]
-
-        lo, hi = np.quantile(arr, [0.01, 0.99])
-        if float(hi) > float(lo):
-            arr = np.clip((arr - float(lo)) / (float(hi) - float(lo)), 0.0, 1.0)
-
-        im2 = Image.fromarray((arr * 255.0).astype(np.uint8), mode="L")
+            y1 = min(gray.shape[0] - 1, y1 + pad)
+            x1 = min(gray.shape[1] - 1, x1 + pad)
+            if (y0, x0, y1 + 1, x1 + 1) != (0, 0) + gray.shape:
+                gray = gray[y0 : y1 + 1, x0 : x1 + 1]
+                hist = _hist256(gray)
+
+        lo = _hist_quantile(hist, 0.01) / 255.0
+        hi = _hist_quantile(hist, 0.99) / 255.0
+        lut = np.arange(256, dtype=np.float32) / 255.0
+        if hi > lo:
+            lut = np.clip((lut - lo) / (hi - lo), 0.0, 1.0)
+        gray = (lut * 255.0).astype(np.uint8)[gray]
+
+        im2 = Image.fromarray(gray, mode="L")
         im2 = ImageOps.pad(im2, (self.size, self.size), method=Image.BILINEAR, color=0, centering=(0.5, 0.5))
-        return im2.convert("RGB")
+        return np.array(im2, dtype=np.uint8)
+
+    def __call__(self, im: Image.Image) -> Image.Image:
+        gray = _gray_u8(ImageOps.exif_transpose(im))
+        return Image.fromarray(self.from_gray(gray), mode="L").convert("RGB")
 
 
-def _make_preprocessor(cfg: CbisDdsmConfig, size: int):
+def _preproc_mode(cfg: CbisDdsmConfig) -> str:
     pre = (_env("ML_PREPROC", cfg.preprocess) or "auto").strip().lower()
-    if pre == "mm":
-        return MMPreprocess(size)
-    if pre == "pad":
-        return PadToSquareResize(size)
+    if pre in ("mm", "pad"):
+        return pre
 
     kind = (cfg.dataset_kind or "").strip().lower()
     if kind == "mammogram_mastery":
-        return MMPreprocess(size)
-    return PadToSquareResize(size)
+        return "mm"
+    return "pad"
+
+
+def _reference_preprocessor(mode: str, size: int):
+    return MMPreprocess(size) if mode == "mm" else PadToSquareResize(size)
+
+
+class PillowLetterbox:
+    """MMPreprocess/PadToSquareResize one image at a time, behind TensorPreprocessor's interface."""
+
+    def __init__(self, size: int, mode: str = "mm"):
+        self.size = int(size)
+        self.mode = "pad" if str(mode).lower() == "pad" else "mm"
+        self.device = torch.device("cpu")
+        self._ref = _reference_preprocessor(self.mode, self.size)
+
+    def letterbox(self, images, hists: Optional[np.ndarray] = None) -> torch.Tensor:
+        out = np.empty((len(images), self.size, self.size), dtype=np.uint8)
+        for i, g in enumerate(images):
+            g = g if isinstance(g, np.ndarray) else g.cpu().numpy()
+            out[i] = self._ref.from_gray(g, None if hists is None else hists[i])
+        return torch.from_numpy(out)
+
+    def __call__(self, images, hists: Optional[np.ndarray] = None) -> torch.Tensor:
+        return normalize(self.letterbox(images, hists))
+
+
+_PILLOW_LETTERBOX: Dict[Tuple[int, str], PillowLetterbox] = {}
+
 
+def letterboxer(size: int, mode: str, device: Optional[torch.device] = None):
+    # Both produce identical pixels. On CPU Pillow is faster than the tensor
+    # engine at every batch size (see src/bench_preprocess.py and
+    # evaluation_output/bench_preprocess.json), so the engine only runs on
+    # accelerators unless ML_PREPROC_ENGINE=tensor.
+    dev = torch.device(device) if device is not None else torch.device("cpu")
+    engine = _env("ML_PREPROC_ENGINE", "auto").lower()
+    if engine == "tensor" or (engine != "pil" and dev.type != "cpu"):
+        return get_preprocessor(size, mode, dev)
+    key = (int(size), "pad" if str(mode).lower() == "pad" else "mm")
+    lb = _PILLOW_LETTERBOX.get(key)
+    if lb is None:
+        lb = _PILLOW_LETTERBOX[key] = PillowLetterbox(*key)
+    return lb
+
+
+def _make_preprocessor(cfg: CbisDdsmConfig, size: int, device: Optional[torch.device] = None):
+    return letterboxer(size, _preproc_mode(cfg), device)
+
+
+# Bump when decoding or letterboxing gives different pixels for the same file
+# and parameters, so image caches written by older code are not reused.
+_PREPROC_REVISION = 1
+
+
+def _load_gray(path: Path, max_side: int) -> np.ndarray:
+    b = path.read_bytes()
+    im, _ = decode_image_bytes_reduced(b, filename=path.name, max_side=max_side)
+    return _gray_u8(_shrink(im, max_side))
+
+
+def _image_cache_params(cfg: CbisDdsmConfig, image_size: int) -> Dict:
+    return {
+        "mode": _preproc_mode(cfg),
+        "size": int(image_size),
+        "max_side": int(_stage_max_sides(image_size)["preprocess"]),
+        "revision": _PREPROC_REVISION,
+        "pillow": Image.__version__,
+    }
+
+
+def _image_cache_root(cfg: CbisDdsmConfig) -> Path:
+    # Separate from mm_cache_dir_name, which names the pre-resized image tree
+    # inside the dataset that build_samples_mm reads.
+    env = _env("ML_IMAGE_CACHE_DIR", "")
+    if env:
+        return Path(env).resolve()
+    if cfg.image_cache_dir:
+        return Path(cfg.image_cache_dir)
+    _, ad = _resolve_dirs(cfg)
+    return ad / "image_cache"
+
+
+def build_image_cache(cfg: CbisDdsmConfig, samples: SampleTable, image_size: int, prune: bool = False) -> ImageCache:
+    # Runs the deterministic part of BreastDataset once per file: decode,
+    # shrink, MMPreprocess/PadToSquareResize letterbox at image_size.
+    root = _image_cache_root(cfg)
+    params = _image_cache_params(cfg, image_size)
+    preproc = _make_preprocessor(cfg, image_size)
+    max_side = params["max_side"]
+    workers = max(1, _env_int("ML_CACHE_WORKERS", _cpu_count()))
+
+    def _produce(path: str) -> np.ndarray:
+        return preproc.letterbox([_load_gray(Path(path), max_side)])[0].numpy()
+
+    stale = stale_caches(root, params)
+    if stale and prune:
+        remove_caches(stale)
+        print(f"image cache: removed {len(stale)} stale cache(s) under {root}", flush=True)
+    cache, st = build_cache(
+        root,
+        params,
+        as_table(samples).paths.tolist(),
+        _produce,
+        workers=workers,
+        shard_size=_env_int("ML_CACHE_SHARD", 1024),
+    )
+    print(
+        f"image cache: {st['count']} images in {st['shards']} shards, {st['kept']} kept, {st['built']} built, "
+        f"{st['failed']} failed{', compacted' if st['compacted'] else ''} in {st['seconds']:.1f}s "
+        f"({workers} threads) -> {st['dir']}",
+        flush=True,
+    )
+    return cache
+
+
+def _open_image_cache(cfg: CbisDdsmConfig, image_size: int) -> Optional[ImageCache]:
+    if not (cfg.use_image_cache or cfg.build_image_cache):
+        return None
+    root = _image_cache_root(cfg)
+    params = _image_cache_params(cfg, image_size)
+    cache = ImageCache.open(root, params)
+    if cache is None:
+        stale = stale_caches(root, params)
+        if stale:
+            print(
+                f"image cache: {len(stale)} cache(s) under {root} were built with other preprocessing "
+                f"parameters; decoding images on the fly",
+                flush=True,
+            )
+    return cache
 
 
 class BreastDataset(Dataset):
-    def __init__(self, samples: List[Sample], image_size: int, train: bool, erase_p: float, preproc):
-        self.samples = samples
+    def __init__(
+        self,
+        samples: SampleTable,
+        image_size: int,
+        train: bool,
+        erase_p: float,
+        preproc,
+        cache: Optional[ImageCache] = None,
+    ):
+        self.samples = as_table(samples)
         self.image_size = int(image_size)
         self.train = bool(train)
         self.erase_p = float(erase_p)
         self.preproc = preproc
-
+        self.max_side = _stage_max_sides(self.image_size)["preprocess"]
+        self.cache = cache if cache is not None and cache.size == self.image_size else None
+        self.cache_rows = None
+        if self.cache is not None:
+            paths = self.samples.paths.tolist()
+            rows = self.cache.rows(paths)
+            ok = self.cache.fresh(paths, rows, workers=_env_int("ML_CACHE_WORKERS", _cpu_count()))
+            changed = int(np.count_nonzero((rows >= 0) & ~ok))
+            rows[~ok] = -1
+            self.cache_rows = rows
+            if changed:
+                print(f"image cache: {changed} file(s) changed since the cache was built; decoding them on the fly", flush=True)
+
+        import torchvision.transforms as T
+
+        self.aug = None
         if train:
-            tf = [
-                self.preproc,
+            self.aug = T.Compose([
                 T.RandomHorizontalFlip(p=0.5),
                 T.RandomAffine(degrees=6, translate=(0.03, 0.03), scale=(0.98, 1.02), shear=2),
-                T.ToTensor(),
-                T.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD),
-            ]
-            if self.erase_p > 0:
-                tf.append(T.RandomErasing(p=self.erase_p, scale=(0.02, 0.10), ratio=(0.3, 3.3), value="random"))
-            self.tf = T.Compose(tf)
-        else:
-            self.tf = T.Compose([
-                self.preproc,
-                T.ToTensor(),
-                T.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD),
             ])
+        self.erase = None
+        if train and self.erase_p > 0:
+            self.erase = T.RandomErasing(p=self.erase_p, scale=(0.02, 0.10), ratio=(0.3, 3.3), value="random")
 
     def __len__(self) -> int:
         return len(self.samples)
 
+    def _load(self, idx: int) -> torch.Tensor:
+        row = int(self.cache_rows[idx]) if self.cache_rows is not None else -1
+        if row >= 0:
+            return torch.from_numpy(np.array(self.cache.image(row)))[None]
+        return self.preproc.letterbox([_load_gray(Path(self.samples.paths[idx]), self.max_side)])
+
     def __getitem__(self, idx: int):
-        s = self.samples[idx]
         try:
-            p = Path(s.path)
-            if p.suffix.lower() == ".dcm":
-                b = p.read_bytes()
-                img = decode_image_bytes_safe(b, filename=p.name)
-                x = self.tf(img)
-            else:
-                with Image.open(s.path) as img:
-                    img = ImageOps.exif_transpose(img)
-                    x = self.tf(img)
+            x = self._load(idx)
         except Exception:
-            img = Image.new("RGB", (self.image_size, self.image_size))
-            x = self.tf(img)
-        return x, int(s.y)
+            x = torch.zeros((1, self.image_size, self.image_size), dtype=torch.uint8)
+        if self.aug is not None:
+            x = self.aug(x)
+        x = normalize(x.unsqueeze(0))[0]
+        if self.erase is not None:
+            x = self.erase(x)
+        return x, int(self.samples.y[idx])
 
 
 def _make_loader_train(
     cfg: CbisDdsmConfig,
-    samples: List[Sample],
+    samples: SampleTable,
     image_size: int,
     batch: int,
     workers: int,
@@ -818,9 +1157,10 @@ def _make_loader_train(
     erase_p: float,
 ) -> DataLoader:
     preproc = _make_preprocessor(cfg, image_size)
-    ds = BreastDataset(samples, image_size=image_size, train=True, erase_p=erase_p, preproc=preproc)
+    cache = _open_image_cache(cfg, image_size)
+    ds = BreastDataset(samples, image_size=image_size, train=True, erase_p=erase_p, preproc=preproc, cache=cache)
 
-    ys = np.array([s.y for s in samples], dtype=np.int64)
+    ys = ds.samples.y.astype(np.int64)
     counts = np.bincount(ys, minlength=2).astype(np.float64)
     counts = np.maximum(counts, 1.0)
     cls_w = 1.0 / counts
@@ -857,7 +1197,7 @@ def _make_loader_train(
 
 def _make_loader_eval(
     cfg: CbisDdsmConfig,
-    samples: List[Sample],
+    samples: SampleTable,
     image_size: int,
     batch: int,
     workers: int,
@@ -865,7 +1205,8 @@ def _make_loader_eval(
     erase_p: float,
 ) -> DataLoader:
     preproc = _make_preprocessor(cfg, image_size)
-    ds = BreastDataset(samples, image_size=image_size, train=False, erase_p=erase_p, preproc=preproc)
+    cache = _open_image_cache(cfg, image_size)
+    ds = BreastDataset(samples, image_size=image_size, train=False, erase_p=erase_p, preproc=preproc, cache=cache)
 
     pin = dev.type == "cuda"
     w = max(0, int(workers))
@@ -889,74 +1230,44 @@ def _make_loader_eval(
     return DataLoader(ds, **kwargs)
 
 
-def _split_groupwise(cfg: CbisDdsmConfig, samples: List[Sample]) -> Tuple[List[Sample], List[Sample]]:
+def _split_groupwise(cfg: CbisDdsmConfig, samples: SampleTable) -> Tuple[SampleTable, SampleTable]:
+    # Same walk as the list version: shuffle groups in first-seen order and
+    # fill validation with whole groups, done on the group-id column.
+    t = as_table(samples)
     rng = np.random.default_rng(int(cfg.seed))
+    n = len(t)
+    target_val = max(16, int(round(float(cfg.val_ratio) * n)))
 
-    groups: Dict[str, List[Sample]] = {}
-    for s in samples:
-        groups.setdefault(s.group_id, []).append(s)
-
-    items = list(groups.items())
-    rng.shuffle(items)
+    order = first_seen_order(t.group)
+    rng.shuffle(order)
 
     if cfg.mm_val_from_original_only:
-        orig_groups: Dict[str, List[Sample]] = {}
-        for s in samples:
-            if s.origin == "original":
-                orig_groups.setdefault(s.group_id, []).append(s)
-
-        orig_items = list(orig_groups.items())
-        rng.shuffle(orig_items)
-
-        if len(orig_items) >= 2:
-            target_val = max(16, int(round(float(cfg.val_ratio) * len(samples))))
+        orig = t.origin == ORIGINS.index("original")
+        orig_order = first_seen_order(t.group[orig])
+        rng.shuffle(orig_order)
 
-            va_groups = set()
-            va: List[Sample] = []
-            va_n = 0
+        if len(orig_order) >= 2:
+            va_groups, va_idx = select_groups(t.group, orig_order, target_val, orig)
+            tr_idx = np.flatnonzero(~np.isin(t.group, va_groups))
 
-            for gid, g in orig_items:
-                if va_n < target_val:
-                    va_groups.add(gid)
-                    va.extend(g)
-                    va_n += len(g)
+            if tr_idx.size and va_idx.size and np.unique(t.y[va_idx]).size == 2 and np.unique(t.y[tr_idx]).size == 2:
+                return t.take(tr_idx), t.take(va_idx)
 
-            tr = [s for s in samples if s.group_id not in va_groups]
+    va_groups, va_idx = select_groups(t.group, order, target_val)
+    _, tr_idx = select_groups(t.group, order[~np.isin(order, va_groups)], n + 1)
 
-            ys_va = set(int(s.y) for s in va)
-            ys_tr = set(int(s.y) for s in tr)
+    if not tr_idx.size or not va_idx.size:
+        k = max(16, int(0.12 * n))
+        va_idx, tr_idx = np.arange(min(k, n)), np.arange(min(k, n), n)
 
-            if tr and va and len(ys_va) == 2 and len(ys_tr) == 2:
-                return tr, va
+    if np.unique(t.y[va_idx]).size < 2 or np.unique(t.y[tr_idx]).size < 2:
+        perm = np.arange(n)
+        rng.shuffle(perm)
+        k = max(16, int(round(cfg.val_ratio * n)))
+        va_idx, tr_idx = perm[:k], perm[k:]
 
-    target_val = max(16, int(round(float(cfg.val_ratio) * len(samples))))
+    return t.take(tr_idx), t.take(va_idx)
 
-    tr: List[Sample] = []
-    va: List[Sample] = []
-    va_n = 0
-
-    for _, g in items:
-        if va_n < target_val:
-            va.extend(g)
-            va_n += len(g)
-        else:
-            tr.extend(g)
-
-    if not tr or not va:
-        k = max(16, int(0.12 * len(samples)))
-        va = samples[:k]
-        tr = samples[k:]
-
-    ys_va = set(int(s.y) for s in va)
-    ys_tr = set(int(s.y) for s in tr)
-
-    if len(ys_va) < 2 or len(ys_tr) < 2:
-        rng.shuffle(samples)
-        k = max(16, int(round(cfg.val_ratio * len(samples))))
-        va = samples[:k]
-        tr = samples[k:]
-
-    return tr, va
 
 def _roc_auc_binary(y_true: np.ndarray, y_score: np.ndarray) -> float:
     y_true = y_true.astype(np.int64)
@@ -991,7 +1302,6 @@ def _roc_auc_binary(y_true: np.ndarray, y_score: np.ndarray) -> float:
     return float(auc)
 
 
-
 def _metrics(y_true: np.ndarray, p_malign: np.ndarray) -> Dict[str, float]:
     y_true = y_true.astype(np.int64)
     p_malign = p_malign.astype(np.float64)
@@ -1114,6 +1424,7 @@ def _eval(
     loss_fn,
     dev: torch.device,
     max_batches: int = 0,
+    dtype: Optional[torch.dtype] = None,
 ) -> Tuple[float, Dict[str, float], Dict[str, int], np.ndarray, np.ndarray]:
     model.eval()
     total_loss, total_n = 0.0, 0
@@ -1122,10 +1433,10 @@ def _eval(
 
     n_batches = 0
     for xb, yb in dl:
-        xb = xb.to(dev, non_blocking=True)
+        xb = xb.to(dev, non_blocking=True) if dtype is None else xb.to(dev, dtype=dtype, non_blocking=True)
         yb = yb.to(dev, non_blocking=True)
 
-        logits = model(xb)
+        logits = model(xb).float()
         loss = loss_fn(logits, yb)
 
         probs = torch.softmax(logits, dim=1)
@@ -1150,22 +1461,49 @@ def _eval(
     return float(total_loss / max(1, total_n)), m, cm, y_true_np, p_np
 
 
-def _save_artifacts(ad: Path, model: nn.Module, meta: Dict) -> None:
-    ap = _artifact_paths(ad)
-    ad.mkdir(parents=True, exist_ok=True)
+def _publish_version(ad: Path, version: str) -> None:
+    tmp = ad / "CURRENT.tmp"
+    tmp.write_text(version + "\n", encoding="utf-8")
+    os.replace(tmp, ad / "CURRENT")
+
+
+def _prune_versions(ad: Path, keep: int) -> None:
+    root = ad / "versions"
+    if keep <= 0 or not root.is_dir():
+        return
+    cur = _current_version(ad)
+    dirs = sorted((p for p in root.iterdir() if p.is_dir()), key=lambda p: (p.stat().st_mtime, p.name))
+    for name in [p.name for p in dirs[:-keep]]:
+        if name == cur:
+            continue
+        try:
+            shutil.rmtree(root / name)
+        except Exception:
+            pass
+
+
+def _save_artifacts(ad: Path, model: nn.Module, meta: Dict) -> str:
+    version = time.strftime("%Y%m%d-%H%M%S") + "-" + os.urandom(3).hex()
+    ap = _artifact_paths(ad, version)
+    ap["version_dir"].mkdir(parents=True, exist_ok=True)
+    meta = dict(meta)
+    meta["artifact_version"] = version
+    meta["artifact_path"] = str(ap["model"])
     torch.save(model.state_dict(), ap["model"])
     _save_json(ap["label_map"], {"labels": LABELS, "label_to_idx": LABEL_TO_IDX})
     _save_json(ap["meta"], meta)
+    _publish_version(ad, version)
+    _prune_versions(ad, _env_int("ML_KEEP_VERSIONS", 3))
+    return version
 
 
-def build_path_label_map(cfg: CbisDdsmConfig, samples: List[Sample]) -> Dict[str, str]:
+def build_path_label_map(cfg: CbisDdsmConfig, samples: SampleTable) -> Dict[str, str]:
     _, ad = _resolve_dirs(cfg)
     ap = _artifact_paths(ad)
-    mp: Dict[str, str] = {}
-    for s in samples:
-        rel = s.rel.replace("\\", "/").lower().lstrip("/")
-        mp[rel] = IDX_TO_LABEL[int(s.y)]
-    _save_json(ap["path_map"], mp)
+    t = as_table(samples)
+    rels = [r.replace("\\", "/").lower().lstrip("/") for r in t.rels.tolist()]
+    mp: Dict[str, str] = dict(zip(rels, _LABEL_NAMES[t.y].tolist()))
+    _write_label_map(ap, "path_map", mp)
     meta = _load_json(ap["meta"]) or {}
     meta["path_map_ok"] = True
     meta["path_map_path"] = str(ap["path_map"])
@@ -1174,20 +1512,13 @@ def build_path_label_map(cfg: CbisDdsmConfig, samples: List[Sample]) -> Dict[str
     return mp
 
 
-def build_name_label_map(cfg: CbisDdsmConfig, samples: List[Sample]) -> Dict[str, str]:
+def build_name_label_map(cfg: CbisDdsmConfig, samples: SampleTable) -> Dict[str, str]:
     _, ad = _resolve_dirs(cfg)
     ap = _artifact_paths(ad)
-    tmp: Dict[str, Optional[str]] = {}
-    for s in samples:
-        name = Path(s.path).name.lower()
-        lab = IDX_TO_LABEL[int(s.y)]
-        prev = tmp.get(name)
-        if prev is None:
-            tmp[name] = lab
-        elif prev != lab:
-            tmp[name] = ""
-    mp: Dict[str, str] = {k: v for k, v in tmp.items() if v}
-    _save_json(ap["name_map"], mp)
+    t = as_table(samples)
+    names = [os.path.basename(p).lower() for p in t.paths.tolist()]
+    mp = _unambiguous(zip(names, _LABEL_NAMES[t.y].tolist()))
+    _write_label_map(ap, "name_map", mp)
     meta = _load_json(ap["meta"]) or {}
     meta["name_map_ok"] = True
     meta["name_map_path"] = str(ap["name_map"])
@@ -1196,25 +1527,177 @@ def build_name_label_map(cfg: CbisDdsmConfig, samples: List[Sample]) -> Dict[str
     return mp
 
 
-def build_hash_label_map(cfg: CbisDdsmConfig, samples: List[Sample]) -> Dict[str, str]:
+def _sha1_file(path: str, chunk: int = 1 << 20) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            b = f.read(chunk)
+            if not b:
+                break
+            h.update(b)
+    return h.hexdigest()
+
+
+_PHASH_N = 32
+_PHASH_K = 16
+_PHASH_DCT = np.cos(np.pi * (2 * np.arange(_PHASH_N)[None, :] + 1) * np.arange(_PHASH_N)[:, None] / (2 * _PHASH_N))
+_PHASH_DTYPE = np.dtype([("code", np.uint8, (_PHASH_K * _PHASH_K // 8,)), ("label", np.uint8)])
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+
+def _phash(im: Image.Image) -> bytes:
+    # Low-frequency DCT signs of a 32x32 thumbnail: stable under
+    # re-encoding and rescaling, not under crops or edits.
+    g = np.asarray(im.convert("L").resize((_PHASH_N, _PHASH_N), Image.BOX), dtype=np.float64)
+    low = (_PHASH_DCT @ g @ _PHASH_DCT.T)[:_PHASH_K, :_PHASH_K].ravel()
+    bits = low > np.median(low[1:])
+    bits[0] = False
+    return np.packbits(bits).tobytes()
+
+
+def _phash_bytes(b: bytes, filename: str = "") -> bytes:
+    return _phash(decode_image_bytes_reduced(b, filename, max_side=256)[0])
+
+
+def _phash_lookup(table: np.ndarray, code: bytes) -> Optional[str]:
+    if len(table) == 0:
+        return None
+    q = np.frombuffer(code, dtype=np.uint8)
+    dist = _POPCOUNT[np.bitwise_xor(table["code"], q)].sum(axis=1)
+    near = dist <= _env_int("ML_PHASH_MAX_DIST", 24)
+    if not near.any():
+        return None
+    labels = table["label"][near]
+    if (labels != labels[0]).any():
+        return None
+    return IDX_TO_LABEL[int(labels[0])]
+
+
+def _digest_file(path: str, phash: bool) -> Dict:
+    st = os.stat(path)
+    out = {"size": int(st.st_size), "mtime_ns": int(st.st_mtime_ns)}
+    if phash:
+        b = Path(path).read_bytes()
+        out["sha1"] = _sha1(b)
+        try:
+            out["phash"] = _phash_bytes(b, path).hex()
+        except Exception:
+            out["phash"] = ""
+    else:
+        out["sha1"] = _sha1_file(path)
+    return out
+
+
+def file_digests(cfg: CbisDdsmConfig, paths: List[str], phash: bool = False) -> Dict[str, Dict]:
+    # Digests persist in hash_cache.json keyed by path; a file is re-read
+    # only when its size or mtime changed. hashlib and PIL decoding release
+    # the GIL, so a thread pool scales across cores.
     _, ad = _resolve_dirs(cfg)
     ap = _artifact_paths(ad)
-    mp: Dict[str, str] = {}
-    for s in samples:
+    cached = _load_json(ap["hash_cache"]) or {}
+    entries: Dict[str, Dict] = (cached.get("files") or {}) if cached.get("version") == 1 else {}
+
+    out: Dict[str, Dict] = {}
+    todo: List[str] = []
+    for p in dict.fromkeys(paths):
         try:
-            b = Path(s.path).read_bytes()
-            mp[_sha1(b)] = IDX_TO_LABEL[int(s.y)]
-        except Exception:
-            pass
-    _save_json(ap["hash_map"], mp)
+            st = os.stat(p)
+        except OSError:
+            continue
+        e = entries.get(p)
+        if (
+            e is not None
+            and e.get("size") == st.st_size
+            and e.get("mtime_ns") == st.st_mtime_ns
+            and (not phash or "phash" in e)
+        ):
+            out[p] = e
+        else:
+            todo.append(p)
+
+    t0 = time.perf_counter()
+    workers = max(1, _env_int("ML_HASH_WORKERS", min(16, 2 * _cpu_count())))
+
+    def _one(p: str) -> Tuple[str, Optional[Dict]]:
+        try:
+            return p, _digest_file(p, phash)
+        except OSError:
+            return p, None
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ml-hash") as ex:
+        for p, e in ex.map(_one, todo):
+            if e is not None:
+                out[p] = e
+
+    _save_json(ap["hash_cache"], {"version": 1, "files": out})
+    print(
+        f"hash map: {len(out)} files, {len(out) - len(todo)} cached, {len(todo)} hashed "
+        f"in {time.perf_counter() - t0:.1f}s ({workers} threads)",
+        flush=True,
+    )
+    return out
+
+
+def _unambiguous(pairs) -> Dict[str, str]:
+    tmp: Dict[str, str] = {}
+    for k, lab in pairs:
+        if not k:
+            continue
+        prev = tmp.get(k)
+        if prev is None:
+            tmp[k] = lab
+        elif prev != lab:
+            tmp[k] = ""
+    return {k: v for k, v in tmp.items() if v}
+
+
+def build_hash_label_map(cfg: CbisDdsmConfig, samples: SampleTable) -> Dict[str, str]:
+    _, ad = _resolve_dirs(cfg)
+    ap = _artifact_paths(ad)
+    phash = bool(cfg.build_phash_map)
+    t = as_table(samples)
+    paths = t.paths.tolist()
+    digests = file_digests(cfg, paths, phash=phash)
+    labelled = [(digests[p], lab) for p, lab in zip(paths, _LABEL_NAMES[t.y].tolist()) if p in digests]
+    mp = _unambiguous((d["sha1"], lab) for d, lab in labelled)
+    _write_label_map(ap, "hash_map", mp)
     meta = _load_json(ap["meta"]) or {}
     meta["hash_map_ok"] = True
     meta["hash_map_path"] = str(ap["hash_map"])
     meta["hash_map_size"] = int(len(mp))
+    if phash:
+        pm = _unambiguous((d.get("phash", ""), lab) for d, lab in labelled)
+        _write_phash_map(ap, pm)
+        meta["phash_map_ok"] = True
+        meta["phash_map_path"] = str(ap["phash_map"])
+        meta["phash_map_size"] = int(len(pm))
     _save_json(ap["meta"], meta)
     return mp
 
 
+def _write_label_map(ap: Dict[str, Path], kind: str, mp: Dict[str, str]) -> None:
+    global _MAP_CHECKED
+    if os.name == "nt":
+        # Windows cannot replace a file this process still has mapped.
+        _release_maps()
+    write_index(ap[kind], mp)
+    _MAP_CHECKED = 0.0
+
+
+def _write_phash_map(ap: Dict[str, Path], mp: Dict[str, str]) -> None:
+    global _MAP_CHECKED
+    table = np.zeros(len(mp), dtype=_PHASH_DTYPE)
+    for i, (code, lab) in enumerate(sorted(mp.items())):
+        table[i] = (np.frombuffer(bytes.fromhex(code), dtype=np.uint8), LABEL_TO_IDX[lab])
+    if os.name == "nt":
+        _release_maps()
+    tmp = ap["phash_map"].with_name(ap["phash_map"].name + ".tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, table)
+    os.replace(tmp, ap["phash_map"])
+    _MAP_CHECKED = 0.0
+
+
 def _load_map(path: Path) -> Dict[str, str]:
     obj = _load_json(path)
     if not isinstance(obj, dict):
@@ -1227,8 +1710,44 @@ def _load_map(path: Path) -> Dict[str, str]:
     return out
 
 
-def ensure_loaded(cfg: Optional[CbisDdsmConfig] = None) -> None:
-    global _MODEL, _DEV, _META, _SIG
+class OnnxModel:
+    def __init__(self, path: Path, intra_threads: int = 0, inter_threads: int = 0):
+        try:
+            import onnxruntime as ort
+        except Exception as e:
+            raise RuntimeError(f"onnxruntime missing for ONNX serving: {e!r}")
+
+        so = ort.SessionOptions()
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_threads > 0:
+            so.intra_op_num_threads = int(intra_threads)
+        if inter_threads > 0:
+            so.inter_op_num_threads = int(inter_threads)
+
+        self.path = Path(path)
+        self.session = ort.InferenceSession(str(self.path), sess_options=so, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+
+    def eval(self) -> "OnnxModel":
+        return self
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        xn = x.detach().to("cpu", torch.float32).contiguous().numpy()
+        logits = self.session.run([self.output_name], {self.input_name: xn})[0]
+        return torch.from_numpy(logits)
+
+
+def _load_torch_model(arch: str, model_path: Path, dev: torch.device) -> nn.Module:
+    m = _create_model(arch, 2, pretrained=False)
+    m = m.to(dev, memory_format=torch.channels_last)
+    sd = torch.load(model_path, map_location=dev)
+    m.load_state_dict(sd)
+    m.eval()
+    return m
+
+
+def export_onnx(cfg: Optional[CbisDdsmConfig] = None, opset: int = 17) -> Path:
     cfg = cfg or CbisDdsmConfig()
     _, ad = _resolve_dirs(cfg)
     ap = _artifact_paths(ad)
@@ -1238,56 +1757,502 @@ def ensure_loaded(cfg: Optional[CbisDdsmConfig] = None) -> None:
 
     meta = _load_json(ap["meta"]) or {}
     arch = str(meta.get("arch") or "efficientnet_b0")
-    sig = {"ad": str(ad), "arch": arch, "mtime": int(ap["model"].stat().st_mtime)}
+    size = int(meta.get("image_size") or 224)
 
-    if _MODEL is not None and _SIG == sig:
-        return
+    m = _load_torch_model(arch, ap["model"], torch.device("cpu"))
+    m = m.to(memory_format=torch.contiguous_format)
+    dummy = torch.zeros(1, 3, size, size, dtype=torch.float32)
 
-    with _LOAD_LOCK:
-        if _MODEL is not None and _SIG == sig:
-            return
+    tmp = ap["onnx"].with_suffix(".onnx.tmp")
+    kwargs = dict(
+        input_names=["input"],
+        output_names=["logits"],
+        dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=int(opset),
+        do_constant_folding=True,
+    )
+    if "dynamo" in torch.onnx.export.__code__.co_varnames:
+        kwargs["dynamo"] = False
+    with torch.inference_mode():
+        torch.onnx.export(m, (dummy,), str(tmp), **kwargs)
+    os.replace(tmp, ap["onnx"])
 
-        dev = _device()
-        _speed_flags(dev)
+    meta = _load_json(ap["meta"]) or {}
+    meta["onnx_path"] = str(ap["onnx"])
+    meta["onnx_opset"] = int(opset)
+    meta["onnx_source_mtime"] = int(ap["model"].stat().st_mtime)
+    _save_json(ap["meta"], meta)
+    return ap["onnx"]
+
+
+def _serving_backend(cfg: CbisDdsmConfig) -> str:
+    b = _env("ML_BACKEND", cfg.serve_backend).strip().lower()
+    return b if b in ("torch", "onnx") else "torch"
 
-        m = _create_model(arch, 2)
-        if dev.type == "cuda":
-            m = m.to(dev, memory_format=torch.channels_last)
+
+def _serving_precision(cfg: CbisDdsmConfig) -> str:
+    p = _env("ML_PRECISION", cfg.serve_precision).strip().lower()
+    return p if p in ("fp32", "bf16", "int8") else "fp32"
+
+
+def _quant_tolerances() -> Dict[str, float]:
+    return {
+        "bal_acc": _env_float("ML_QUANT_MAX_BAL_ACC_DROP", 0.01),
+        "auc": _env_float("ML_QUANT_MAX_AUC_DROP", 0.01),
+    }
+
+
+def _variant_drops(base: Dict[str, float], m: Dict[str, float]) -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for k in ("bal_acc", "auc"):
+        b = float(base.get(k, float("nan")))
+        v = float(m.get(k, float("nan")))
+        if math.isnan(b) and math.isnan(v):
+            out[k] = 0.0
+        elif math.isnan(b) or math.isnan(v):
+            out[k] = float("inf")
         else:
-            m = m.to(dev)
+            out[k] = b - v
+    return out
+
+
+def _variant_accepted(drops: Dict[str, float], tol: Dict[str, float]) -> bool:
+    return all(float(drops.get(k, float("inf"))) <= float(tol[k]) for k in tol)
+
+
+def _variant_refusal(meta: Dict, precision: str, model_mtime: int) -> Optional[str]:
+    rec = (meta.get("serving_variants") or {}).get(precision)
+    if not isinstance(rec, dict):
+        return f"{precision} has no recorded accuracy check (run quantize_mm.py)"
+    if int(rec.get("source_mtime") or 0) != int(model_mtime):
+        return f"{precision} accuracy record is stale for the current model.pt"
+    tol = _quant_tolerances()
+    drops = rec.get("drops") or {}
+    if not _variant_accepted(drops, tol):
+        return f"{precision} refused: drops {drops} exceed tolerance {tol}"
+    return None
 
-        sd = torch.load(ap["model"], map_location=dev)
-        m.load_state_dict(sd)
-        m.eval()
 
-        _MODEL = m
-        _DEV = dev
-        _META = meta
-        _SIG = sig
+def quantize_int8_static(model: nn.Module, calib_batches, example: torch.Tensor) -> nn.Module:
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
 
+    engines = torch.backends.quantized.supported_engines
+    engine = "x86" if "x86" in engines else ("fbgemm" if "fbgemm" in engines else engines[-1])
+    torch.backends.quantized.engine = engine
 
-def ensure_maps_loaded(cfg: Optional[CbisDdsmConfig] = None) -> None:
-    global _PATH_MAP, _NAME_MAP, _HASH_MAP, _MAP_SIG
+    m = model.to("cpu", memory_format=torch.contiguous_format).eval()
+    prepared = prepare_fx(m, get_default_qconfig_mapping(engine), (example,))
+    with torch.inference_mode():
+        for xb in calib_batches:
+            prepared(xb.to("cpu", torch.float32))
+    return convert_fx(prepared)
+
+
+@dataclass
+class ServedModel:
+    model: object
+    dev: torch.device
+    dtype: torch.dtype
+    meta: Dict
+    sig: Dict
+    info: Dict
+    key: str = ""
+    nbytes: int = 0
+    loaded_at: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.time)
+
+
+class UnknownModelId(LookupError):
+    pass
+
+
+def _is_model_dir(p: Path) -> bool:
+    return p.is_dir() and ((p / "CURRENT").exists() or (p / "model.pt").exists())
+
+
+def model_registry(cfg: Optional[CbisDdsmConfig] = None) -> Dict[str, Path]:
+    global _REGISTRY_CACHE
     cfg = cfg or CbisDdsmConfig()
     _, ad = _resolve_dirs(cfg)
+    root = _env("ML_MODELS_DIR", "")
+    spec = _env("ML_MODELS", "")
+    try:
+        root_mtime = int(Path(root).stat().st_mtime_ns) if root else 0
+    except OSError:
+        root_mtime = 0
+
+    sig = (str(ad), root, root_mtime, spec)
+    cached = _REGISTRY_CACHE
+    if cached is not None and cached[0] == sig:
+        return cached[1]
+
+    reg: Dict[str, Path] = {"": ad}
+    if root and Path(root).is_dir():
+        for p in sorted(Path(root).iterdir()):
+            if _is_model_dir(p):
+                reg[p.name] = p.resolve()
+    for item in spec.replace(";", ",").split(","):
+        if "=" in item:
+            k, v = item.split("=", 1)
+            if k.strip() and v.strip():
+                reg[k.strip()] = Path(v.strip()).resolve()
+
+    _REGISTRY_CACHE = (sig, reg)
+    return reg
+
+
+def _resolve_model_key(cfg: CbisDdsmConfig, model_id: str) -> Tuple[str, Path]:
+    reg = model_registry(cfg)
+    m = (model_id or "").strip()
+    if m in reg:
+        return m, reg[m]
+    if m and _env_bool("ML_MODEL_ID_STRICT", False) and m != _normalize_model_id(cfg, ""):
+        raise UnknownModelId(f"Unknown model_id: {m} (known: {', '.join(sorted(k for k in reg if k))})")
+    return "", reg[""]
+
+
+def _memory_budget() -> int:
+    return max(0, int(_env_float("ML_MODEL_MEM_BUDGET_MB", 0.0) * 1024 * 1024))
+
+
+def _model_nbytes(m, path: Path) -> int:
+    n = 0
+    if isinstance(m, nn.Module):
+        for t in list(m.parameters()) + list(m.buffers()):
+            n += int(t.numel()) * int(t.element_size())
+    if n == 0 and path.exists():
+        n = int(path.stat().st_size)
+    return n
+
+
+def _model_sig(cfg: CbisDdsmConfig, ad: Optional[Path] = None) -> Tuple[Dict, Dict, Dict[str, Path]]:
+    if ad is None:
+        _, ad = _resolve_dirs(cfg)
     ap = _artifact_paths(ad)
 
+    if not ap["model"].exists():
+        raise FileNotFoundError(f"Model artifact missing: {ap['model']}")
+
+    meta = _load_json(ap["meta"]) or {}
     sig = {
         "ad": str(ad),
-        "pm": int(ap["path_map"].stat().st_mtime) if ap["path_map"].exists() else 0,
-        "nm": int(ap["name_map"].stat().st_mtime) if ap["name_map"].exists() else 0,
-        "hm": int(ap["hash_map"].stat().st_mtime) if ap["hash_map"].exists() else 0,
+        "version": _current_version(ad),
+        "arch": str(meta.get("arch") or "efficientnet_b0"),
+        "mtime": int(ap["model"].stat().st_mtime),
+        "backend": _serving_backend(cfg),
+        "precision": _serving_precision(cfg),
     }
+    return sig, meta, ap
+
+
+def _build_served(cfg: CbisDdsmConfig, sig: Dict, meta: Dict, ap: Dict[str, Path]) -> ServedModel:
+    arch = sig["arch"]
+    backend = sig["backend"]
+    precision = sig["precision"]
+
+    fallback = None
+    if backend == "onnx":
+        if not ap["onnx"].exists():
+            fallback = f"ONNX graph missing: {ap['onnx']}"
+        elif int(ap["onnx"].stat().st_mtime) < sig["mtime"]:
+            fallback = f"ONNX graph older than model.pt: {ap['onnx']}"
+
+    prec_fallback = None
+    if precision != "fp32":
+        if backend == "onnx" and fallback is None:
+            prec_fallback = f"{precision} is not available for the onnx backend"
+        else:
+            prec_fallback = _variant_refusal(meta, precision, sig["mtime"])
+        if precision == "int8" and prec_fallback is None and not ap["int8"].exists():
+            prec_fallback = f"int8 model missing: {ap['int8']}"
+    served_precision = precision if prec_fallback is None else "fp32"
+    dtype = torch.float32
+    fusion, fusion_fallback = None, None
+
+    if backend == "onnx" and fallback is None:
+        dev = torch.device("cpu")
+        threads = _configure_cpu_threads()
+        src = ap["onnx"]
+        m = OnnxModel(src, threads["intra_op_threads"], threads["inter_op_threads"])
+    elif served_precision == "int8":
+        dev = torch.device("cpu")
+        threads = _configure_cpu_threads()
+        src = ap["int8"]
+        m = torch.jit.load(str(src), map_location="cpu")
+        m.eval()
+    else:
+        dev = _serving_device(cfg)
+        _speed_flags(dev)
+        threads = _configure_cpu_threads() if dev.type == "cpu" else {}
+        src = ap["model"]
+        m = _load_torch_model(arch, src, dev)
+        if _env_bool("ML_FUSE", True):
+            m, fusion, fusion_fallback = _fuse_for_serving(m, dev, int(meta.get("image_size") or 224))
+        if served_precision == "bf16":
+            dtype = torch.bfloat16
+            m = m.to(dtype=dtype)
+
+    info = {
+        "backend": "onnx" if isinstance(m, OnnxModel) else "torch",
+        "backend_requested": backend,
+        "backend_fallback": fallback,
+        "precision": served_precision,
+        "precision_requested": precision,
+        "precision_fallback": prec_fallback,
+        "device": str(dev),
+        "device_name": torch.cuda.get_device_name(dev) if dev.type == "cuda" else "cpu",
+        "arch": arch,
+        "channels_last": isinstance(m, nn.Module),
+        "gray_input": bool(getattr(m, "gray_input", False)),
+        "fusion": fusion,
+        "fusion_fallback": fusion_fallback,
+        "version": sig["version"],
+        "model_path": str(ap["model"]),
+        **threads,
+    }
+    return ServedModel(model=m, dev=dev, dtype=dtype, meta=meta, sig=sig, info=info, nbytes=_model_nbytes(m, src))
+
+
+def _fuse_for_serving(m: nn.Module, dev: torch.device, image_size: int) -> Tuple[nn.Module, Optional[Dict], Optional[str]]:
+    # Conv+BN fusion plus the folded grayscale stem, kept only if a probe
+    # batch gives the same probabilities as the original graph.
+    try:
+        fm, report = optimize_for_inference(copy.deepcopy(m), IMAGENET_MEAN, IMAGENET_STD)
+        fm = fm.to(dev, memory_format=torch.channels_last)
+        g = torch.Generator().manual_seed(0)
+        probe = torch.randint(0, 256, (2, 1, image_size, image_size), generator=g, dtype=torch.uint8).to(dev)
+        with torch.inference_mode():
+            ref = torch.softmax(m(normalize(probe).contiguous(memory_format=torch.channels_last)).float(), dim=1)
+            got = torch.softmax(fm(probe).float(), dim=1)
+        diff = float((ref - got).abs().max())
+    except Exception as e:
+        return m, None, f"fusion failed: {e!r}"
+    tol = _env_float("ML_FUSE_TOL", 1e-4)
+    if not diff <= tol:
+        return m, None, f"fused graph differs from the original by {diff:.2e} (tolerance {tol:.0e})"
+    report["probe_max_abs_diff"] = diff
+    return fm, report, None
+
+
+def _warmup_sizes(served: ServedModel) -> List[int]:
+    raw = _env("ML_WARMUP_SIZES", "")
+    sizes = [int(v) for v in raw.replace(";", ",").split(",") if v.strip().isdigit()]
+    return sizes or [int(served.meta.get("image_size") or 224)]
+
+
+def warmup(served: ServedModel) -> float:
+    t0 = time.perf_counter()
+    batches = sorted({1, max(1, _env_int("ML_BATCH_MAX", 16))})
+    for size in _warmup_sizes(served):
+        for n in batches:
+            forward_probs(torch.zeros(n, 1, size, size, dtype=torch.uint8), served)
+    ms = (time.perf_counter() - t0) * 1000.0
+    served.info["warmup_ms"] = float(ms)
+    return ms
+
+
+def current_served(key: str = "") -> Optional[ServedModel]:
+    return _SERVED.get(key)
+
+
+def install_served(served: ServedModel, key: str = "") -> None:
+    global _EVICTIONS
+    served.key = key
+    evicted = []
+    with _SERVED_LOCK:
+        _SERVED[key] = served
+        _SERVED.move_to_end(key)
+        budget = _memory_budget()
+        if budget > 0:
+            total = sum(v.nbytes for v in _SERVED.values())
+            for k in list(_SERVED):
+                if total <= budget or len(_SERVED) <= 1:
+                    break
+                if k == key:
+                    continue
+                old = _SERVED.pop(k)
+                total -= old.nbytes
+                evicted.append(k)
+                _EVICTIONS += 1
+                MODEL_EVICTIONS.inc()
+    for k in evicted:
+        print(f"model registry: evicted '{k or 'default'}' (budget {budget / 2**20:.0f} MB)", flush=True)
+    if evicted and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _touch(key: str, served: ServedModel) -> ServedModel:
+    served.last_used = time.time()
+    with _SERVED_LOCK:
+        if _SERVED.get(key) is served:
+            _SERVED.move_to_end(key)
+    return served
+
+
+def ensure_loaded(cfg: Optional[CbisDdsmConfig] = None, model_id: str = "") -> ServedModel:
+    cfg = cfg or CbisDdsmConfig()
+    key, ad = _resolve_model_key(cfg, model_id)
+
+    cur = _SERVED.get(key)
+    if cur is not None and model_watcher_running():
+        return _touch(key, cur)
+
+    sig, meta, ap = _model_sig(cfg, ad)
+    if cur is not None and cur.sig == sig:
+        return _touch(key, cur)
+
+    with _LOAD_LOCK:
+        cur = _SERVED.get(key)
+        if cur is not None and cur.sig == sig:
+            return _touch(key, cur)
+        served = _build_served(cfg, sig, meta, ap)
+        install_served(served, key)
+        MODEL_LOADS.inc(model=key or "default", kind="reload" if cur is not None else "load")
+        return served
+
+
+def reload_if_changed(cfg: Optional[CbisDdsmConfig] = None, model_id: str = "") -> bool:
+    cfg = cfg or CbisDdsmConfig()
+    key, ad = _resolve_model_key(cfg, model_id)
+
+    sig, meta, ap = _model_sig(cfg, ad)
+    cur = _SERVED.get(key)
+    if cur is not None and cur.sig == sig:
+        return False
+    if sig["version"] is None and time.time() - ap["model"].stat().st_mtime < _env_float("ML_MODEL_SETTLE_S", 2.0):
+        return False
+
+    served = _build_served(cfg, sig, meta, ap)
+    warmup(served)
+
+    with _LOAD_LOCK:
+        if cur is not None and _SERVED.get(key) is not cur:
+            return False
+        install_served(served, key)
+    MODEL_LOADS.inc(model=key or "default", kind="reload" if cur is not None else "load")
+    print(
+        f"model watcher: serving '{key or 'default'}' {served.info['arch']} version={sig['version']} "
+        f"warmup_ms={served.info['warmup_ms']:.0f}",
+        flush=True,
+    )
+    return True
+
+
+def _watch_loop(cfg: CbisDdsmConfig, interval: float) -> None:
+    while True:
+        for key in list(_SERVED) or [""]:
+            try:
+                reload_if_changed(cfg, key)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"model watcher: reload of '{key or 'default'}' failed: {e!r}", flush=True)
+                MODEL_LOAD_FAILURES.inc(model=key or "default")
+        if _WATCH_STOP.wait(interval):
+            break
+
+
+def model_watcher_running() -> bool:
+    if _WATCH_EXTERNAL:
+        return True
+    w = _WATCHER
+    return w is not None and w.is_alive()
+
+
+def start_model_watcher(cfg: Optional[CbisDdsmConfig] = None, interval: Optional[float] = None) -> bool:
+    global _WATCHER
+    if model_watcher_running():
+        return False
+    cfg = cfg or CbisDdsmConfig()
+    interval = float(interval if interval is not None else _env_float("ML_MODEL_WATCH_S", 5.0))
+    _WATCH_STOP.clear()
+    _WATCHER = threading.Thread(target=_watch_loop, args=(cfg, max(0.5, interval)), name="ml-model-watcher", daemon=True)
+    _WATCHER.start()
+    return True
+
+
+def stop_model_watcher() -> None:
+    global _WATCHER
+    _WATCH_STOP.set()
+    w = _WATCHER
+    _WATCHER = None
+    if w is not None:
+        w.join(timeout=5.0)
+
+
+def _file_sig(p: Path) -> Tuple[int, int]:
+    try:
+        st = p.stat()
+    except OSError:
+        return (0, 0)
+    return (int(st.st_mtime_ns), int(st.st_size))
+
+
+def _open_label_map(path: Path, legacy: Path) -> "Dict[str, str] | LabelIndex":
+    # Artifact dirs from before the binary index only have the JSON map;
+    # convert it once, or serve it as a dict if the dir is read-only.
+    if not path.exists() and legacy.exists():
+        try:
+            write_index(path, _load_map(legacy))
+        except OSError:
+            return _load_map(legacy)
+    if not path.exists():
+        return {}
+    try:
+        return LabelIndex(path)
+    except (OSError, ValueError) as e:
+        print(f"ground truth: cannot open {path.name}: {e}", flush=True)
+        return {}
+
+
+def _maps_sig(ad: Path, ap: Dict[str, Path]) -> Dict:
+    sig = {"ad": str(ad), **{k: _file_sig(ap[k]) + _file_sig(ap[k + "_json"]) for k in _MAP_KINDS}}
+    sig["phash_map"] = _file_sig(ap["phash_map"])
+    return sig
+
+
+def _open_phash_map(path: Path) -> Optional[np.ndarray]:
+    if not path.exists():
+        return None
+    try:
+        table = np.load(path, mmap_mode="r")
+    except (OSError, ValueError) as e:
+        print(f"ground truth: cannot open {path.name}: {e}", flush=True)
+        return None
+    return table if table.dtype == _PHASH_DTYPE else None
+
+
+def _release_maps() -> None:
+    global _PATH_MAP, _NAME_MAP, _HASH_MAP, _PHASH_MAP, _MAP_SIG
+    with _MAPS_LOCK:
+        _PATH_MAP, _NAME_MAP, _HASH_MAP, _PHASH_MAP = {}, {}, {}, None
+        _MAP_SIG = None
+
+
+def ensure_maps_loaded(cfg: Optional[CbisDdsmConfig] = None, force: bool = False) -> None:
+    global _PATH_MAP, _NAME_MAP, _HASH_MAP, _PHASH_MAP, _MAP_SIG, _MAP_CHECKED, _MAP_CHECK_S
+    # Lookups call this per request; the files are only re-stat'ed every
+    # ML_MAP_CHECK_S seconds.
+    now = time.monotonic()
+    if not force and _MAP_SIG is not None and now - _MAP_CHECKED < _MAP_CHECK_S:
+        return
+    _MAP_CHECKED = now
+    _MAP_CHECK_S = _env_float("ML_MAP_CHECK_S", 2.0)
+
+    cfg = cfg or CbisDdsmConfig()
+    _, ad = _resolve_dirs(cfg)
+    ap = _artifact_paths(ad)
+    sig = _maps_sig(ad, ap)
     if _MAP_SIG == sig:
         return
 
     with _MAPS_LOCK:
         if _MAP_SIG == sig:
             return
-        _PATH_MAP = _load_map(ap["path_map"])
-        _NAME_MAP = _load_map(ap["name_map"])
-        _HASH_MAP = _load_map(ap["hash_map"])
-        _MAP_SIG = sig
+        _PATH_MAP, _NAME_MAP, _HASH_MAP = (_open_label_map(ap[k], ap[k + "_json"]) for k in _MAP_KINDS)
+        _PHASH_MAP = _open_phash_map(ap["phash_map"])
+        _MAP_SIG = _maps_sig(ad, ap)
 
 
 def _update_train_state_from_artifacts(cfg: Optional[CbisDdsmConfig] = None) -> None:
@@ -1339,6 +2304,9 @@ def train_and_save(cfg: Optional[CbisDdsmConfig] = None) -> Dict:
     cfg.build_path_map = _env_bool("MM_BUILD_PATH_MAP", cfg.build_path_map)
     cfg.build_name_map = _env_bool("MM_BUILD_NAME_MAP", cfg.build_name_map)
     cfg.build_hash_map = _env_bool("MM_BUILD_HASH_MAP", cfg.build_hash_map)
+    cfg.build_phash_map = _env_bool("MM_BUILD_PHASH_MAP", cfg.build_phash_map)
+    cfg.build_image_cache = _env_bool("MM_BUILD_IMAGE_CACHE", cfg.build_image_cache)
+    cfg.use_image_cache = _env_bool("ML_USE_IMAGE_CACHE", cfg.use_image_cache)
 
     _seed_everything(cfg.seed)
 
@@ -1379,6 +2347,7 @@ def train_and_save(cfg: Optional[CbisDdsmConfig] = None) -> Dict:
         _TRAIN_STATE["done"] = False
         _TRAIN_STATE["error"] = None
 
+    samples: Optional[SampleTable] = None
     try:
         while True:
             try:
@@ -1387,12 +2356,15 @@ def train_and_save(cfg: Optional[CbisDdsmConfig] = None) -> Dict:
                 except Exception:
                     pass
 
-                print("train_and_save: resolving samples...", flush=True)
-                print(f"dataset_dir: {dsd}", flush=True)
-                print(f"artifact_dir: {ad}", flush=True)
-                print(f"dataset_kind: {cfg.dataset_kind}", flush=True)
+                if samples is None:
+                    print("train_and_save: resolving samples...", flush=True)
+                    print(f"dataset_dir: {dsd}", flush=True)
+                    print(f"artifact_dir: {ad}", flush=True)
+                    print(f"dataset_kind: {cfg.dataset_kind}", flush=True)
 
-                samples = build_samples(cfg)
+                    samples = build_samples(cfg)
+                    if cfg.build_image_cache:
+                        build_image_cache(cfg, samples, image_size)
                 print(f"train_and_save: total samples found = {len(samples)}", flush=True)
 
                 tr_s, va_s = _split_groupwise(cfg, samples)
@@ -1403,15 +2375,15 @@ def train_and_save(cfg: Optional[CbisDdsmConfig] = None) -> Dict:
                 if not va_s:
                     raise RuntimeError("Validation split is empty.")
 
-                y_train = [int(s.y) for s in tr_s]
-                y_val = [int(s.y) for s in va_s]
+                n_train = np.bincount(tr_s.y, minlength=2)
+                n_val = np.bincount(va_s.y, minlength=2)
 
                 print(
-                    f"train_and_save: train class counts -> benign={sum(1 for y in y_train if y == 0)} malignant={sum(1 for y in y_train if y == 1)}",
+                    f"train_and_save: train class counts -> benign={n_train[0]} malignant={n_train[1]}",
                     flush=True
                 )
                 print(
-                    f"train_and_save: val class counts -> benign={sum(1 for y in y_val if y == 0)} malignant={sum(1 for y in y_val if y == 1)}",
+                    f"train_and_save: val class counts -> benign={n_val[0]} malignant={n_val[1]}",
                     flush=True
                 )
 
@@ -1604,6 +2576,7 @@ def train_and_save(cfg: Optional[CbisDdsmConfig] = None) -> Dict:
                     "compile": bool(cfg.compile),
                     "mm_use_cache": bool(cfg.mm_use_cache),
                     "mm_cache_dir_name": str(cfg.mm_cache_dir_name),
+                    "image_cache_key": train_dl.dataset.cache.meta["key"] if train_dl.dataset.cache is not None else None,
                     "mm_use_augmented": bool(cfg.mm_use_augmented),
                     "mm_val_from_original_only": bool(cfg.mm_val_from_original_only),
                     "n_samples_total": int(len(samples)),
@@ -1702,17 +2675,25 @@ def find_ground_truth(cfg: Optional[CbisDdsmConfig], filename: str, file_bytes:
     f = (filename or "").replace("\\", "/").lower().strip()
     f2 = f.lstrip("/")
 
-    if f2 in _PATH_MAP:
-        return _PATH_MAP[f2]
+    hit = _PATH_MAP.get(f2)
+    if hit is not None:
+        return hit
 
-    name = Path(f2).name.lower()
-    if name in _NAME_MAP:
-        return _NAME_MAP[name]
+    hit = _NAME_MAP.get(Path(f2).name.lower())
+    if hit is not None:
+        return hit
 
     if file_bytes is not None and _HASH_MAP:
-        h = _sha1(file_bytes)
-        if h in _HASH_MAP:
-            return _HASH_MAP[h]
+        hit = _HASH_MAP.get(_sha1(file_bytes))
+        if hit is not None:
+            return hit
+
+    table = _PHASH_MAP
+    if file_bytes is not None and table is not None:
+        try:
+            return _phash_lookup(table, _phash_bytes(file_bytes, f2))
+        except Exception:
+            return None
 
     return None
 
@@ -1747,7 +2728,47 @@ def _make_out_of_domain_result(cfg: CbisDdsmConfig, model_id: str, q: Dict, dom:
     return out
 
 
-def predict_bytes(
+def _make_unusable_result(cfg: CbisDdsmConfig, model_id: str, q: Dict, dom: Dict) -> Dict:
+    out = {
+        "model_id": _normalize_model_id(cfg, model_id),
+        "label": "UNUSABLE_IMAGE",
+        "effective_probability": 0.0,
+        "best_probability": 0.0,
+        "probability": 0.0,
+        "proba_malignant": 0.0,
+        "probabilities": {"BENIGN": 0.0, "MALIGNANT": 0.0},
+        "ground_truth": None,
+        "match_with_dataset": None,
+    }
+    out.update(q or {})
+    out.update(dom or {})
+    return out
+
+
+@contextlib.contextmanager
+def _stage(hook, name: str, timings: Optional[Dict] = None):
+    t0 = time.perf_counter()
+    with hook(name) if hook is not None else contextlib.nullcontext():
+        yield
+    if timings is not None:
+        timings[name] = time.perf_counter() - t0
+
+
+def _stage_max_sides(image_size: int) -> Dict[str, int]:
+    analysis = max(0, _env_int("ML_ANALYSIS_MAX_SIDE", 1024))
+    return {
+        "analysis": analysis,
+        "preprocess": max(0, _env_int("ML_PREPROC_MAX_SIDE", max(analysis, 4 * int(image_size)))),
+    }
+
+
+def _decode_max_side(sides: Dict[str, int]) -> int:
+    if any(v <= 0 for v in sides.values()):
+        return 0
+    return max(_env_int("ML_DECODE_MAX_SIDE", 0), *sides.values())
+
+
+def analyze_bytes(
     cfg: Optional[CbisDdsmConfig],
     file_bytes: bytes,
     filename: str = "",
@@ -1755,63 +2776,141 @@ def predict_bytes(
     model_id: str = "",
     require_quality: bool = False,
     require_domain: bool = False,
-) -> Dict:
+    stage=None,
+    preprocess: bool = True,
+) -> Tuple[Optional[np.ndarray], Dict]:
     cfg = cfg or CbisDdsmConfig()
-    ensure_loaded(cfg)
-
-    dev = _DEV or _device()
-    model = _MODEL
-    if model is None:
-        raise RuntimeError("Model not loaded.")
 
+    # Wall time per stage in seconds, returned as info["timings"] on every path.
+    timings: Dict[str, float] = {}
     image_size = int(image_size)
-    im = decode_image_bytes_safe(file_bytes, filename=filename)
-    q = assess_quality(im)
-    dom = assess_domain_mammogram_like(im)
+    sides = _stage_max_sides(image_size)
+    with _stage(stage, "decode", timings):
+        im, dec = decode_image_bytes_reduced(file_bytes, filename=filename, max_side=_decode_max_side(sides))
+    with _stage(stage, "analyze"):
+        t0 = time.perf_counter()
+        work = _shrink(im, sides["analysis"])
+        timings["resize"] = time.perf_counter() - t0
+        a = analyze_image(work, src_size=(dec["src_w"], dec["src_h"]), timings=timings)
+        q, dom = a["q"], a["dom"]
 
     req_dom = bool(require_domain or _env_bool("D_REQUIRE", False))
 
     if require_quality and (q.get("quality_ok") is False):
-        out = {
-            "model_id": _normalize_model_id(cfg, model_id),
-            "label": "UNUSABLE_IMAGE",
-            "effective_probability": 0.0,
-            "best_probability": 0.0,
-            "probability": 0.0,
-            "proba_malignant": 0.0,
-            "probabilities": {"BENIGN": 0.0, "MALIGNANT": 0.0},
-            "ground_truth": None,
-            "match_with_dataset": None,
-        }
-        out.update(q)
-        out.update(dom)
-        return out
+        return None, {"result": _make_unusable_result(cfg, model_id, q, dom), "decode": dec, "timings": timings}
 
     if req_dom and (dom.get("domain_ok") is False):
-        return _make_out_of_domain_result(cfg, model_id, q, dom)
+        return None, {"result": _make_out_of_domain_result(cfg, model_id, q, dom), "decode": dec, "timings": timings}
+
+    info = {"q": q, "dom": dom, "decode": dec, "timings": timings}
+    with _stage(stage, "preprocess", timings):
+        pim = _shrink(im, sides["preprocess"])
+        gray, hist = (a["gray"], a["hist"]) if pim is work else (_gray_u8(pim), None)
+        if not preprocess:
+            # Letterboxing is left to the caller, which batches it on the model device.
+            info["preprocess"] = {"size": image_size, "mode": _preproc_mode(cfg)}
+            return gray, info
+        arr = _make_preprocessor(cfg, image_size).letterbox([gray], None if hist is None else hist[None])[0].numpy()
+    return arr, info
+
+
+def to_model_input(arr: np.ndarray) -> torch.Tensor:
+    # uint8 (1, 1, S, S); forward_probs normalises it unless the served graph
+    # takes grayscale directly.
+    return torch.from_numpy(np.array(arr, dtype=np.uint8, copy=True))[None, None]
+
+
+def prepare_gray_batch(grays: List[np.ndarray], key: Tuple[int, str], served: Optional[ServedModel] = None) -> torch.Tensor:
+    served = served or _SERVED.get("")
+    dev = served.dev if served is not None else torch.device("cpu")
+    size, mode = key
+    t0 = time.perf_counter()
+    x = letterboxer(size, mode, dev).letterbox(grays).unsqueeze(1)
+    STAGE_SECONDS.observe(time.perf_counter() - t0, stage="preprocess_batch")
+    return x
 
-    tf = T.Compose([
-        _make_preprocessor(cfg, image_size),
-        T.ToTensor(),
-        T.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD),
-    ])
 
-    x = tf(im).unsqueeze(0)
-    if dev.type == "cuda":
-        x = x.to(dev, non_blocking=True, memory_format=torch.channels_last)
-    else:
-        x = x.to(dev, non_blocking=True)
+def prepare_bytes(
+    cfg: Optional[CbisDdsmConfig],
+    file_bytes: bytes,
+    filename: str = "",
+    image_size: int = 224,
+    model_id: str = "",
+    require_quality: bool = False,
+    require_domain: bool = False,
+    stage=None,
+) -> Tuple[Optional[torch.Tensor], Dict]:
+    arr, info = analyze_bytes(
+        cfg,
+        file_bytes,
+        filename=filename,
+        image_size=image_size,
+        model_id=model_id,
+        require_quality=require_quality,
+        require_domain=require_domain,
+        stage=stage,
+    )
+    if arr is None:
+        return None, info
+    return to_model_input(arr), info
+
+
+def forward_probs(x: torch.Tensor, served: Optional[ServedModel] = None, timings: Optional[Dict] = None) -> np.ndarray:
+    served = served or _SERVED.get("")
+    if served is None:
+        raise RuntimeError("Model not loaded.")
+
+    t0 = time.perf_counter()
+    if x.dtype == torch.uint8:
+        x = x.to(served.dev, non_blocking=True)
+        if not served.info.get("gray_input"):
+            x = normalize(x)
+    if x.is_floating_point():
+        x = x.to(served.dev, dtype=served.dtype, non_blocking=True, memory_format=torch.channels_last)
+    t1 = time.perf_counter()
 
     with torch.inference_mode():
-        logits = model(x)
-        probs = torch.softmax(logits, dim=1).squeeze(0).detach().float().cpu().numpy().astype(np.float64)
+        logits = served.model(x)
+        probs = torch.softmax(logits.float(), dim=1).detach().cpu().numpy().astype(np.float64)
+    t2 = time.perf_counter()
+
+    STAGE_SECONDS.observe(t1 - t0, stage="h2d")
+    STAGE_SECONDS.observe(t2 - t1, stage="forward")
+    BATCH_SIZE.observe(len(probs))
+    if timings is not None:
+        timings.update(h2d=t1 - t0, forward=t2 - t1)
+    return probs
+
+
+def _timed_ground_truth(
+    cfg: CbisDdsmConfig, filename: str, file_bytes: Optional[bytes], timings: Optional[Dict] = None
+) -> Optional[str]:
+    t0 = time.perf_counter()
+    gt = find_ground_truth(cfg, filename=filename, file_bytes=file_bytes)
+    dt = time.perf_counter() - t0
+    STAGE_SECONDS.observe(dt, stage="ground_truth")
+    if timings is not None:
+        timings["ground_truth"] = dt
+    return gt
+
+
+def finish_prediction(
+    cfg: Optional[CbisDdsmConfig],
+    probs: np.ndarray,
+    info: Dict,
+    file_bytes: bytes,
+    filename: str = "",
+    model_id: str = "",
+    timings: Optional[Dict] = None,
+) -> Dict:
+    cfg = cfg or CbisDdsmConfig()
 
     p_benign, p_malign = float(probs[0]), float(probs[1])
     idx = int(np.argmax(probs))
     label = IDX_TO_LABEL[idx]
     probas = {"BENIGN": p_benign, "MALIGNANT": p_malign}
 
-    gt = find_ground_truth(cfg, filename=filename, file_bytes=file_bytes)
+    gt = _timed_ground_truth(cfg, filename, file_bytes, timings)
     match = (gt == label) if gt else None
 
     out = {
@@ -1826,11 +2925,70 @@ def predict_bytes(
         "match_with_dataset": match,
     }
 
-    out.update(q)
-    out.update(dom)
+    out.update(info.get("q") or {})
+    out.update(info.get("dom") or {})
     return out
 
 
+def model_signature(key: str = "") -> Optional[Dict]:
+    served = _SERVED.get(key)
+    return dict(served.sig) if served is not None else None
+
+
+def attach_request_fields(
+    cfg: Optional[CbisDdsmConfig],
+    out: Dict,
+    file_bytes: bytes,
+    filename: str = "",
+    model_id: str = "",
+    timings: Optional[Dict] = None,
+) -> Dict:
+    cfg = cfg or CbisDdsmConfig()
+    out = dict(out)
+    out["model_id"] = _normalize_model_id(cfg, model_id)
+
+    label = out.get("label")
+    if label in LABEL_TO_IDX:
+        gt = _timed_ground_truth(cfg, filename, file_bytes, timings)
+        out["ground_truth"] = gt
+        out["match_with_dataset"] = (gt == label) if gt else None
+    return out
+
+
+def predict_bytes(
+    cfg: Optional[CbisDdsmConfig],
+    file_bytes: bytes,
+    filename: str = "",
+    image_size: int = 224,
+    model_id: str = "",
+    require_quality: bool = False,
+    require_domain: bool = False,
+    timings: Optional[Dict] = None,
+) -> Dict:
+    # timings, if given, receives the stage wall times in seconds plus
+    # "input" (decode format and dimensions).
+    cfg = cfg or CbisDdsmConfig()
+    served = ensure_loaded(cfg, model_id)
+
+    x, info = prepare_bytes(
+        cfg,
+        file_bytes,
+        filename=filename,
+        image_size=image_size,
+        model_id=model_id,
+        require_quality=require_quality,
+        require_domain=require_domain,
+    )
+    if timings is not None:
+        timings.update(info.get("timings") or {})
+        timings["input"] = dict(info.get("decode") or {})
+    if x is None:
+        return info["result"]
+
+    probs = forward_probs(x, served, timings)[0]
+    return finish_prediction(cfg, probs, info, file_bytes, filename=filename, model_id=model_id, timings=timings)
+
+
 def start_train_background(cfg: Optional[CbisDdsmConfig] = None) -> Dict:
     cfg = cfg or CbisDdsmConfig()
 
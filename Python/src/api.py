@@ -1,21 +1,72 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import importlib
+import importlib.util
+import json
 import logging
 import os
 import sys
+import threading
+import time
 import traceback
+import zipfile
 from pathlib import Path
-from typing import Optional
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
-import torch
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 if str(PROJECT_ROOT) not in sys.path:
     sys.path.insert(0, str(PROJECT_ROOT))
 
-import src.CBISDDSM as mm
+_T_IMPORTED = time.perf_counter()
+
+
+class _LazyModule:
+    # Resolves the real module on first attribute access. importlib's own
+    # per-module import lock makes concurrent first accesses wait for the one
+    # import in progress instead of seeing a half-initialised module.
+    def __init__(self, name: str):
+        self.__dict__["_name"] = name
+        self.__dict__["_mod"] = None
+
+    def _load(self):
+        mod = self.__dict__["_mod"]
+        if mod is None:
+            mod = importlib.import_module(self.__dict__["_name"])
+            self.__dict__["_mod"] = mod
+        return mod
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr: str, value) -> None:
+        setattr(self._load(), attr, value)
+
+
+def _lazy_import(name: str):
+    mod = sys.modules.get(name)
+    if mod is not None:
+        return mod
+    if importlib.util.find_spec(name) is None:
+        raise ImportError(name)
+    return _LazyModule(name)
+
+
+# torch, torchvision and the model module are only imported on first use, so
+# uvicorn can bind and answer liveness probes before they are loaded.
+mm = _lazy_import("src.CBISDDSM")
+batching = _lazy_import("src.batching")
+execution = _lazy_import("src.execution")
+
+import src.metrics as metrics
+import src.prefork as prefork
+import src.tracing as tracing
+from src.env import _env_bool, _env_int
+from src.prediction_cache import PredictionCache, cache_from_env
 
 logging.basicConfig(
     level=logging.INFO,
@@ -25,6 +76,9 @@ logging.basicConfig(
 logger = logging.getLogger("ml_server")
 
 DEBUG_ENV = os.environ.get("ML_DEBUG", "0").strip() == "1"
+SERVER_TIMING_ENV = os.environ.get("ML_SERVER_TIMING", "1").strip() != "0"
+TIMINGS_ENV = os.environ.get("ML_TIMINGS", "0").strip() == "1"
+RETRY_AFTER_S = max(1, _env_int("ML_RETRY_AFTER_S", 1))
 
 app = FastAPI(title="MedFlow ML", version="1.0")
 
@@ -32,6 +86,8 @@ app = FastAPI(title="MedFlow ML", version="1.0")
 def _log_ml_env() -> None:
     if not DEBUG_ENV:
         return
+    import torch
+
     logger.debug("=== ML SERVER ENV ===")
     logger.debug("sys.executable = %s", sys.executable)
     logger.debug("sys.version = %s", sys.version)
@@ -50,6 +106,280 @@ def _log_ml_env() -> None:
 _log_ml_env()
 
 
+_INIT_LOCK = threading.Lock()
+
+_BATCHER: Optional[batching.MicroBatcher] = None
+_BATCHER_INIT = False
+
+
+def _get_batcher() -> Optional[batching.MicroBatcher]:
+    global _BATCHER, _BATCHER_INIT
+    with _INIT_LOCK:
+        if not _BATCHER_INIT:
+            _BATCHER = batching.batcher_from_env(mm.forward_probs, prepare=mm.prepare_gray_batch)
+            _BATCHER_INIT = True
+            if _BATCHER is not None:
+                logger.info(
+                    "Micro-batching enabled: max_batch=%s max_wait_ms=%s",
+                    _BATCHER.max_batch, _BATCHER.max_wait * 1000.0,
+                )
+    return _BATCHER
+
+
+_EXECUTOR: Optional[execution.PrepareExecutor] = None
+
+
+def _get_executor() -> execution.PrepareExecutor:
+    global _EXECUTOR
+    with _INIT_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = execution.executor_from_env()
+            logger.info("Prepare executor: %s", _EXECUTOR.stats())
+    return _EXECUTOR
+
+
+_CACHE: Optional[PredictionCache] = None
+_CACHE_INIT = False
+
+
+def _get_cache() -> Optional[PredictionCache]:
+    global _CACHE, _CACHE_INIT
+    with _INIT_LOCK:
+        if not _CACHE_INIT:
+            _CACHE = cache_from_env()
+            _CACHE_INIT = True
+            if _CACHE is not None:
+                logger.info("Prediction cache: %s", _CACHE.stats())
+    return _CACHE
+
+
+_STARTUP: Dict = {
+    "preload": _env_bool("ML_PRELOAD", True),
+    "preloaded": False,
+    "phase": "import",
+    "phases_ms": {},
+    "ready_after_ms": None,
+    "error": None,
+}
+
+
+@contextlib.contextmanager
+def _startup_phase(name: str):
+    _STARTUP["phase"] = name
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _STARTUP["phases_ms"][name] = round((time.perf_counter() - t0) * 1000.0, 1)
+
+
+def _preload() -> None:
+    try:
+        if _STARTUP["preload"]:
+            with _startup_phase("import"):
+                cfg = mm.CbisDdsmConfig()
+                _ = execution.PrepareExecutor, batching.MicroBatcher
+            with _startup_phase("model_load"):
+                served = mm.ensure_loaded(cfg)
+            with _startup_phase("warmup"):
+                mm.warmup(served)
+            with _startup_phase("ground_truth_maps"):
+                mm.ensure_maps_loaded(cfg)
+            with _startup_phase("executor"):
+                _get_executor().prestart()
+                _get_batcher()
+                _get_cache()
+    except Exception as e:
+        _STARTUP["error"] = f"{type(e).__name__}: {e}"
+        logger.warning("Preload failed in phase %s: %s", _STARTUP["phase"], _STARTUP["error"])
+    finally:
+        _STARTUP["preloaded"] = True
+        _STARTUP["phase"] = "done"
+        _STARTUP["ready_after_ms"] = round((time.perf_counter() - _T_IMPORTED) * 1000.0, 1)
+        logger.info("Startup phases (ms): %s", _STARTUP["phases_ms"])
+
+    # The watcher also picks up a model that failed to load above, so it is
+    # started on its own; only an import failure stops it.
+    try:
+        if mm._env_bool("ML_MODEL_WATCH", True):
+            mm.start_model_watcher(mm.CbisDdsmConfig())
+            logger.info("Model watcher started (interval=%ss)", mm._env_float("ML_MODEL_WATCH_S", 5.0))
+    except Exception as e:
+        logger.warning("Model watcher not started: %s: %s", type(e).__name__, e)
+
+
+_PRELOAD_THREAD: Optional[threading.Thread] = None
+
+
+def _startup_info() -> Dict:
+    return {**_STARTUP, "phases_ms": dict(_STARTUP["phases_ms"])}
+
+
+def _is_ready() -> bool:
+    if not _STARTUP["preload"]:
+        return True
+    return bool(_STARTUP["preloaded"]) and mm.current_served() is not None
+
+
+@app.on_event("startup")
+def _start_preload() -> None:
+    _STARTUP["phases_ms"]["bind"] = round((time.perf_counter() - _T_IMPORTED) * 1000.0, 1)
+    global _PRELOAD_THREAD
+    tracing.set_span_exporter(tracing.exporter_from_env())
+    _PRELOAD_THREAD = threading.Thread(target=_preload, name="ml-preload", daemon=True)
+    _PRELOAD_THREAD.start()
+
+
+@app.on_event("shutdown")
+def _close_runtime() -> None:
+    if _PRELOAD_THREAD is not None:
+        _PRELOAD_THREAD.join(timeout=30.0)
+    if "src.CBISDDSM" in sys.modules and _STARTUP["preloaded"]:
+        mm.stop_model_watcher()
+    if _BATCHER is not None:
+        _BATCHER.close()
+    if _EXECUTOR is not None:
+        _EXECUTOR.close()
+    if _CACHE is not None:
+        try:
+            _CACHE.save()
+        except Exception:
+            logger.warning("Could not persist prediction cache", exc_info=True)
+
+
+async def _predict_async(
+    cfg: mm.CbisDdsmConfig,
+    b: bytes,
+    filename: str,
+    image_size: int,
+    model_id: str,
+    require_quality: bool,
+    require_domain: bool,
+    endpoint: str = "predict",
+    trace: Optional[tracing.RequestTrace] = None,
+) -> dict:
+    metrics.INFLIGHT.inc()
+    t0 = time.perf_counter()
+    outcome = "error"
+    try:
+        out = await _predict_cached(cfg, b, filename, image_size, model_id, require_quality, require_domain, trace)
+        outcome = str(out.get("label") or "error")
+        return out
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        metrics.INFLIGHT.dec()
+        metrics.PREDICTIONS.inc(outcome=outcome)
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - t0, endpoint=endpoint)
+
+
+async def _predict_cached(
+    cfg: mm.CbisDdsmConfig,
+    b: bytes,
+    filename: str,
+    image_size: int,
+    model_id: str,
+    require_quality: bool,
+    require_domain: bool,
+    trace: Optional[tracing.RequestTrace] = None,
+) -> dict:
+    served = await asyncio.to_thread(mm.ensure_loaded, cfg, model_id)
+
+    cache = _get_cache()
+    if cache is None:
+        return await _predict_uncached(
+            cfg, served, b, filename, image_size, model_id, require_quality, require_domain, trace
+        )
+
+    key = await asyncio.to_thread(
+        PredictionCache.make_key, b, served.sig, image_size, require_quality, require_domain
+    )
+    out, how = await cache.get_or_compute(
+        key,
+        lambda: _predict_uncached(cfg, served, b, filename, image_size, model_id, require_quality, require_domain, trace),
+    )
+    if trace is not None:
+        trace.attrs["cache"] = how
+    if how == "miss":
+        return out
+    return await asyncio.to_thread(
+        mm.attach_request_fields, cfg, out, b, filename=filename, model_id=model_id,
+        timings=trace.stages if trace is not None else None,
+    )
+
+
+def _batch_preprocess(served: mm.ServedModel) -> bool:
+    # Letterbox inside the batcher, as one batch on the model device. On a CPU
+    # model the executor workers already spread that work across processes.
+    v = mm._env("ML_BATCH_PREPROCESS", "auto").lower()
+    if v in ("1", "true", "yes", "y", "on"):
+        return True
+    if v in ("0", "false", "no", "n", "off"):
+        return False
+    return served.dev.type != "cpu"
+
+
+async def _predict_uncached(
+    cfg: mm.CbisDdsmConfig,
+    served: mm.ServedModel,
+    b: bytes,
+    filename: str,
+    image_size: int,
+    model_id: str,
+    require_quality: bool,
+    require_domain: bool,
+    trace: Optional[tracing.RequestTrace] = None,
+) -> dict:
+    tm = trace.stages if trace is not None else None
+    batcher = _get_batcher()
+    raw = batcher is not None and _batch_preprocess(served)
+    t0 = time.perf_counter()
+    x, info = await _get_executor().analyze(
+        cfg,
+        b,
+        filename=filename,
+        image_size=image_size,
+        model_id=model_id,
+        require_quality=require_quality,
+        require_domain=require_domain,
+        preprocess=not raw,
+    )
+    metrics.observe_stages(info.get("timings"))
+    if trace is not None:
+        # Time spent outside the analysis stages: executor queueing and IPC.
+        worker = sum((info.get("timings") or {}).values())
+        trace.add(info.get("timings"))
+        trace.add({"executor_wait": max(0.0, time.perf_counter() - t0 - worker)})
+        trace.attrs["input"] = {**(info.get("decode") or {}), "image_size": int(image_size)}
+    if x is None:
+        return info["result"]
+
+    if batcher is None:
+        probs = (await asyncio.to_thread(mm.forward_probs, x, served, tm))[0]
+    elif raw:
+        pp = info["preprocess"]
+        probs = await batcher.predict_async(x, served, key=(int(pp["size"]), str(pp["mode"])), timings=tm)
+    else:
+        probs = await batcher.predict_async(x, served, timings=tm)
+
+    return await asyncio.to_thread(
+        mm.finish_prediction, cfg, probs, info, b, filename=filename, model_id=model_id, timings=tm
+    )
+
+
+@app.get("/api/health/live")
+def api_health_live():
+    return {"ok": True, "uptime_s": round(time.perf_counter() - _T_IMPORTED, 3)}
+
+
+@app.get("/api/health/ready")
+def api_health_ready():
+    ready = _is_ready()
+    body = {"ready": ready, "startup": _startup_info()}
+    return JSONResponse(status_code=200 if ready else 503, content=body)
+
+
 @app.get("/api/status")
 def api_status():
     cfg = mm.CbisDdsmConfig()
@@ -60,14 +390,34 @@ def api_status():
         "training": tr,
         "runtime": {
             "python": sys.executable,
-            "torch_version": torch.__version__,
-            "torch_cuda_version": torch.version.cuda,
-            "cuda_available": torch.cuda.is_available(),
-            "cuda_device_count": torch.cuda.device_count(),
+            "torch_version": mm.torch.__version__,
+            "torch_cuda_version": mm.torch.version.cuda,
+            "cuda_available": mm.torch.cuda.is_available(),
+            "cuda_device_count": mm.torch.cuda.device_count(),
+            "device_config": os.environ.get("ML_DEVICE", "auto"),
         },
+        "serving": mm.get_serving_info(),
+        "worker": prefork.worker_info(),
+        "startup": _startup_info(),
+        "batching": _BATCHER.stats() if _BATCHER is not None else None,
+        "executor": _EXECUTOR.stats() if _EXECUTOR is not None else None,
+        "prediction_cache": _CACHE.stats() if _CACHE is not None else None,
     }
 
 
+@app.get("/metrics")
+def api_metrics():
+    if not metrics.ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled (ML_METRICS=0)")
+    if _BATCHER is not None:
+        metrics.QUEUE_DEPTH.set(_BATCHER.stats()["queue_depth"], queue="batcher")
+    if _EXECUTOR is not None:
+        metrics.QUEUE_DEPTH.set(_EXECUTOR.stats()["pending"], queue="executor")
+    if "src.CBISDDSM" in sys.modules:
+        metrics.MODELS_LOADED.set(len(mm._SERVED))
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.post("/api/imaging/predict")
 async def api_predict(
     file: UploadFile = File(...),
@@ -75,7 +425,9 @@ async def api_predict(
     image_size: int = Form(224),
     require_quality: int = Form(0),
     require_domain: int = Form(1),
+    timings: int = Form(0),
 ):
+    trace = tracing.RequestTrace("predict")
     try:
         logger.info(
             "Predict request: filename=%s model_id=%s image_size=%s "
@@ -84,6 +436,7 @@ async def api_predict(
         )
 
         if DEBUG_ENV:
+            torch = mm.torch
             logger.debug("cuda_available=%s cuda_version=%s", torch.cuda.is_available(), torch.version.cuda)
             if torch.cuda.is_available():
                 try:
@@ -95,7 +448,7 @@ async def api_predict(
         if not b:
             raise HTTPException(status_code=400, detail="File is empty")
 
-        out = mm.predict_bytes(
+        out = await _predict_async(
             mm.CbisDdsmConfig(),
             b,
             filename=file.filename or "",
@@ -103,16 +456,36 @@ async def api_predict(
             model_id=model_id,
             require_quality=bool(int(require_quality)),
             require_domain=bool(int(require_domain)),
+            trace=trace,
         )
 
         status = 422 if out.get("label") in ("OUT_OF_DOMAIN", "UNUSABLE_IMAGE") else 200
 
         logger.info("Predict result: label=%s status=%s", out.get("label"), status)
 
-        return JSONResponse(status_code=status, content=out)
+        trace.finish()
+        if timings or TIMINGS_ENV:
+            out = {**out, "timings": trace.as_dict()}
+        headers = {"Server-Timing": trace.server_timing()} if SERVER_TIMING_ENV else None
+        return JSONResponse(status_code=status, content=out, headers=headers)
 
     except HTTPException:
         raise
+    except mm.UnknownModelId as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except execution.ExecutorBusy as e:
+        logger.warning("Predict rejected: filename=%s %s", file.filename, e)
+        raise HTTPException(status_code=503, detail=str(e))
+    except execution.StageTimeout as e:
+        logger.error("Predict timed out: filename=%s %s", file.filename, e)
+        raise HTTPException(status_code=504, detail=str(e))
+    except execution.PoolRecycled as e:
+        logger.warning("Predict interrupted: filename=%s pool_recycled=%d %s", file.filename, e.recycled, e)
+        raise HTTPException(
+            status_code=503,
+            detail={"error": str(e), "pool_recycled": e.recycled},
+            headers={"Retry-After": str(RETRY_AFTER_S)},
+        )
     except Exception as e:
         logger.error(
             "Predict failed: filename=%s model_id=%s error=%s: %s",
@@ -121,9 +494,156 @@ async def api_predict(
         )
         raise HTTPException(status_code=500, detail=f"{type(e).__name__}: {e}")
     finally:
+        tracing.export(trace)
         await file.close()
 
 
+def _is_zip_upload(f: UploadFile) -> bool:
+    if (f.filename or "").lower().endswith(".zip"):
+        return True
+    try:
+        head = f.file.read(4)
+        f.file.seek(0)
+        return head == b"PK\x03\x04"
+    except Exception:
+        return False
+
+
+async def _iter_batch_inputs(files: List[UploadFile]) -> AsyncIterator[Tuple[str, Optional[bytes], Optional[str]]]:
+    max_entry = mm._env_int("ML_BATCH_MAX_ENTRY_MB", 200) * 1024 * 1024
+
+    for f in files:
+        if not _is_zip_upload(f):
+            yield f.filename or "", await f.read(), None
+            continue
+
+        try:
+            zf = zipfile.ZipFile(f.file)
+        except zipfile.BadZipFile as e:
+            yield f.filename or "", None, f"BadZipFile: {e}"
+            continue
+
+        with zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                if Path(info.filename).suffix.lower() not in mm.SUPPORTED_IMAGE_EXTS:
+                    continue
+                if info.file_size > max_entry:
+                    yield info.filename, None, f"Entry too large: {info.file_size} bytes"
+                    continue
+                yield info.filename, await asyncio.to_thread(zf.read, info), None
+
+
+async def _predict_batch_item(
+    index: int,
+    filename: str,
+    b: Optional[bytes],
+    error: Optional[str],
+    model_id: str,
+    image_size: int,
+    require_quality: bool,
+    require_domain: bool,
+    timings: bool = False,
+) -> dict:
+    head = {"index": int(index), "filename": filename}
+    if error is not None:
+        return {**head, "status": 400, "error": error}
+    if not b:
+        return {**head, "status": 400, "error": "File is empty"}
+
+    trace = tracing.RequestTrace("predict_batch_item")
+    try:
+        out = await _predict_async(
+            mm.CbisDdsmConfig(),
+            b,
+            filename=filename,
+            image_size=image_size,
+            model_id=model_id,
+            require_quality=require_quality,
+            require_domain=require_domain,
+            endpoint="predict_batch",
+            trace=trace,
+        )
+    except mm.UnknownModelId as e:
+        return {**head, "status": 404, "error": str(e)}
+    except execution.ExecutorBusy as e:
+        return {**head, "status": 503, "error": str(e)}
+    except execution.StageTimeout as e:
+        return {**head, "status": 504, "error": str(e)}
+    except execution.PoolRecycled as e:
+        logger.warning("Batch item interrupted: filename=%s pool_recycled=%d %s", filename, e.recycled, e)
+        return {**head, "status": 503, "error": str(e), "pool_recycled": e.recycled, "retry_after": RETRY_AFTER_S}
+    except Exception as e:
+        logger.error("Batch item failed: filename=%s error=%s: %s", filename, type(e).__name__, e, exc_info=True)
+        return {**head, "status": 500, "error": f"{type(e).__name__}: {e}"}
+    finally:
+        tracing.export(trace)
+
+    status = 422 if out.get("label") in ("OUT_OF_DOMAIN", "UNUSABLE_IMAGE") else 200
+    if timings or TIMINGS_ENV:
+        out = {**out, "timings": trace.finish().as_dict()}
+    return {**head, "status": status, **out}
+
+
+@app.post("/api/imaging/predict_batch")
+async def api_predict_batch(
+    files: List[UploadFile] = File(...),
+    model_id: str = Form(""),
+    image_size: int = Form(224),
+    require_quality: int = Form(0),
+    require_domain: int = Form(1),
+    timings: int = Form(0),
+):
+    if not files:
+        raise HTTPException(status_code=400, detail="No files")
+
+    ex = _get_executor()
+    limit = max(1, mm._env_int("ML_BATCH_CONCURRENCY", max(2, min(16, ex.max_pending // 2))))
+    req_q = bool(int(require_quality))
+    req_d = bool(int(require_domain))
+
+    logger.info(
+        "Predict batch request: files=%s model_id=%s image_size=%s concurrency=%s",
+        len(files), model_id, image_size, limit,
+    )
+
+    async def _stream() -> AsyncIterator[bytes]:
+        pending = set()
+        n_done = 0
+        it = _iter_batch_inputs(files).__aiter__()
+        exhausted = False
+        index = 0
+        try:
+            while True:
+                while not exhausted and len(pending) < limit:
+                    try:
+                        name, b, err = await it.__anext__()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    pending.add(asyncio.ensure_future(_predict_batch_item(
+                        index, name, b, err, model_id, int(image_size), req_q, req_d, bool(int(timings)),
+                    )))
+                    index += 1
+
+                if not pending:
+                    break
+
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    n_done += 1
+                    yield (json.dumps(t.result(), ensure_ascii=False) + "\n").encode("utf-8")
+        finally:
+            for t in pending:
+                t.cancel()
+            for f in files:
+                await f.close()
+            logger.info("Predict batch finished: items=%s", n_done)
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
+
+
 @app.get("/api/imaging/ground_truth")
 def api_ground_truth(filename: Optional[str] = None):
     gt = mm.find_ground_truth(mm.CbisDdsmConfig(), filename or "")
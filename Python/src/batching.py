@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+import src.CBISDDSM as mm
+
+
+class MicroBatcher:
+    def __init__(
+        self,
+        forward: Callable[..., np.ndarray],
+        max_batch: int = 16,
+        max_wait_ms: float = 5.0,
+        name: str = "ml-batcher",
+        prepare: Optional[Callable[[List[Any], Any, Any], torch.Tensor]] = None,
+    ):
+        self.forward = forward
+        self.prepare = prepare
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+
+        self._q: "queue.Queue[Optional[Tuple[Any, Any, Any, Future, Optional[Dict], float]]]" = queue.Queue()
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "batches": 0, "max_batch_seen": 0, "errors": 0}
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, x: Any, model: Any = None, key: Any = None, timings: Optional[Dict] = None) -> Future:
+        # Without a key, x is a ready model input. With a key, x is a raw item
+        # that `prepare` turns into a batch together with others of the same key.
+        # A timings dict gets this item's queue wait and its batch's stage times.
+        if self._closed:
+            raise RuntimeError("Batcher is closed.")
+        if key is not None:
+            if self.prepare is None:
+                raise ValueError("Batcher has no prepare function for raw inputs")
+        else:
+            if x.dim() == 3:
+                x = x.unsqueeze(0)
+            if x.dim() != 4 or int(x.size(0)) != 1:
+                raise ValueError(f"Expected a single sample tensor, got shape {tuple(x.shape)}")
+        fut: Future = Future()
+        self._q.put((x, model, key, fut, timings, time.perf_counter()))
+        return fut
+
+    def predict(
+        self, x: Any, model: Any = None, timeout: Optional[float] = None, key: Any = None, timings: Optional[Dict] = None
+    ) -> np.ndarray:
+        return self.submit(x, model, key, timings).result(timeout=timeout)
+
+    async def predict_async(self, x: Any, model: Any = None, key: Any = None, timings: Optional[Dict] = None) -> np.ndarray:
+        return await asyncio.wrap_future(self.submit(x, model, key, timings))
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            st = dict(self._stats)
+        st["max_batch"] = self.max_batch
+        st["max_wait_ms"] = self.max_wait * 1000.0
+        st["queue_depth"] = self._q.qsize()
+        st["avg_batch"] = float(st["requests"]) / max(1, st["batches"])
+        return st
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._q.put(None)
+        self._thread.join(timeout=5.0)
+
+    def _collect(self) -> Tuple[List[Tuple], bool]:
+        first = self._q.get()
+        if first is None:
+            return [], True
+
+        items = [first]
+        deadline = time.perf_counter() + self.max_wait
+        stop = False
+
+        while len(items) < self.max_batch:
+            left = deadline - time.perf_counter()
+            try:
+                it = self._q.get(timeout=left) if left > 0 else self._q.get_nowait()
+            except queue.Empty:
+                break
+            if it is None:
+                stop = True
+                break
+            items.append(it)
+
+        return items, stop
+
+    def _run_group(self, model: Any, key: Any, group: List[Tuple[Any, Future, Optional[Dict], float]]) -> None:
+        group = [it for it in group if it[1].set_running_or_notify_cancel()]
+        if not group:
+            return
+        t0 = time.perf_counter()
+        bt = {} if any(it[2] is not None for it in group) else None
+        kw = {} if bt is None else {"timings": bt}
+        try:
+            if key is not None:
+                xb = self.prepare([it[0] for it in group], key, model)
+                if bt is not None:
+                    bt["preprocess_batch"] = time.perf_counter() - t0
+            else:
+                xb = group[0][0] if len(group) == 1 else torch.cat([it[0] for it in group], dim=0)
+            probs = self.forward(xb, **kw) if model is None else self.forward(xb, model, **kw)
+            if len(probs) != len(group):
+                raise RuntimeError(f"Forward returned {len(probs)} rows for a batch of {len(group)}")
+        except Exception as e:
+            with self._stats_lock:
+                self._stats["errors"] += 1
+            for _, f, _, _ in group:
+                f.set_exception(e)
+            return
+
+        with self._stats_lock:
+            self._stats["requests"] += len(group)
+            self._stats["batches"] += 1
+            self._stats["max_batch_seen"] = max(self._stats["max_batch_seen"], len(group))
+
+        for i, (_, f, timings, t_sub) in enumerate(group):
+            if timings is not None:
+                timings["queue"] = t0 - t_sub
+                timings.update(bt)
+            f.set_result(probs[i])
+
+    def _run(self) -> None:
+        while True:
+            items, stop = self._collect()
+
+            models: Dict[int, Any] = {}
+            groups: Dict[Tuple, List[Tuple[Any, Future, Optional[Dict], float]]] = {}
+            for x, model, key, f, timings, t_sub in items:
+                models[id(model)] = model
+                shape = tuple(x.shape[1:]) if key is None else None
+                groups.setdefault((id(model), key, shape), []).append((x, f, timings, t_sub))
+            for (mid, key, _), g in groups.items():
+                self._run_group(models[mid], key, g)
+
+            if stop:
+                break
+
+        while True:
+            try:
+                it = self._q.get_nowait()
+            except queue.Empty:
+                break
+            if it is not None and it[3].set_running_or_notify_cancel():
+                it[3].set_exception(RuntimeError("Batcher is closed."))
+
+
+def batcher_from_env(
+    forward: Callable[..., np.ndarray],
+    prepare: Optional[Callable[[List[Any], Any, Any], torch.Tensor]] = None,
+) -> Optional[MicroBatcher]:
+    max_batch = mm._env_int("ML_BATCH_MAX", 16)
+    if max_batch <= 1:
+        return None
+    return MicroBatcher(
+        forward,
+        max_batch=max_batch,
+        max_wait_ms=mm._env_float("ML_BATCH_WAIT_MS", 5.0),
+        prepare=prepare,
+    )
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+from PIL import Image
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import src.CBISDDSM as mm
+from src.batching import MicroBatcher
+
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=256)
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--image-size", type=int, default=224)
+    ap.add_argument("--max-batch", type=int, default=16)
+    ap.add_argument("--max-wait-ms", type=float, default=5.0)
+    ap.add_argument("--warmup", type=int, default=8)
+    ap.add_argument("--end-to-end", action="store_true")
+    ap.add_argument("--random-init", type=str, default="")
+    ap.add_argument("--device", type=str, default="")
+    ap.add_argument("--out", type=str, default="")
+    return ap.parse_args()
+
+
+def _synthetic_png(rng: np.random.Generator, h: int = 1024, w: int = 800) -> bytes:
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    blob = np.exp(-(((xx - w * 0.15) / (w * 0.45)) ** 2 + ((yy - h * 0.5) / (h * 0.40)) ** 2))
+    arr = 235.0 * blob + rng.normal(0.0, 6.0, size=(h, w))
+    arr[blob < 0.15] = 0.0
+    im = Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8), mode="L")
+    buf = io.BytesIO()
+    im.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _load_model(args) -> None:
+    if not args.random_init:
+        mm.ensure_loaded(mm.CbisDdsmConfig())
+        return
+
+    os.environ["ML_NO_PRETRAIN"] = "1"
+    dev = mm.torch.device(args.device) if args.device else mm._serving_device()
+    if dev.type == "cpu":
+        mm._configure_cpu_threads()
+    m = mm._create_model(args.random_init, 2)
+    m = m.to(dev, memory_format=mm.torch.channels_last)
+    m.eval()
+    fusion = None
+    if mm._env_bool("ML_FUSE", True):
+        m, fusion, _ = mm._fuse_for_serving(m, dev, args.image_size)
+    sig = {"arch": args.random_init, "random_init": True}
+    info = {"device": str(dev), "gray_input": bool(getattr(m, "gray_input", False)), "fusion": fusion}
+    mm.install_served(mm.ServedModel(
+        model=m, dev=dev, dtype=mm.torch.float32, meta={"arch": args.random_init}, sig=sig, info=info
+    ))
+
+
+def _run(
+    n_requests: int,
+    concurrency: int,
+    one: Callable[[int], None],
+) -> Dict[str, float]:
+    lat: List[float] = []
+    lat_lock = threading.Lock()
+
+    def _task(i: int) -> None:
+        t0 = time.perf_counter()
+        one(i)
+        dt = time.perf_counter() - t0
+        with lat_lock:
+            lat.append(dt)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as ex:
+        list(ex.map(_task, range(n_requests)))
+    wall = time.perf_counter() - t0
+
+    a = np.array(lat, dtype=np.float64) * 1000.0
+    return {
+        "requests": int(n_requests),
+        "concurrency": int(concurrency),
+        "seconds": float(wall),
+        "rps": float(n_requests / max(1e-9, wall)),
+        "p50_ms": float(np.percentile(a, 50)),
+        "p95_ms": float(np.percentile(a, 95)),
+        "p99_ms": float(np.percentile(a, 99)),
+        "max_ms": float(a.max()),
+    }
+
+
+def main():
+    args = parse_args()
+    _load_model(args)
+
+    cfg = mm.CbisDdsmConfig()
+    rng = np.random.default_rng(0)
+    images = [_synthetic_png(rng) for _ in range(8)]
+
+    inputs = []
+    for b in images:
+        x, _ = mm.prepare_bytes(cfg, b, filename="bench.png", image_size=args.image_size)
+        inputs.append(x)
+
+    for i in range(max(0, args.warmup)):
+        mm.forward_probs(inputs[i % len(inputs)])
+
+    def _input(i: int):
+        if args.end_to_end:
+            x, _ = mm.prepare_bytes(cfg, images[i % len(images)], filename="bench.png", image_size=args.image_size)
+            return x
+        return inputs[i % len(inputs)]
+
+    serial_lock = threading.Lock()
+
+    def _direct(i: int) -> None:
+        with serial_lock:
+            mm.forward_probs(_input(i))
+
+    print("bench_batching: direct path (batch of one per request)...", flush=True)
+    direct = _run(args.requests, args.concurrency, _direct)
+
+    batcher = MicroBatcher(mm.forward_probs, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms)
+
+    def _batched(i: int) -> None:
+        batcher.predict(_input(i))
+
+    try:
+        print("bench_batching: micro-batched path...", flush=True)
+        batched = _run(args.requests, args.concurrency, _batched)
+        batched["batcher"] = batcher.stats()
+    finally:
+        batcher.close()
+
+    report = {
+        "device": str(mm.current_served().dev),
+        "arch": args.random_init or str(mm.current_served().meta.get("arch")),
+        "fusion": mm.current_served().info.get("fusion"),
+        "image_size": int(args.image_size),
+        "end_to_end": bool(args.end_to_end),
+        "direct": direct,
+        "batched": batched,
+        "speedup_rps": float(batched["rps"] / max(1e-9, direct["rps"])),
+    }
+
+    print(json.dumps(report, indent=2), flush=True)
+    if args.out:
+        mm._save_json(Path(args.out), report)
+
+
+if __name__ == "__main__":
+    main()
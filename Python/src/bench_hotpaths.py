@@ -0,0 +1,228 @@
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import src.CBISDDSM as mm
+from src.label_index import write_index
+
+# The committed baseline was recorded with the default arguments on the
+# machine described in its "machine" block. Timings only compare on the same
+# machine: record one where regressions are checked with
+#   python -m src.bench_hotpaths --save-baseline
+# and later runs of `python -m src.bench_hotpaths` fail on cases more than
+# --threshold slower than it.
+DEFAULT_BASELINE = PROJECT_ROOT / "evaluation_output" / "bench_hotpaths_baseline.json"
+
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", type=str, default="512,1024,2048", help="Image long sides to benchmark.")
+    ap.add_argument("--counts", type=str, default="1000,10000,100000", help="Sample counts for metrics/split/lookups.")
+    ap.add_argument("--only", type=str, default="", help="Comma-separated substrings of case names to run.")
+    ap.add_argument("--rounds", type=int, default=5)
+    ap.add_argument("--min-time", type=float, default=0.2, help="Seconds per round; the call count adapts.")
+    ap.add_argument("--image-size", type=int, default=224)
+    ap.add_argument("--baseline", type=str, default=str(DEFAULT_BASELINE))
+    ap.add_argument("--save-baseline", action="store_true", help="Record this run as the baseline instead of comparing.")
+    ap.add_argument("--threshold", type=float, default=0.25, help="Flag cases slower than baseline by this fraction.")
+    ap.add_argument("--no-fail", action="store_true", help="Report regressions without a non-zero exit code.")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", type=str, default="")
+    return ap.parse_args()
+
+
+def _mammogram_gray(rng: np.random.Generator, h: int, w: int) -> np.ndarray:
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    blob = np.exp(-(((xx - w * 0.15) / (w * 0.45)) ** 2 + ((yy - h * 0.5) / (h * 0.40)) ** 2))
+    arr = 235.0 * blob + rng.normal(0.0, 6.0, size=(h, w))
+    arr[blob < 0.15] = 0.0
+    return np.clip(arr, 0, 255).astype(np.uint8)
+
+
+def _encode(gray: np.ndarray, fmt: str) -> bytes:
+    buf = io.BytesIO()
+    Image.fromarray(gray, mode="L").save(buf, format=fmt, **({"quality": 92} if fmt == "JPEG" else {}))
+    return buf.getvalue()
+
+
+def _time_case(fn: Callable[[], object], rounds: int, min_time: float) -> Dict:
+    fn()
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        dt = time.perf_counter() - t0
+        if dt >= min_time or number >= 1 << 20:
+            break
+        number = max(number * 2, int(number * min_time / max(dt, 1e-9) * 1.1))
+
+    per_call = [dt / number]
+    for _ in range(max(0, rounds - 1)):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        per_call.append((time.perf_counter() - t0) / number)
+    a = np.array(per_call) * 1e6
+    return {"best_us": float(a.min()), "median_us": float(np.median(a)), "number": int(number), "rounds": len(per_call)}
+
+
+def _image_cases(sizes: List[int], image_size: int, rng: np.random.Generator) -> List[Tuple[str, Callable[[], object]]]:
+    cases = []
+    for side in sizes:
+        h, w = side, max(8, int(side * 0.8))
+        gray = _mammogram_gray(rng, h, w)
+        im = Image.fromarray(gray, mode="L")
+        png, jpg = _encode(gray, "PNG"), _encode(gray, "JPEG")
+        mmp, pad = mm.MMPreprocess(image_size), mm.PadToSquareResize(image_size)
+        tag = f"{h}x{w}"
+        cases += [
+            (f"decode_image_bytes_safe/png/{tag}", lambda b=png: mm.decode_image_bytes_safe(b, "x.png")),
+            (f"decode_image_bytes_safe/jpeg/{tag}", lambda b=jpg: mm.decode_image_bytes_safe(b, "x.jpg")),
+            (f"assess_quality/{tag}", lambda im=im: mm.assess_quality(im)),
+            (f"assess_domain_mammogram_like/{tag}", lambda im=im: mm.assess_domain_mammogram_like(im)),
+            (f"laplacian_var_u8/{tag}", lambda g=gray: mm._laplacian_var_u8(g)),
+            (f"MMPreprocess/{tag}", lambda g=gray: mmp.from_gray(g)),
+            (f"PadToSquareResize/{tag}", lambda g=gray: pad.from_gray(g)),
+        ]
+    return cases
+
+
+def _samples(n: int, rng: np.random.Generator) -> mm.SampleTable:
+    out = []
+    n_groups = max(2, n // 4)
+    for i in range(n):
+        g = int(rng.integers(0, n_groups))
+        y = g % 2
+        origin = "original" if i % 4 == 0 else "augmented"
+        rel = f"{origin}/{'cancer' if y else 'non-cancer'}/img_{g:06d}_{i:07d}.jpg"
+        out.append((f"/data/{rel}", y, f"img_{g:06d}", rel, origin))
+    return mm.SampleTable.from_rows(out)
+
+
+def _table_cases(counts: List[int], rng: np.random.Generator, tmp: Path) -> List[Tuple[str, Callable[[], object]]]:
+    cases = []
+    os.environ["ML_ARTIFACT_DIR"] = str(tmp)
+    cfg = mm.CbisDdsmConfig()
+    for n in counts:
+        y = rng.integers(0, 2, size=n)
+        p = np.clip(y * 0.3 + rng.random(n) * 0.7, 0.0, 1.0)
+        p_tied = np.round(p, 2)
+        samples = _samples(n, rng)
+        cases += [
+            (f"roc_auc_binary/{n}", lambda y=y, p=p: mm._roc_auc_binary(y, p)),
+            (f"roc_auc_binary/ties/{n}", lambda y=y, p=p_tied: mm._roc_auc_binary(y, p)),
+            (f"metrics/{n}", lambda y=y, p=p: mm._metrics(y, p)),
+            (f"split_groupwise/{n}", lambda s=samples: mm._split_groupwise(cfg, s)),
+        ]
+
+    # One map set sized like the largest count; lookups hit by path, by name,
+    # or miss both and fall back to hashing the bytes.
+    n = max(counts)
+    samples = _samples(n, rng)
+    ap = mm._artifact_paths(tmp)
+    write_index(ap["path_map"], {s.rel.lower(): mm.IDX_TO_LABEL[s.y] for s in samples})
+    write_index(ap["name_map"], {Path(s.path).name.lower(): mm.IDX_TO_LABEL[s.y] for s in samples})
+    blob = _encode(_mammogram_gray(rng, 1024, 800), "PNG")
+    write_index(ap["hash_map"], {mm._sha1(blob): "BENIGN"})
+    mm.ensure_maps_loaded(cfg)
+    hit = samples[n // 2]
+    cases += [
+        (f"find_ground_truth/path/{n}", lambda: mm.find_ground_truth(cfg, hit.rel)),
+        (f"find_ground_truth/name/{n}", lambda: mm.find_ground_truth(cfg, "upload/" + Path(hit.path).name)),
+        (f"find_ground_truth/hash/{n}", lambda: mm.find_ground_truth(cfg, "unknown.png", blob)),
+    ]
+    return cases
+
+
+def _machine() -> Dict:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pillow": Image.__version__,
+    }
+
+
+def _compare(results: Dict[str, Dict], baseline: Dict, threshold: float) -> Tuple[List[Dict], List[Dict]]:
+    regressions, improvements = [], []
+    for name, r in results.items():
+        b = (baseline.get("results") or {}).get(name)
+        if not b:
+            continue
+        ratio = r["best_us"] / max(1e-9, b["best_us"])
+        row = {"case": name, "baseline_us": b["best_us"], "current_us": r["best_us"], "ratio": float(ratio)}
+        if ratio > 1.0 + threshold:
+            regressions.append(row)
+        elif ratio < 1.0 / (1.0 + threshold):
+            improvements.append(row)
+    return regressions, improvements
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    counts = [int(s) for s in args.counts.split(",") if s.strip()]
+    only = [s.strip() for s in args.only.split(",") if s.strip()]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cases = _image_cases(sizes, args.image_size, rng) + _table_cases(counts, rng, Path(tmp))
+        if only:
+            cases = [c for c in cases if any(o in c[0] for o in only)]
+
+        results: Dict[str, Dict] = {}
+        for name, fn in cases:
+            results[name] = _time_case(fn, args.rounds, args.min_time)
+            print(f"{name:<48} {results[name]['best_us']:>12.1f} us", flush=True)
+
+    report = {"machine": _machine(), "config": {"image_size": args.image_size, "seed": args.seed}, "results": results}
+
+    base_path = Path(args.baseline) if args.baseline else None
+    if base_path is not None and base_path.exists() and not args.save_baseline:
+        baseline = json.loads(base_path.read_text(encoding="utf-8"))
+        regressions, improvements = _compare(results, baseline, args.threshold)
+        report["baseline"] = {
+            "path": str(base_path),
+            "same_machine": baseline.get("machine") == report["machine"],
+            "threshold": args.threshold,
+            "regressions": regressions,
+            "improvements": improvements,
+        }
+        if not report["baseline"]["same_machine"]:
+            print("bench_hotpaths: baseline was recorded on a different machine; ratios are indicative only", flush=True)
+        for r in regressions:
+            print(f"REGRESSION {r['case']}: {r['baseline_us']:.1f} -> {r['current_us']:.1f} us (x{r['ratio']:.2f})", flush=True)
+        for r in improvements:
+            print(f"improved   {r['case']}: {r['baseline_us']:.1f} -> {r['current_us']:.1f} us (x{r['ratio']:.2f})", flush=True)
+
+    if args.save_baseline and base_path is not None:
+        mm._save_json(base_path, report)
+        print(f"bench_hotpaths: baseline written to {base_path}", flush=True)
+    if args.out:
+        mm._save_json(Path(args.out), report)
+
+    if (report.get("baseline") or {}).get("regressions") and not args.no_fail:
+        raise SystemExit(f"bench_hotpaths: {len(report['baseline']['regressions'])} case(s) regressed beyond {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
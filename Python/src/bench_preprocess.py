@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import src.CBISDDSM as mm
+from src.bench_hotpaths import _machine, _mammogram_gray
+
+DEFAULT_OUT = PROJECT_ROOT / "evaluation_output" / "bench_preprocess.json"
+
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", type=str, default="512,1024,2048", help="Image long sides to benchmark.")
+    ap.add_argument("--batches", type=str, default="1,8,32", help="Tensor engine batch sizes.")
+    ap.add_argument("--images", type=int, default=32, help="Images per size; each batch size covers all of them.")
+    ap.add_argument("--modes", type=str, default="mm,pad")
+    ap.add_argument("--image-size", type=int, default=224)
+    ap.add_argument("--device", type=str, default="cpu")
+    ap.add_argument("--rounds", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", type=str, default=str(DEFAULT_OUT))
+    return ap.parse_args()
+
+
+def _per_image_ms(fn, grays: List[np.ndarray], batch: int, rounds: int) -> float:
+    fn(grays[:batch])
+    best = float("inf")
+    for _ in range(max(1, rounds)):
+        t0 = time.perf_counter()
+        for i in range(0, len(grays), batch):
+            fn(grays[i : i + batch])
+        best = min(best, time.perf_counter() - t0)
+    return 1000.0 * best / len(grays)
+
+
+def _sync(dev, x):
+    if dev.type == "cuda":
+        mm.torch.cuda.synchronize()
+    return x
+
+
+def main():
+    args = parse_args()
+    dev = mm.torch.device(args.device)
+    rng = np.random.default_rng(args.seed)
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    batches = [int(b) for b in args.batches.split(",") if b.strip()]
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+
+    results: Dict[str, Dict] = {}
+    for side in sizes:
+        grays = [_mammogram_gray(rng, side, int(side * 0.8)) for _ in range(max(1, args.images))]
+        tag = f"{side}x{int(side * 0.8)}"
+        for mode in modes:
+            pil = mm.PillowLetterbox(args.image_size, mode)
+            eng = mm.get_preprocessor(args.image_size, mode, dev)
+            same = bool(np.array_equal(pil.letterbox(grays[:4]).numpy(), eng.letterbox(grays[:4]).cpu().numpy()))
+            row = {"pillow_ms": _per_image_ms(pil.letterbox, grays, 1, args.rounds), "identical": same}
+            for b in batches:
+                row[f"tensor_b{b}_ms"] = _per_image_ms(lambda g: _sync(dev, eng.letterbox(g)), grays, b, args.rounds)
+            results[f"{mode}/{tag}"] = row
+            cols = " ".join(f"{k}={v:.2f}" for k, v in row.items() if k.endswith("_ms"))
+            print(f"{mode}/{tag:<12} {cols} identical={same}", flush=True)
+
+    report = {
+        "machine": {**_machine(), "torch": mm.torch.__version__, "torch_threads": mm.torch.get_num_threads()},
+        "config": {"device": str(dev), "image_size": args.image_size, "images": args.images, "seed": args.seed},
+        "unit": "ms per image, best of rounds",
+        "results": results,
+    }
+    if args.out:
+        mm._save_json(Path(args.out), report)
+        print(f"bench_preprocess: written to {args.out}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import src.CBISDDSM as mm
+
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dataset-kind", type=str, default=os.getenv("ML_DATASET", "mammogram_mastery"))
+    ap.add_argument("--dataset-dir", type=str, default=os.getenv("ML_DATASET_DIR", ""))
+    ap.add_argument("--artifact-dir", type=str, default=os.getenv("ML_ARTIFACT_DIR", ""))
+    ap.add_argument("--preset", type=str, default=os.getenv("CBIS_PRESET", "best"))
+    ap.add_argument("--image-size", type=int, default=0, help="Overrides the preset's image_size.")
+    ap.add_argument("--preprocess", type=str, default=os.getenv("ML_PREPROC", "auto"), choices=["auto", "mm", "pad"])
+    ap.add_argument("--max-samples", type=int, default=int(os.getenv("CBIS_MAX_SAMPLES", "0")))
+    ap.add_argument("--mm-use-augmented", type=str, default=os.getenv("MM_USE_AUGMENTED", "1"))
+    ap.add_argument(
+        "--image-cache-dir",
+        type=str,
+        default=os.getenv("ML_IMAGE_CACHE_DIR", ""),
+        help="Defaults to <artifact_dir>/image_cache.",
+    )
+    ap.add_argument("--workers", type=int, default=int(os.getenv("ML_CACHE_WORKERS", "0")))
+    ap.add_argument("--prune-stale", action="store_true", help="Delete caches built with other parameters.")
+    return ap.parse_args()
+
+
+def _b(s: str) -> bool:
+    return str(s).strip().lower() in ("1", "true", "yes", "y", "on")
+
+
+def main():
+    args = parse_args()
+    if args.dataset_dir:
+        os.environ["ML_DATASET_DIR"] = str(Path(args.dataset_dir).resolve())
+    if args.artifact_dir:
+        os.environ["ML_ARTIFACT_DIR"] = str(Path(args.artifact_dir).resolve())
+    if args.image_cache_dir:
+        os.environ["ML_IMAGE_CACHE_DIR"] = str(Path(args.image_cache_dir).resolve())
+    if args.workers > 0:
+        os.environ["ML_CACHE_WORKERS"] = str(args.workers)
+
+    cfg = mm.CbisDdsmConfig(
+        dataset_kind=args.dataset_kind,
+        preset=args.preset,
+        max_samples=int(args.max_samples),
+        mm_use_augmented=_b(args.mm_use_augmented),
+        preprocess=args.preprocess,
+        build_image_cache=True,
+    )
+    size = int(args.image_size) or int(mm._preset_params(cfg.preset)["image_size"])
+    dsd, ad = mm._resolve_dirs(cfg)
+
+    print("build_image_cache: start", flush=True)
+    print("dataset_dir:", dsd, flush=True)
+    print("artifact_dir:", ad, flush=True)
+    print("image_cache_dir:", mm._image_cache_root(cfg), flush=True)
+    print("image_size:", size, "preprocess:", mm._preproc_mode(cfg), flush=True)
+
+    t0 = time.time()
+    samples = mm.build_samples(cfg)
+    cache = mm.build_image_cache(cfg, samples, size, prune=bool(args.prune_stale))
+    print(f"build_image_cache: {len(cache)} of {len(samples)} samples cached in {time.time() - t0:.1f}s", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import src.CBISDDSM as mm
+
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--images", type=str, default="", help="Directory of images to check; synthetic if empty.")
+    ap.add_argument("--limit", type=int, default=64)
+    ap.add_argument("--image-size", type=int, default=224)
+    ap.add_argument("--modes", type=str, default="mm,pad")
+    ap.add_argument("--batch", type=int, default=16)
+    ap.add_argument("--device", type=str, default="")
+    ap.add_argument("--out", type=str, default="")
+    return ap.parse_args()
+
+
+def _synthetic_grays(n: int, seed: int = 0) -> List[np.ndarray]:
+    rng = np.random.default_rng(seed)
+    out = []
+    for _ in range(n):
+        h, w = int(rng.integers(64, 1200)), int(rng.integers(64, 1200))
+        yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+        blob = np.exp(-(((xx - w * rng.uniform(0.0, 1.0)) / (w * 0.45)) ** 2 + ((yy - h * 0.5) / (h * 0.40)) ** 2))
+        arr = 235.0 * blob + rng.normal(0.0, 6.0, size=(h, w))
+        arr[blob < rng.uniform(0.0, 0.4)] = 0.0
+        out.append(np.clip(arr, 0, 255).astype(np.uint8))
+    return out
+
+
+def _load_grays(folder: Path, limit: int, image_size: int) -> List[np.ndarray]:
+    max_side = mm._stage_max_sides(image_size)["preprocess"]
+    out = []
+    for p in sorted(folder.rglob("*")):
+        if p.suffix.lower() not in mm.SUPPORTED_IMAGE_EXTS:
+            continue
+        im, _ = mm.decode_image_bytes_reduced(p.read_bytes(), filename=p.name, max_side=max_side)
+        out.append(mm._gray_u8(mm._shrink(im, max_side)))
+        if len(out) >= limit:
+            break
+    return out
+
+
+def _check(grays: List[np.ndarray], mode: str, size: int, batch: int, dev) -> Dict:
+    ref = mm._reference_preprocessor(mode, size)
+    eng = mm.get_preprocessor(size, mode, dev)
+
+    t0 = time.perf_counter()
+    expected = [ref.from_gray(g) for g in grays]
+    t_ref = time.perf_counter() - t0
+
+    eng.letterbox(grays[:batch])
+    t0 = time.perf_counter()
+    got = []
+    for i in range(0, len(grays), batch):
+        got.extend(eng.letterbox(grays[i : i + batch]).cpu().numpy())
+    t_eng = time.perf_counter() - t0
+
+    diffs = [int(np.abs(e.astype(np.int16) - g.astype(np.int16)).max()) for e, g in zip(expected, got)]
+    x_ref = mm.normalize(mm.torch.cat([mm.to_model_input(e) for e in expected[:batch]]))
+    x_eng = eng(grays[:batch]).cpu()
+    return {
+        "images": len(grays),
+        "mismatched": int(sum(d != 0 for d in diffs)),
+        "max_abs_diff_u8": int(max(diffs) if diffs else 0),
+        "max_abs_diff_input": float((x_ref - x_eng).abs().max()),
+        "reference_ms_per_image": 1000.0 * t_ref / max(1, len(grays)),
+        "engine_ms_per_image": 1000.0 * t_eng / max(1, len(grays)),
+    }
+
+
+def main():
+    args = parse_args()
+    dev = mm.torch.device(args.device) if args.device else mm._serving_device()
+    grays = _load_grays(Path(args.images), args.limit, args.image_size) if args.images else _synthetic_grays(args.limit)
+    if not grays:
+        raise SystemExit(f"No images found in {args.images}")
+
+    report = {"device": str(dev), "image_size": int(args.image_size), "batch": int(args.batch), "modes": {}}
+    for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+        print(f"check_preprocess: mode={mode}...", flush=True)
+        report["modes"][mode] = _check(grays, mode, args.image_size, max(1, args.batch), dev)
+
+    print(json.dumps(report, indent=2), flush=True)
+    if args.out:
+        mm._save_json(Path(args.out), report)
+    if any(r["mismatched"] for r in report["modes"].values()):
+        raise SystemExit("check_preprocess: tensor engine does not match the PIL reference")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Bump when the per-file annotations stored in the manifest (label/group
+# derivation) change meaning, so old manifests are rebuilt.
+MANIFEST_VERSION = 1
+
+DirEntry = Dict[str, object]
+
+
+def _scan_dir(path: str, exts: Tuple[str, ...]) -> Tuple[List[str], List[str]]:
+    files, dirs = [], []
+    with os.scandir(path) as it:
+        for e in it:
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    dirs.append(e.name)
+                elif e.is_file() and os.path.splitext(e.name)[1].lower() in exts:
+                    files.append(e.name)
+            except OSError:
+                continue
+    return sorted(files), sorted(dirs)
+
+
+def scan_tree(
+    root: Path,
+    cached: Optional[Dict[str, DirEntry]],
+    exts: Iterable[str],
+    annotate: Optional[Callable[[str, str], object]] = None,
+    workers: int = 8,
+) -> Tuple[Dict[str, DirEntry], Dict]:
+    # One stat per directory; only directories whose mtime changed (an entry
+    # was added, removed or renamed) are listed again. annotate(rel_dir, name)
+    # results are stored next to each file and reused while the dir is
+    # unchanged.
+    cached = cached or {}
+    exts = tuple(e.lower() for e in exts)
+    root_s = str(root)
+    out: Dict[str, DirEntry] = {}
+    stats = {"dirs": 0, "rescanned": 0, "files": 0}
+    lock = threading.Lock()
+    t0 = time.perf_counter()
+
+    def _visit(rel: str) -> List[str]:
+        path = os.path.join(root_s, rel) if rel else root_s
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return []
+        entry = cached.get(rel)
+        if entry is None or entry.get("mtime_ns") != mtime:
+            try:
+                files, dirs = _scan_dir(path, exts)
+            except OSError:
+                return []
+            entry = {"mtime_ns": mtime, "dirs": dirs, "files": files}
+            if annotate is not None:
+                entry["meta"] = [annotate(rel, f) for f in files]
+            rescanned = 1
+        else:
+            rescanned = 0
+        with lock:
+            out[rel] = entry
+            stats["dirs"] += 1
+            stats["rescanned"] += rescanned
+            stats["files"] += len(entry["files"])
+        return [f"{rel}/{d}" if rel else d for d in entry["dirs"]]
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ml-scan") as ex:
+        pending = {ex.submit(_visit, "")}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                for child in fut.result():
+                    pending.add(ex.submit(_visit, child))
+
+    stats["seconds"] = round(time.perf_counter() - t0, 3)
+    return out, stats
+
+
+def iter_files(entries: Dict[str, DirEntry]):
+    for rel in sorted(entries):
+        e = entries[rel]
+        meta = e.get("meta") or [None] * len(e["files"])
+        for name, m in zip(e["files"], meta):
+            yield (f"{rel}/{name}" if rel else name), m
+
+
+def load_manifest(path: Path, key: Dict) -> Dict[str, Dict[str, DirEntry]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            obj = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(obj, dict) or obj.get("version") != MANIFEST_VERSION or obj.get("key") != key:
+        return {}
+    return obj.get("roots") or {}
+
+
+def save_manifest(path: Path, key: Dict, roots: Dict[str, Dict[str, DirEntry]]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"version": MANIFEST_VERSION, "key": key, "roots": roots}, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, path)
@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+import os
+from typing import Tuple
+
+# Environment parsing shared by every module. Kept free of torch and the
+# other heavy imports so the server, metrics and prefork code can use it
+# before the model stack is loaded. Unset, blank and unparsable values all
+# fall back to the default.
+
+
+def _env(key: str, default: str = "") -> str:
+    v = os.getenv(key, "").strip()
+    return v if v else default
+
+
+def _env_bool(key: str, default: bool = False) -> bool:
+    v = os.getenv(key, "").strip().lower()
+    if not v:
+        return default
+    return v in ("1", "true", "yes", "y", "on")
+
+
+def _env_int(key: str, default: int) -> int:
+    v = os.getenv(key, "").strip()
+    try:
+        return int(v)
+    except Exception:
+        return default
+
+
+def _env_float(key: str, default: float) -> float:
+    v = os.getenv(key, "").strip()
+    try:
+        return float(v)
+    except Exception:
+        return default
+
+
+def _env_list(key: str, default: Tuple[str, ...]) -> Tuple[str, ...]:
+    v = _env(key, "").strip()
+    if not v:
+        return default
+    parts = [x.strip().lower() for x in v.split(",") if x.strip()]
+    return tuple(parts) if parts else default
@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import multiprocessing as mp
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import Dict, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+import src.CBISDDSM as mm
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except Exception:
+    resource_tracker = None
+    shared_memory = None
+
+
+class StageTimeout(RuntimeError):
+    pass
+
+
+class ExecutorBusy(RuntimeError):
+    pass
+
+
+class PoolRecycled(RuntimeError):
+    def __init__(self, message: str, recycled: int):
+        super().__init__(message)
+        self.recycled = int(recycled)
+
+
+_IN_WORKER = False
+
+
+def _worker_init() -> None:
+    global _IN_WORKER
+    _IN_WORKER = True
+    try:
+        torch.set_num_threads(1)
+    except Exception:
+        pass
+
+
+@contextlib.contextmanager
+def _alarm_stage(name: str, seconds: float):
+    if seconds <= 0 or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def _on_alarm(signum, frame):
+        raise StageTimeout(f"Stage '{name}' exceeded {seconds:.1f}s")
+
+    prev = signal.signal(signal.SIGALRM, _on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, float(seconds))
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0.0)
+        signal.signal(signal.SIGALRM, prev)
+
+
+def _to_shm(arr: np.ndarray) -> Dict:
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(arr.nbytes)))
+    try:
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+        view[...] = arr
+        del view
+        if resource_tracker is not None:
+            try:
+                resource_tracker.unregister(shm._name, "shared_memory")
+            except Exception:
+                pass
+        return {"shm": shm.name, "shape": tuple(arr.shape), "dtype": str(arr.dtype)}
+    finally:
+        shm.close()
+
+
+def _unlink_shm(name: str) -> None:
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except Exception:
+        return
+    shm.close()
+    try:
+        shm.unlink()
+    except Exception:
+        pass
+
+
+def _discard_result(fut) -> None:
+    # Done-callback for a job whose caller went away (cancelled or timed out):
+    # nobody will call _from_shm, so drop the segment the worker left behind.
+    if fut.cancelled() or fut.exception() is not None:
+        return
+    ref, _ = fut.result()
+    if ref is not None and "shm" in ref:
+        _unlink_shm(ref["shm"])
+
+
+def _default_start_method() -> str:
+    # fork from a threaded parent with torch loaded can deadlock the child.
+    methods = mp.get_all_start_methods()
+    return "forkserver" if "forkserver" in methods else "spawn"
+
+
+def _from_shm(ref: Dict) -> np.ndarray:
+    shm = shared_memory.SharedMemory(name=ref["shm"])
+    try:
+        view = np.ndarray(tuple(ref["shape"]), dtype=np.dtype(ref["dtype"]), buffer=shm.buf)
+        arr = view.copy()
+        del view
+        return arr
+    finally:
+        shm.close()
+        try:
+            shm.unlink()
+        except Exception:
+            pass
+
+
+def _analyze_job(
+    cfg: mm.CbisDdsmConfig,
+    file_bytes: bytes,
+    filename: str,
+    image_size: int,
+    model_id: str,
+    require_quality: bool,
+    require_domain: bool,
+    stage_timeout: float,
+    use_shm: bool,
+    preprocess: bool = True,
+) -> Tuple[Optional[Dict], Dict]:
+    stage = (lambda name: _alarm_stage(name, stage_timeout)) if _IN_WORKER else None
+    arr, info = mm.analyze_bytes(
+        cfg,
+        file_bytes,
+        filename=filename,
+        image_size=image_size,
+        model_id=model_id,
+        require_quality=require_quality,
+        require_domain=require_domain,
+        stage=stage,
+        preprocess=preprocess,
+    )
+    if arr is None:
+        return None, info
+    if use_shm:
+        return _to_shm(arr), info
+    return {"array": arr}, info
+
+
+def _worker_ping() -> int:
+    return os.getpid()
+
+
+class PrepareExecutor:
+    def __init__(
+        self,
+        workers: int,
+        max_pending: int,
+        stage_timeout: float,
+        use_shm: bool,
+        start_method: str = "",
+    ):
+        self.workers = max(0, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self.stage_timeout = max(0.0, float(stage_timeout))
+        self.hard_timeout = self.stage_timeout * 4.0 + 5.0 if self.stage_timeout > 0 else None
+        self.use_shm = bool(use_shm and shared_memory is not None and self.workers > 0)
+        self.start_method = (start_method or "").strip().lower() or _default_start_method()
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._recycled = 0
+        self._timeouts = 0
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                ctx = mp.get_context(self.start_method)
+                if self.start_method == "forkserver":
+                    ctx.set_forkserver_preload(["src.execution"])
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=ctx,
+                    initializer=_worker_init,
+                )
+            return self._pool
+
+    def _recycle(self, pool: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+            self._recycled += 1
+        procs = list((getattr(pool, "_processes", None) or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for p in procs:
+            try:
+                p.kill()
+            except Exception:
+                pass
+
+    def _broken(self, pool: ProcessPoolExecutor, err: BaseException) -> PoolRecycled:
+        # Another request's timeout killed the pool under this one, or a
+        # worker died; replace the pool (once) and let the caller retry.
+        self._recycle(pool)
+        return PoolRecycled(f"Worker pool was recycled while this image was queued: {err}", self._recycled)
+
+    def _acquire(self) -> None:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise ExecutorBusy(f"Too many pending images ({self._pending}/{self.max_pending})")
+            self._pending += 1
+
+    def _release(self) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    def _finish(self, ref: Optional[Dict], info: Dict) -> Tuple[Optional[Union[torch.Tensor, np.ndarray]], Dict]:
+        if ref is None:
+            return None, info
+        arr = _from_shm(ref) if "shm" in ref else ref["array"]
+        if "preprocess" in info:
+            return arr, info
+        return mm.to_model_input(arr), info
+
+    async def analyze(
+        self,
+        cfg: mm.CbisDdsmConfig,
+        file_bytes: bytes,
+        filename: str = "",
+        image_size: int = 224,
+        model_id: str = "",
+        require_quality: bool = False,
+        require_domain: bool = False,
+        preprocess: bool = True,
+    ) -> Tuple[Optional[Union[torch.Tensor, np.ndarray]], Dict]:
+        # With preprocess=False the working grayscale comes back as a uint8
+        # array and info["preprocess"] says how to letterbox it.
+        args = (
+            cfg, file_bytes, filename, int(image_size), model_id,
+            bool(require_quality), bool(require_domain), self.stage_timeout, self.use_shm, bool(preprocess),
+        )
+
+        self._acquire()
+        try:
+            if self.workers <= 0:
+                ref, info = await asyncio.to_thread(_analyze_job, *args)
+                return self._finish(ref, info)
+
+            pool = self._get_pool()
+            try:
+                fut = pool.submit(_analyze_job, *args)
+            except BrokenProcessPool as e:
+                raise self._broken(pool, e) from e
+            try:
+                ref, info = await asyncio.wait_for(asyncio.wrap_future(fut), timeout=self.hard_timeout)
+            except (asyncio.TimeoutError, FutureTimeout):
+                fut.add_done_callback(_discard_result)
+                with self._lock:
+                    self._timeouts += 1
+                self._recycle(pool)
+                raise StageTimeout(
+                    f"Image analysis exceeded {self.hard_timeout:.1f}s; worker pool recycled ({self._recycled} so far)"
+                )
+            except BrokenProcessPool as e:
+                raise self._broken(pool, e) from e
+            except BaseException:
+                fut.add_done_callback(_discard_result)
+                raise
+            return self._finish(ref, info)
+        finally:
+            self._release()
+
+    def prestart(self, timeout: float = 60.0) -> None:
+        if self.workers <= 0:
+            return
+        pool = self._get_pool()
+        futs = [pool.submit(_worker_ping) for _ in range(self.workers)]
+        for f in futs:
+            f.result(timeout=timeout)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                "stage_timeout_s": self.stage_timeout,
+                "shared_memory": self.use_shm,
+                "start_method": self.start_method,
+                "timeouts": self._timeouts,
+                "pool_recycled": self._recycled,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def executor_from_env() -> PrepareExecutor:
+    workers = mm._env_int("ML_EXEC_WORKERS", max(1, min(4, (os.cpu_count() or 2) - 1)))
+    return PrepareExecutor(
+        workers=workers,
+        max_pending=mm._env_int("ML_EXEC_MAX_PENDING", max(8, 8 * max(1, workers))),
+        stage_timeout=mm._env_float("ML_STAGE_TIMEOUT_S", 15.0),
+        use_shm=mm._env_bool("ML_EXEC_SHM", os.name != "nt"),
+        start_method=mm._env("ML_EXEC_START_METHOD", ""),
+    )
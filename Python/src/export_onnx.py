@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import src.CBISDDSM as mm
+
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "--artifact-dir",
+        type=str,
+        default=os.getenv("ML_ARTIFACT_DIR", str(PROJECT_ROOT / "artifacts" / "mammogram_mastery_images")),
+    )
+    ap.add_argument("--opset", type=int, default=17)
+    ap.add_argument("--parity-samples", type=int, default=16)
+    ap.add_argument("--parity-tol", type=float, default=1e-4)
+    ap.add_argument("--bench-iters", type=int, default=50)
+    ap.add_argument("--bench-batch", type=int, default=1)
+    return ap.parse_args()
+
+
+def _median_ms(fn, x, iters: int) -> float:
+    for _ in range(3):
+        fn(x)
+    ts = []
+    for _ in range(max(1, iters)):
+        t0 = time.perf_counter()
+        fn(x)
+        ts.append(time.perf_counter() - t0)
+    return float(np.median(ts) * 1000.0)
+
+
+def main():
+    args = parse_args()
+    artifact_dir = Path(args.artifact_dir).resolve()
+    cfg = mm.CbisDdsmConfig(artifact_dir=artifact_dir)
+    os.environ["ML_ARTIFACT_DIR"] = str(artifact_dir)
+
+    t0 = time.time()
+    print("export_onnx: exporting...", flush=True)
+    onnx_path = mm.export_onnx(cfg, opset=args.opset)
+    print("onnx:", onnx_path, "seconds:", round(time.time() - t0, 2), flush=True)
+
+    ap = mm._artifact_paths(artifact_dir)
+    meta = mm._load_json(ap["meta"]) or {}
+    arch = str(meta.get("arch") or "efficientnet_b0")
+    size = int(meta.get("image_size") or 224)
+
+    threads = mm._configure_cpu_threads()
+    dev = mm.torch.device("cpu")
+    tm = mm._load_torch_model(arch, ap["model"], dev)
+    om = mm.OnnxModel(onnx_path, threads["intra_op_threads"], threads["inter_op_threads"])
+
+    def _torch_probs(x):
+        with mm.torch.inference_mode():
+            return mm.torch.softmax(tm(x.to(memory_format=mm.torch.channels_last)), dim=1).numpy()
+
+    def _onnx_probs(x):
+        return mm.torch.softmax(om(x), dim=1).numpy()
+
+    g = mm.torch.Generator().manual_seed(0)
+    max_diff = 0.0
+    label_flips = 0
+    for i in range(max(1, args.parity_samples)):
+        bs = 1 if i % 2 == 0 else 4
+        x = mm.torch.rand(bs, 1, size, size, generator=g).expand(-1, 3, -1, -1)
+        mean = mm.torch.tensor(mm.IMAGENET_MEAN).view(1, 3, 1, 1)
+        std = mm.torch.tensor(mm.IMAGENET_STD).view(1, 3, 1, 1)
+        x = ((x - mean) / std).contiguous()
+        pt = _torch_probs(x)
+        po = _onnx_probs(x)
+        max_diff = max(max_diff, float(np.abs(pt - po).max()))
+        label_flips += int((pt.argmax(1) != po.argmax(1)).sum())
+
+    parity_ok = bool(max_diff <= float(args.parity_tol) and label_flips == 0)
+    print(f"parity: max_abs_prob_diff={max_diff:.3e} label_flips={label_flips} ok={parity_ok}", flush=True)
+
+    xb = mm.torch.zeros(max(1, args.bench_batch), 3, size, size)
+    torch_ms = _median_ms(_torch_probs, xb, args.bench_iters)
+    onnx_ms = _median_ms(_onnx_probs, xb, args.bench_iters)
+
+    report = {
+        "arch": arch,
+        "image_size": size,
+        "opset": int(args.opset),
+        "parity_max_abs_prob_diff": max_diff,
+        "parity_label_flips": label_flips,
+        "parity_ok": parity_ok,
+        "bench_batch": int(args.bench_batch),
+        "torch_cpu_median_ms": torch_ms,
+        "onnx_cpu_median_ms": onnx_ms,
+        "speedup": float(torch_ms / max(1e-9, onnx_ms)),
+        **threads,
+    }
+    print(json.dumps(report, indent=2), flush=True)
+
+    meta = mm._load_json(ap["meta"]) or {}
+    meta["onnx_parity"] = report
+    mm._save_json(ap["meta"], meta)
+
+    if not parity_ok:
+        raise SystemExit("export_onnx: parity check FAILED")
+
+
+if __name__ == "__main__":
+    main()
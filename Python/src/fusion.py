@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+from typing import Dict, Sequence, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def fuse_conv_bn(model: nn.Module) -> int:
+    # Folds every eval-mode BatchNorm2d that directly follows a Conv2d inside a
+    # Sequential (torchvision's Conv2dNormActivation blocks) into the conv.
+    from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+    n = 0
+    for mod in list(model.modules()):
+        if not isinstance(mod, nn.Sequential):
+            continue
+        names = list(mod._modules.keys())
+        for a, b in zip(names, names[1:]):
+            conv, bn = mod._modules[a], mod._modules[b]
+            if not isinstance(conv, nn.Conv2d) or not isinstance(bn, nn.BatchNorm2d):
+                continue
+            if bn.running_mean is None or bn.running_var is None:
+                continue
+            mod._modules[a] = fuse_conv_bn_eval(conv, bn)
+            mod._modules[b] = nn.Identity()
+            n += 1
+    return n
+
+
+class GrayStem(nn.Conv2d):
+    """First convolution rewritten for raw single-channel 0..255 input.
+
+    The replicated grey channels, the /255 scaling and the per-channel
+    mean/std are folded into a one-channel kernel. The constant part of the
+    normalisation becomes a per-input-size bias map, so zero padding at the
+    borders gives the same result as padding the normalised image.
+    """
+
+    def __init__(self, conv: nn.Conv2d, mean: Sequence[float], std: Sequence[float]):
+        if conv.in_channels != len(mean) or conv.groups != 1 or conv.padding_mode != "zeros":
+            raise ValueError("Only a dense zero-padded stem conv over the normalised channels can be folded")
+        super().__init__(
+            1, conv.out_channels, conv.kernel_size,
+            stride=conv.stride, padding=conv.padding, dilation=conv.dilation, bias=True,
+            device=conv.weight.device, dtype=conv.weight.dtype,
+        )
+        with torch.no_grad():
+            w = conv.weight.detach().to(torch.float64)
+            m = torch.tensor(mean, dtype=torch.float64, device=w.device).view(1, -1, 1, 1)
+            s = torch.tensor(std, dtype=torch.float64, device=w.device).view(1, -1, 1, 1)
+            b = conv.bias.detach().to(torch.float64) if conv.bias is not None else torch.zeros(conv.out_channels, dtype=torch.float64, device=w.device)
+            self.weight.copy_((w / (255.0 * s)).sum(dim=1, keepdim=True))
+            self.bias.copy_(b)
+            self.register_buffer("offset", (w * m / s).sum(dim=1, keepdim=True).to(conv.weight.dtype))
+        self._maps: Dict[Tuple, torch.Tensor] = {}
+
+    def _bias_map(self, hw: Tuple[int, int], dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+        key = (hw, dtype, str(device))
+        bm = self._maps.get(key)
+        if bm is None:
+            ones = torch.ones((1, 1) + tuple(hw), dtype=torch.float64, device=device)
+            off = F.conv2d(ones, self.offset.to(torch.float64), None, self.stride, self.padding, self.dilation)
+            bm = (self.bias.to(torch.float64).view(1, -1, 1, 1) - off).to(dtype)
+            self._maps[key] = bm
+        return bm
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        y = F.conv2d(x, self.weight, None, self.stride, self.padding, self.dilation)
+        return y + self._bias_map(tuple(x.shape[-2:]), y.dtype, y.device)
+
+    def _apply(self, fn, *args, **kwargs):
+        self._maps = {}
+        return super()._apply(fn, *args, **kwargs)
+
+
+class GrayInputModel(nn.Module):
+    """Wraps a classifier whose stem was replaced by GrayStem.
+
+    Takes uint8 (B, 1, H, W) or (B, H, W) letterboxed grayscale and casts it
+    to the parameter dtype on the way in.
+    """
+
+    gray_input = True
+
+    def __init__(self, model: nn.Module, stem: GrayStem):
+        super().__init__()
+        self.model = model
+        self.stem = stem
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if x.dim() == 3:
+            x = x.unsqueeze(1)
+        if x.size(1) != 1:
+            raise ValueError(f"Expected single-channel grayscale input, got shape {tuple(x.shape)}")
+        return self.model(x.to(self.stem.weight.dtype))
+
+
+def _first_conv(model: nn.Module) -> Tuple[nn.Module, str, nn.Conv2d]:
+    for parent in model.modules():
+        for name, child in parent.named_children():
+            if isinstance(child, nn.Conv2d):
+                return parent, name, child
+    raise ValueError("Model has no Conv2d")
+
+
+def fold_gray_input(model: nn.Module, mean: Sequence[float], std: Sequence[float]) -> GrayInputModel:
+    parent, name, conv = _first_conv(model)
+    stem = GrayStem(conv, mean, std)
+    setattr(parent, name, stem)
+    return GrayInputModel(model, stem)
+
+
+def optimize_for_inference(model: nn.Module, mean: Sequence[float], std: Sequence[float]) -> Tuple[GrayInputModel, Dict]:
+    # In place: the module passed in is rewritten and must not be used as the
+    # original float/three-channel model afterwards.
+    model.eval()
+    fused = fuse_conv_bn(model)
+    out = fold_gray_input(model, mean, std)
+    out.eval()
+    return out, {"conv_bn_fused": int(fused), "gray_input": True}
@@ -0,0 +1,280 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.sample_table import StringColumn
+
+# Layout of one cache directory (<root>/<mode><size>-<params key>):
+#   cache.json          parameters, generation, shard sizes; replaced last
+#   index_<gen>.npy     one INDEX_DTYPE row per cached image
+#   keys_<gen>.npy      UTF-8 keys (source paths) addressed by key_start/key_end
+#   shard_<id>.npy      uint8 (n, size, size) images, never rewritten
+# Shard ids only grow, so a reader holding an older generation keeps valid
+# mappings while a build runs.
+CACHE_VERSION = 1
+INDEX_DTYPE = np.dtype([
+    ("key_start", "<i8"),
+    ("key_end", "<i8"),
+    ("shard", "<i4"),
+    ("slot", "<i4"),
+    ("size", "<i8"),
+    ("mtime_ns", "<i8"),
+])
+
+
+def params_key(params: Dict) -> str:
+    blob = json.dumps({"cache_version": CACHE_VERSION, **params}, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(blob.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def cache_dir(root: Path, params: Dict) -> Path:
+    return Path(root) / f"{params.get('mode', 'img')}{params.get('size', '')}-{params_key(params)}"
+
+
+def _shard_name(i: int) -> str:
+    return f"shard_{i:05d}.npy"
+
+
+def _read_meta(d: Path) -> Optional[Dict]:
+    try:
+        with open(d / "cache.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if isinstance(meta, dict) and meta.get("version") == CACHE_VERSION else None
+
+
+def stale_caches(root: Path, params: Dict) -> List[Path]:
+    # Cache directories under root built for other preprocessing parameters.
+    key = params_key(params)
+    try:
+        dirs = sorted(p for p in Path(root).iterdir() if p.is_dir())
+    except OSError:
+        return []
+    return [d for d in dirs if (d / "cache.json").exists() and (_read_meta(d) or {}).get("key") != key]
+
+
+class ImageCache:
+    """Preprocessed images in memory-mapped uint8 shards, looked up by source path."""
+
+    def __init__(self, path: Path, meta: Dict):
+        self.path = Path(path)
+        self.meta = meta
+        self.size = int(meta["params"]["size"])
+        self._index = np.load(self.path / meta["index"], mmap_mode="r")
+        self._keys = np.load(self.path / meta["keys"], mmap_mode="r")
+        self._shards: Dict[int, np.ndarray] = {}
+
+    @classmethod
+    def open(cls, root: Path, params: Dict) -> Optional["ImageCache"]:
+        d = cache_dir(root, params)
+        meta = _read_meta(d)
+        if meta is None or meta.get("key") != params_key(params) or meta.get("params") != params:
+            return None
+        try:
+            return cls(d, meta)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def __len__(self) -> int:
+        return int(self._index.shape[0])
+
+    def __getstate__(self) -> Dict:
+        # DataLoader workers reopen the mappings instead of pickling them.
+        return {"path": self.path, "meta": self.meta}
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__init__(state["path"], state["meta"])
+
+    def keys(self) -> List[str]:
+        return StringColumn(self._keys, self._index["key_start"], self._index["key_end"]).tolist()
+
+    def rows(self, keys: Sequence[str]) -> np.ndarray:
+        pos = {k: i for i, k in enumerate(self.keys())}
+        return np.fromiter((pos.get(k, -1) for k in keys), dtype=np.int64, count=len(keys))
+
+    def fresh(self, keys: Sequence[str], rows: np.ndarray, workers: int = 8) -> np.ndarray:
+        # True where rows[i] is cached and keys[i] still has the size and
+        # mtime it was cached with.
+        ok = np.zeros(len(keys), dtype=bool)
+        hit = np.flatnonzero(np.asarray(rows) >= 0)
+        if not hit.size:
+            return ok
+        with ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="ml-cache") as ex:
+            stats = list(ex.map(_stat, (keys[int(i)] for i in hit)))
+        now = np.array([st if st is not None else (-1, -1) for st in stats], dtype=np.int64).reshape(-1, 2)
+        e = self._index[np.asarray(rows)[hit]]
+        ok[hit] = (now[:, 0] == e["size"]) & (now[:, 1] == e["mtime_ns"])
+        return ok
+
+    def entries(self) -> np.ndarray:
+        return self._index
+
+    def image(self, row: int) -> np.ndarray:
+        e = self._index[row]
+        sid = int(e["shard"])
+        shard = self._shards.get(sid)
+        if shard is None:
+            shard = self._shards[sid] = np.load(self.path / _shard_name(sid), mmap_mode="r")
+        return shard[int(e["slot"])]
+
+    def close(self) -> None:
+        self._shards.clear()
+        self._index = self._keys = None
+
+
+def _stat(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return int(st.st_size), int(st.st_mtime_ns)
+
+
+def build_cache(
+    root: Path,
+    params: Dict,
+    paths: Sequence[str],
+    produce: Callable[[str], np.ndarray],
+    workers: int = 8,
+    shard_size: int = 1024,
+) -> Tuple[ImageCache, Dict]:
+    # produce(path) returns the uint8 (size, size) image for one file. Files
+    # whose size and mtime match the current generation are kept in place;
+    # the rest are produced on a thread pool and appended as new shards. When
+    # the kept shards hold more dead slots than live images, everything is
+    # rebuilt into fresh shards.
+    t0 = time.perf_counter()
+    d = cache_dir(root, params)
+    d.mkdir(parents=True, exist_ok=True)
+    key = params_key(params)
+    size = int(params["size"])
+    shard_size = max(1, int(shard_size))
+    workers = max(1, int(workers))
+
+    prev = ImageCache.open(root, params)
+    prev_meta = prev.meta if prev is not None else {}
+    prev_rows: Dict[str, int] = {k: i for i, k in enumerate(prev.keys())} if prev is not None else {}
+    prev_index = prev.entries() if prev is not None else np.zeros(0, dtype=INDEX_DTYPE)
+    shard_rows: Dict[int, int] = {int(k): int(v) for k, v in (prev_meta.get("shards") or {}).items()}
+
+    paths = list(dict.fromkeys(paths))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ml-cache") as ex:
+        stats = list(ex.map(_stat, paths))
+
+    keep: List[Tuple[str, int]] = []
+    todo: List[Tuple[str, Tuple[int, int]]] = []
+    for p, st in zip(paths, stats):
+        if st is None:
+            continue
+        r = prev_rows.get(p, -1)
+        if r >= 0 and (int(prev_index[r]["size"]), int(prev_index[r]["mtime_ns"])) == st:
+            keep.append((p, r))
+        else:
+            todo.append((p, st))
+
+    live = {int(prev_index[r]["shard"]) for _, r in keep}
+    dead = sum(shard_rows.get(s, 0) for s in live) - len(keep)
+    compacted = bool(keep) and dead > len(keep)
+    if compacted:
+        todo = [(p, (int(prev_index[r]["size"]), int(prev_index[r]["mtime_ns"]))) for p, r in keep] + todo
+        keep, live, dead = [], set(), 0
+
+    keys: List[str] = [p for p, _ in keep]
+    rows: List[Tuple[int, int, int, int]] = [
+        (int(prev_index[r]["shard"]), int(prev_index[r]["slot"]), int(prev_index[r]["size"]), int(prev_index[r]["mtime_ns"]))
+        for _, r in keep
+    ]
+    next_shard = max(shard_rows, default=-1) + 1
+    failed = 0
+
+    def _one(item):
+        p, st = item
+        try:
+            img = np.asarray(produce(p), dtype=np.uint8)
+        except Exception:
+            return item, None
+        return item, img if img.shape == (size, size) else None
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ml-cache") as ex:
+        for c in range(0, len(todo), shard_size):
+            done = [(item, img) for item, img in ex.map(_one, todo[c:c + shard_size])]
+            ok = [(item, img) for item, img in done if img is not None]
+            failed += len(done) - len(ok)
+            if not ok:
+                continue
+            sid = next_shard
+            next_shard += 1
+            out = np.lib.format.open_memmap(d / _shard_name(sid), mode="w+", dtype=np.uint8, shape=(len(ok), size, size))
+            for slot, ((p, st), img) in enumerate(ok):
+                out[slot] = img
+                keys.append(p)
+                rows.append((sid, slot, st[0], st[1]))
+            out.flush()
+            del out
+            shard_rows[sid] = len(ok)
+            live.add(sid)
+
+    col = StringColumn.from_strings(keys)
+    index = np.zeros(len(rows), dtype=INDEX_DTYPE)
+    index["key_start"] = col.starts
+    index["key_end"] = col.ends
+    if rows:
+        arr = np.array(rows, dtype=np.int64)
+        index["shard"], index["slot"], index["size"], index["mtime_ns"] = arr[:, 0], arr[:, 1], arr[:, 2], arr[:, 3]
+
+    gen = int(prev_meta.get("generation", 0)) + 1
+    meta = {
+        "version": CACHE_VERSION,
+        "key": key,
+        "params": params,
+        "generation": gen,
+        "index": f"index_{gen:06d}.npy",
+        "keys": f"keys_{gen:06d}.npy",
+        "count": int(len(rows)),
+        "shards": {str(s): shard_rows[s] for s in sorted(live)},
+        "built_at": time.time(),
+    }
+    np.save(d / meta["index"], index)
+    np.save(d / meta["keys"], col.blob)
+    tmp = d / "cache.json.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp, d / "cache.json")
+
+    if prev is not None:
+        prev.close()
+    referenced = {"cache.json", meta["index"], meta["keys"]} | {_shard_name(s) for s in live}
+    for p in d.iterdir():
+        if p.name not in referenced and p.suffix == ".npy":
+            try:
+                p.unlink()
+            except OSError:
+                pass
+
+    stats = {
+        "dir": str(d),
+        "key": key,
+        "count": int(len(rows)),
+        "kept": len(keep),
+        "built": int(len(rows)) - len(keep),
+        "failed": failed,
+        "compacted": compacted,
+        "shards": len(live),
+        "seconds": round(time.perf_counter() - t0, 3),
+    }
+    return ImageCache(d, meta), stats
+
+
+def remove_caches(dirs: Sequence[Path]) -> None:
+    for d in dirs:
+        shutil.rmtree(d, ignore_errors=True)
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Layout (little endian):
+#   header   magic, version, count, nslots, nlabels, labels_off, slots_off, keys_off
+#   labels   NUL separated UTF-8 label names, interned once
+#   slots    open-addressing table of (key hash, key offset, key length, label id)
+#   keys     concatenated UTF-8 keys
+MAGIC = b"MFLIDX01"
+VERSION = 1
+_HEADER = struct.Struct("<8sIIIIQQQ")
+_SLOT = struct.Struct("<QIHH")
+_EMPTY = 0xFFFF
+_MAX_LOAD = 0.5
+
+
+def _hash(kb: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(kb, digest_size=8).digest(), "little")
+
+
+def _table_size(n: int) -> int:
+    size = 8
+    while size * _MAX_LOAD < n:
+        size *= 2
+    return size
+
+
+def _replace(tmp: Path, path: Path) -> None:
+    # Windows refuses to replace a file another handle still maps; give
+    # readers a moment to drop the old index before giving up.
+    for attempt in range(10):
+        try:
+            os.replace(tmp, path)
+            return
+        except PermissionError:
+            if os.name != "nt" or attempt == 9:
+                raise
+            time.sleep(0.2)
+
+
+def write_index(path: Path, mapping: Dict[str, str]) -> int:
+    labels = sorted({str(v) for v in mapping.values()})
+    if len(labels) >= _EMPTY:
+        raise ValueError(f"too many distinct labels for a label index: {len(labels)}")
+    label_ids = {v: i for i, v in enumerate(labels)}
+
+    items = []
+    for k, v in mapping.items():
+        kb = str(k).encode("utf-8")
+        if kb and len(kb) <= 0xFFFF:
+            items.append((kb, label_ids[str(v)]))
+    items.sort()
+
+    nslots = _table_size(len(items))
+    mask = nslots - 1
+    slots = bytearray(_SLOT.pack(0, 0, 0, _EMPTY) * nslots)
+    used = bytearray(nslots)
+    keys = bytearray()
+    for kb, lab in items:
+        h = _hash(kb)
+        i = h & mask
+        while used[i]:
+            i = (i + 1) & mask
+        used[i] = 1
+        _SLOT.pack_into(slots, i * _SLOT.size, h, len(keys), len(kb), lab)
+        keys += kb
+    if len(keys) > 0xFFFFFFFF:
+        raise ValueError("label index keys exceed 4 GiB")
+
+    label_blob = b"\0".join(v.encode("utf-8") for v in labels)
+    labels_off = _HEADER.size
+    slots_off = labels_off + len(label_blob)
+    slots_off += -slots_off % 8
+    keys_off = slots_off + len(slots)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(items), nslots, len(labels), labels_off, slots_off, keys_off))
+        f.write(label_blob)
+        f.write(b"\0" * (slots_off - labels_off - len(label_blob)))
+        f.write(slots)
+        f.write(keys)
+    _replace(tmp, path)
+    return len(items)
+
+
+class LabelIndex:
+    """Read-only label index; lookups read the memory-mapped file directly."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _HEADER.size:
+                raise ValueError(f"label index too short: {self.path}")
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, nslots, nlabels, labels_off, slots_off, keys_off = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"not a label index (magic={magic!r}, version={version}): {self.path}")
+        if nslots & (nslots - 1) or keys_off != slots_off + nslots * _SLOT.size or keys_off > size:
+            raise ValueError(f"corrupt label index: {self.path}")
+        blob = bytes(self._mm[labels_off:slots_off]).rstrip(b"\0")
+        self.labels: List[str] = [s.decode("utf-8") for s in blob.split(b"\0")] if nlabels else []
+        self._count = int(count)
+        self._nslots = int(nslots)
+        self._slots_off = int(slots_off)
+        self._keys_off = int(keys_off)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        kb = key.encode("utf-8")
+        h = _hash(kb)
+        mask = self._nslots - 1
+        i = h & mask
+        mm, unpack, base, koff = self._mm, _SLOT.unpack_from, self._slots_off, self._keys_off
+        for _ in range(self._nslots):
+            sh, off, klen, lab = unpack(mm, base + i * _SLOT.size)
+            if lab == _EMPTY:
+                return default
+            if sh == h and klen == len(kb) and mm[koff + off:koff + off + klen] == kb:
+                return self.labels[lab]
+            i = (i + 1) & mask
+        return default
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        for i in range(self._nslots):
+            _, off, klen, lab = _SLOT.unpack_from(self._mm, self._slots_off + i * _SLOT.size)
+            if lab != _EMPTY:
+                o = self._keys_off + off
+                yield self._mm[o:o + klen].decode("utf-8"), self.labels[lab]
+
+    def close(self) -> None:
+        self._mm.close()
@@ -0,0 +1,380 @@
+from __future__ import annotations
+
+import argparse
+import http.client
+import io
+import json
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+# Client side only: nothing here imports torch or the model module, so the
+# harness does not compete with the server for import time or memory.
+IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".dcm"}
+
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", type=str, default="", help="Target server; spawns run_server.py locally if empty.")
+    ap.add_argument("--images", type=str, default="", help="Folder to replay; synthetic mammograms if empty.")
+    ap.add_argument("--limit", type=int, default=256)
+    ap.add_argument("--synthetic", type=int, default=64)
+    ap.add_argument("--requests", type=int, default=512)
+    ap.add_argument("--warmup", type=int, default=16)
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--rate", type=float, default=0.0, help="Open-loop arrivals per second; closed loop if 0.")
+    ap.add_argument("--arrivals", type=str, default="poisson", choices=["poisson", "constant"])
+    ap.add_argument("--image-size", type=int, default=224)
+    ap.add_argument("--require-domain", type=int, default=1)
+    ap.add_argument("--require-quality", type=int, default=0)
+    ap.add_argument("--model-id", type=str, default="")
+    ap.add_argument(
+        "--bust-cache", action="store_true",
+        help="Append random bytes after each image so the prediction cache never hits (not for DICOM).",
+    )
+    ap.add_argument("--timeout", type=float, default=60.0)
+    ap.add_argument("--ready-timeout", type=float, default=300.0)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--compare", type=str, default="", help="Previous report to print deltas against.")
+    ap.add_argument("--out", type=str, default="")
+    return ap.parse_args()
+
+
+def _synthetic_png(rng: np.random.Generator) -> bytes:
+    h, w = int(rng.integers(900, 1400)), int(rng.integers(700, 1100))
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    cx = w * (0.15 if rng.random() < 0.5 else 0.85)
+    blob = np.exp(-(((xx - cx) / (w * 0.45)) ** 2 + ((yy - h * 0.5) / (h * 0.40)) ** 2))
+    arr = 235.0 * blob + rng.normal(0.0, 6.0, size=(h, w))
+    arr[blob < 0.15] = 0.0
+    buf = io.BytesIO()
+    Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8), mode="L").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _load_images(args) -> List[Tuple[str, bytes]]:
+    if not args.images:
+        rng = np.random.default_rng(args.seed)
+        return [(f"synthetic_{i:04d}.png", _synthetic_png(rng)) for i in range(max(1, args.synthetic))]
+    out = []
+    for p in sorted(Path(args.images).rglob("*")):
+        if p.suffix.lower() in IMAGE_EXTS:
+            out.append((p.name, p.read_bytes()))
+            if len(out) >= args.limit:
+                break
+    if not out:
+        raise SystemExit(f"No images found in {args.images}")
+    return out
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return int(s.getsockname()[1])
+
+
+def _get_json(url: str, path: str, timeout: float) -> Tuple[int, Dict]:
+    u = urllib.parse.urlsplit(url)
+    conn = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=timeout)
+    try:
+        conn.request("GET", path)
+        r = conn.getresponse()
+        body = r.read()
+        try:
+            return r.status, json.loads(body)
+        except Exception:
+            return r.status, {}
+    finally:
+        conn.close()
+
+
+def _spawn_server(ready_timeout: float) -> Tuple[subprocess.Popen, str]:
+    port = _free_port()
+    env = {**os.environ, "ML_HOST": "127.0.0.1", "ML_PORT": str(port), "ML_LOG_LEVEL": os.getenv("ML_LOG_LEVEL", "warning")}
+    proc = subprocess.Popen(
+        [sys.executable, str(PROJECT_ROOT / "src" / "run_server.py")],
+        cwd=str(PROJECT_ROOT), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.perf_counter() + ready_timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"run_server.py exited with code {proc.returncode}")
+        try:
+            if _get_json(url, "/api/health/ready", 2.0)[0] == 200:
+                return proc, url
+        except OSError:
+            pass
+        time.sleep(0.25)
+    proc.terminate()
+    raise SystemExit(f"Server not ready after {ready_timeout:.0f}s")
+
+
+def _multipart(fields: Dict[str, str], filename: str, data: bytes) -> Tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    parts = []
+    for k, v in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode())
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n".encode()
+    )
+    parts.append(data)
+    parts.append(f"\r\n--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def _parse_server_timing(h: Optional[str]) -> Dict[str, float]:
+    out = {}
+    for part in (h or "").split(","):
+        name, _, rest = part.strip().partition(";")
+        for p in rest.split(";"):
+            k, _, v = p.strip().partition("=")
+            if k == "dur" and name:
+                try:
+                    out[name] = float(v)
+                except ValueError:
+                    pass
+    return out
+
+
+class _Client:
+    def __init__(self, url: str, timeout: float):
+        u = urllib.parse.urlsplit(url)
+        self.host, self.port, self.timeout = u.hostname, u.port or 80, timeout
+        self.conn: Optional[http.client.HTTPConnection] = None
+
+    def post(self, body: bytes, ctype: str) -> Tuple[int, bytes, Optional[str]]:
+        for attempt in (0, 1):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request("POST", "/api/imaging/predict", body=body, headers={"Content-Type": ctype})
+                r = self.conn.getresponse()
+                return r.status, r.read(), r.getheader("Server-Timing")
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # A keep-alive connection the server already closed; retry once on a fresh one.
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        raise RuntimeError("unreachable")
+
+
+def _one(client: _Client, req: Tuple[bytes, str]) -> Dict:
+    try:
+        status, body, st = client.post(*req)
+    except Exception as e:
+        if client.conn is not None:
+            client.conn.close()
+            client.conn = None
+        return {"status": 0, "label": None, "error": f"{type(e).__name__}: {e}", "server": {}}
+    label = None
+    try:
+        label = json.loads(body).get("label")
+    except Exception:
+        pass
+    return {"status": int(status), "label": label, "error": None, "server": _parse_server_timing(st)}
+
+
+def _schedule(n: int, rate: float, arrivals: str, rng: np.random.Generator) -> np.ndarray:
+    if rate <= 0:
+        return np.zeros(n)
+    gaps = rng.exponential(1.0 / rate, size=n) if arrivals == "poisson" else np.full(n, 1.0 / rate)
+    return np.concatenate([[0.0], np.cumsum(gaps[:-1])])
+
+
+def _run(url: str, reqs: List[Tuple[bytes, str]], n: int, args, rng: np.random.Generator) -> Tuple[List[Dict], float]:
+    # Closed loop: `concurrency` clients send back to back. Open loop: requests
+    # are released on an arrival schedule and latency is measured from the
+    # scheduled time, so queueing behind a slow server is not hidden.
+    sched = _schedule(n, args.rate, args.arrivals, rng)
+    order = rng.integers(0, len(reqs), size=n)
+    results: List[Optional[Dict]] = [None] * n
+    work: "queue.Queue[Optional[int]]" = queue.Queue()
+    t_start = time.perf_counter() + 0.05
+
+    def _worker():
+        client = _Client(url, args.timeout)
+        while True:
+            i = work.get()
+            if i is None:
+                break
+            t_sched = t_start + sched[i]
+            wait = t_sched - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            body, ctype = reqs[order[i]]
+            if args.bust_cache:
+                # Bytes after the end of the image data are ignored by PNG/JPEG
+                # decoders but change the content hash.
+                tail = body.rindex(b"\r\n--")
+                body = body[:tail] + os.urandom(16) + body[tail:]
+            t0 = time.perf_counter()
+            r = _one(client, (body, ctype))
+            t1 = time.perf_counter()
+            r["latency_ms"] = (t1 - (t_sched if args.rate > 0 else t0)) * 1000.0
+            r["service_ms"] = (t1 - t0) * 1000.0
+            results[i] = r
+        if client.conn is not None:
+            client.conn.close()
+
+    threads = [threading.Thread(target=_worker, daemon=True) for _ in range(max(1, args.concurrency))]
+    for t in threads:
+        t.start()
+    for i in range(n):
+        work.put(i)
+    for _ in threads:
+        work.put(None)
+    for t in threads:
+        t.join()
+    return [r for r in results if r is not None], time.perf_counter() - t_start
+
+
+def _pct(a: np.ndarray) -> Dict[str, float]:
+    if a.size == 0:
+        return {}
+    return {
+        "p50_ms": float(np.percentile(a, 50)),
+        "p95_ms": float(np.percentile(a, 95)),
+        "p99_ms": float(np.percentile(a, 99)),
+        "max_ms": float(a.max()),
+        "mean_ms": float(a.mean()),
+    }
+
+
+def _summarize(results: List[Dict], wall: float) -> Dict:
+    n = len(results)
+    status: Dict[str, int] = {}
+    labels: Dict[str, int] = {}
+    for r in results:
+        status[str(r["status"])] = status.get(str(r["status"]), 0) + 1
+        if r["label"]:
+            labels[r["label"]] = labels.get(r["label"], 0) + 1
+    errors = sum(1 for r in results if r["status"] != 200 and r["status"] != 422)
+    ok = [r for r in results if r["status"] in (200, 422)]
+    stages: Dict[str, List[float]] = {}
+    for r in ok:
+        for k, v in r["server"].items():
+            stages.setdefault(k, []).append(v)
+    first_errors = sorted({r["error"] for r in results if r["error"]})[:5]
+    # Every cache miss decodes, so a response without a decode stage was a hit.
+    hits = sum(1 for r in ok if r["server"] and "decode" not in r["server"])
+    return {
+        "requests": n,
+        "seconds": float(wall),
+        "throughput_rps": float(n / max(1e-9, wall)),
+        "ok_rps": float(len(ok) / max(1e-9, wall)),
+        "latency": _pct(np.array([r["latency_ms"] for r in ok], dtype=np.float64)),
+        "service": _pct(np.array([r["service_ms"] for r in ok], dtype=np.float64)),
+        "error_rate": float(errors / max(1, n)),
+        "out_of_domain_rate": float(labels.get("OUT_OF_DOMAIN", 0) / max(1, n)),
+        "unusable_rate": float(labels.get("UNUSABLE_IMAGE", 0) / max(1, n)),
+        "cache_hit_rate": float(hits / max(1, len(ok))),
+        "status": dict(sorted(status.items())),
+        "labels": dict(sorted(labels.items())),
+        "server_stages_p50_ms": {k: float(np.median(v)) for k, v in sorted(stages.items())},
+        "errors_sample": first_errors,
+    }
+
+
+def _git_rev() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=str(PROJECT_ROOT), capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def _compare(report: Dict, path: Path) -> Dict:
+    base = json.loads(path.read_text(encoding="utf-8"))
+    cur, old = report["result"], base.get("result") or {}
+    out = {"baseline": str(path), "baseline_commit": base.get("commit")}
+    for k in ("throughput_rps", "error_rate", "out_of_domain_rate"):
+        if k in old:
+            out[k] = {"before": old[k], "after": cur[k]}
+    for k in ("p50_ms", "p95_ms", "p99_ms"):
+        a, b = (old.get("latency") or {}).get(k), cur["latency"].get(k)
+        if a is not None and b is not None:
+            out[k] = {"before": a, "after": b, "ratio": float(b / max(1e-9, a))}
+    return out
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    images = _load_images(args)
+    fields = {
+        "model_id": args.model_id,
+        "image_size": str(int(args.image_size)),
+        "require_quality": str(int(args.require_quality)),
+        "require_domain": str(int(args.require_domain)),
+    }
+    reqs = [_multipart(fields, name, b) for name, b in images]
+
+    proc = None
+    url = args.url.rstrip("/")
+    if not url:
+        print("load_test: starting run_server.py...", flush=True)
+        proc, url = _spawn_server(args.ready_timeout)
+    try:
+        _, status = _get_json(url, "/api/status", args.timeout)
+        if args.warmup > 0:
+            print(f"load_test: warmup ({args.warmup} requests)...", flush=True)
+            _run(url, reqs, args.warmup, argparse.Namespace(**{**vars(args), "rate": 0.0}), rng)
+        mode = f"open loop {args.rate:g}/s {args.arrivals}" if args.rate > 0 else "closed loop"
+        print(f"load_test: {args.requests} requests, concurrency={args.concurrency}, {mode}...", flush=True)
+        results, wall = _run(url, reqs, args.requests, args, rng)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    report = {
+        "commit": _git_rev(),
+        "target": "spawned" if proc is not None else url,
+        "images": {"source": args.images or "synthetic", "count": len(images)},
+        "load": {
+            "requests": int(args.requests),
+            "concurrency": int(args.concurrency),
+            "rate": float(args.rate),
+            "arrivals": args.arrivals if args.rate > 0 else "closed",
+            "image_size": int(args.image_size),
+            "require_domain": bool(args.require_domain),
+            "require_quality": bool(args.require_quality),
+            "bust_cache": bool(args.bust_cache),
+        },
+        "server": {
+            "serving": status.get("serving"),
+            "batching": status.get("batching"),
+            "executor": status.get("executor"),
+        },
+        "result": _summarize(results, wall),
+    }
+    if args.compare:
+        report["compare"] = _compare(report, Path(args.compare))
+
+    print(json.dumps(report, indent=2), flush=True)
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+# Mammogram Mastery names its augmented copies "<source>_<augmenter>".
+AUGMENTERS = (
+    "fliplr", "rotate", "gaussianblur", "additivegaussiannoise",
+    "linearcontrast", "multiply", "crop", "resize",
+)
+# Suffixes stripped by _mm_group_key's _re_aug, one style per copy.
+SUFFIX_STYLES = ("_aug{k}", "_rot{k}", " ({k})", "copy{k}", "_flip{k}", "-noise{k}", "_zoom{k}", "_shift{k}")
+
+DIGITAL_MAMMOGRAPHY_SOP = "1.2.840.10008.5.1.4.1.1.1.2"
+
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--out", type=str, required=True)
+    ap.add_argument("--layout", type=str, default="mastery", choices=["mastery", "folder"])
+    ap.add_argument("--naming", type=str, default="mastery", choices=["mastery", "suffix"])
+    ap.add_argument("--originals", type=int, default=64, help="Source images across both classes.")
+    ap.add_argument("--cancer-frac", type=float, default=0.5)
+    ap.add_argument("--augment", type=int, default=4, help="Augmented copies per source image.")
+    ap.add_argument("--size", type=str, default="1024x819", help="HxW of the source images.")
+    ap.add_argument("--size-jitter", type=float, default=0.15)
+    ap.add_argument("--formats", type=str, default="jpg", help="Comma-separated: jpg,png,dcm; assigned round-robin.")
+    ap.add_argument("--jpeg-quality", type=int, default=90)
+    ap.add_argument("--workers", type=int, default=max(1, min(8, (os.cpu_count() or 2) - 1)))
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--verify", action="store_true", help="Scan the tree with build_samples and run the domain/quality checks.")
+    ap.add_argument("--verify-limit", type=int, default=64)
+    return ap.parse_args()
+
+
+def _smooth_noise(rng: np.random.Generator, h: int, w: int, cells: int) -> np.ndarray:
+    gh, gw = max(2, cells), max(2, int(round(cells * w / max(1, h))))
+    g = rng.standard_normal((gh, gw)).astype(np.float32)
+    im = Image.fromarray(g, mode="F").resize((w, h), Image.BICUBIC)
+    a = np.asarray(im, dtype=np.float32)
+    return a / max(1e-6, float(a.std()))
+
+
+def synthetic_mammogram(
+    rng: np.random.Generator,
+    h: int,
+    w: int,
+    malignant: bool,
+    side: str = "L",
+    view: str = "MLO",
+) -> np.ndarray:
+    # Breast against the chest wall on the left edge, black background, fatty
+    # and fibroglandular texture, a pectoral wedge on MLO views, and a lesion
+    # whose shape depends on the label: spiculated mass with a calcification
+    # cluster when malignant, a smooth oval (or nothing) when benign.
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    y, x = yy / h, xx / w
+
+    cy = 0.5 + rng.uniform(-0.05, 0.05)
+    reach = rng.uniform(0.55, 0.78) * (1.0 + 0.04 * _smooth_noise(rng, h, 1, 6))
+    half = rng.uniform(0.40, 0.47)
+    boundary = reach * np.sqrt(np.clip(1.0 - ((y - cy) / half) ** 2, 0.0, 1.0))
+    depth = np.clip((boundary - x) / np.maximum(boundary, 1e-3), 0.0, 1.0)
+    inside = x < boundary
+
+    density = rng.uniform(0.25, 0.75)
+    tissue = 0.45 + 0.10 * _smooth_noise(rng, h, w, 5) + 0.06 * _smooth_noise(rng, h, w, 24)
+    gland = np.clip(_smooth_noise(rng, h, w, 12) * 0.5 + density - 0.3, 0.0, 1.0) * np.clip(depth * 2.0, 0.0, 1.0)
+    img = (tissue + 0.30 * gland) * (1.0 - np.exp(-depth / 0.06))
+    img += 0.10 * np.exp(-((boundary - x) * w / 3.0) ** 2) * inside
+
+    if view == "MLO":
+        pw, ph = rng.uniform(0.18, 0.30), rng.uniform(0.35, 0.55)
+        pect = (x / pw + y / ph) < 1.0
+        img = np.where(pect & inside, np.maximum(img, 0.82 + 0.04 * _smooth_noise(rng, h, w, 8)), img)
+
+    r = min(h, w) * rng.uniform(0.025, 0.05)
+    my = h * rng.uniform(cy - half * 0.5, cy + half * 0.5)
+    mx = w * rng.uniform(0.15, 0.8) * float(np.interp(my / h, y[:, 0], boundary[:, 0]))
+    d = np.hypot(yy - my, xx - mx)
+    if malignant:
+        ang = np.arctan2(yy - my, xx - mx)
+        spikes = rng.integers(8, 16)
+        phase = rng.uniform(0, 2 * np.pi)
+        spread = r * (1.0 + 1.2 * np.abs(np.sin(spikes * ang / 2.0 + phase)) ** 8)
+        img += 0.35 * np.clip(1.0 - d / spread, 0.0, 1.0) ** 0.7
+        for _ in range(int(rng.integers(6, 20))):
+            cy2, cx2 = my + rng.normal(0, r * 1.2), mx + rng.normal(0, r * 1.2)
+            img += 0.45 * np.exp(-((yy - cy2) ** 2 + (xx - cx2) ** 2) / (2.0 * max(1.0, r * 0.05) ** 2))
+    elif rng.random() < 0.6:
+        e = np.hypot((yy - my) / (r * 1.3), (xx - mx) / r)
+        img += 0.22 * np.clip(1.0 - e, 0.0, 1.0) ** 0.35
+
+    img = img * inside + rng.normal(0.0, 0.02, size=(h, w)) * inside
+    img = np.clip(img, 0.0, 1.0) * 235.0
+    img += np.abs(rng.normal(0.0, 1.0, size=(h, w)))
+
+    # Laterality marker, as on most screening exports.
+    my0, mx0 = int(h * 0.04), int(w * 0.90)
+    img[my0 : my0 + max(2, h // 40), mx0 : mx0 + max(2, w // 40)] = 250.0
+
+    out = np.clip(img, 0, 255).astype(np.uint8)
+    return out[:, ::-1].copy() if side == "R" else out
+
+
+def augment(gray: np.ndarray, name: str, rng: np.random.Generator) -> np.ndarray:
+    im = Image.fromarray(gray, mode="L")
+    if name == "fliplr":
+        im = im.transpose(Image.FLIP_LEFT_RIGHT)
+    elif name == "rotate":
+        im = im.rotate(float(rng.uniform(-15, 15)), resample=Image.BILINEAR, fillcolor=0)
+    elif name == "gaussianblur":
+        im = im.filter(ImageFilter.GaussianBlur(radius=float(rng.uniform(0.8, 2.0))))
+    elif name == "additivegaussiannoise":
+        a = np.asarray(im, dtype=np.float32) + rng.normal(0.0, rng.uniform(3.0, 8.0), size=gray.shape)
+        return np.clip(a, 0, 255).astype(np.uint8)
+    elif name == "linearcontrast":
+        a = (np.asarray(im, dtype=np.float32) - 128.0) * rng.uniform(0.8, 1.15) + 128.0
+        return np.where(gray > 0, np.clip(a, 0, 255), 0).astype(np.uint8)
+    elif name == "multiply":
+        return np.clip(np.asarray(im, dtype=np.float32) * rng.uniform(0.8, 1.2), 0, 255).astype(np.uint8)
+    elif name == "crop":
+        h, w = gray.shape
+        dy, dx = int(h * rng.uniform(0.02, 0.1)), int(w * rng.uniform(0.02, 0.1))
+        im = im.crop((0, dy, w - dx, h - dy)).resize((w, h), Image.BILINEAR)
+    elif name == "resize":
+        f = float(rng.uniform(0.6, 0.9))
+        im = im.resize((max(8, int(gray.shape[1] * f)), max(8, int(gray.shape[0] * f))), Image.BILINEAR)
+    else:
+        raise ValueError(f"Unknown augmenter: {name}")
+    return np.asarray(im, dtype=np.uint8)
+
+
+def _write_dicom(path: Path, gray: np.ndarray, patient: str, laterality: str, view: str) -> None:
+    try:
+        from pydicom.dataset import FileDataset, FileMetaDataset
+        from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+    except Exception as e:
+        raise RuntimeError(f"pydicom missing for DICOM writing: {e!r}")
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = DIGITAL_MAMMOGRAPHY_SOP
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = FileDataset(str(path), {}, file_meta=meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.Modality = "MG"
+    ds.PatientID = patient
+    ds.ImageLaterality = laterality
+    ds.ViewPosition = view
+    ds.Rows, ds.Columns = int(gray.shape[0]), int(gray.shape[1])
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    g = gray.astype(np.uint16)
+    ds.PixelData = ((g << 4) | (g >> 4)).tobytes()
+    try:
+        ds.save_as(str(path), enforce_file_format=True)
+    except TypeError:
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.save_as(str(path), write_like_original=False)
+
+
+def _save(path: Path, gray: np.ndarray, fmt: str, jpeg_quality: int, patient: str, laterality: str, view: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if fmt == "dcm":
+        _write_dicom(path, gray, patient, laterality, view)
+        return
+    buf = io.BytesIO()
+    if fmt == "jpg":
+        Image.fromarray(gray, mode="L").save(buf, format="JPEG", quality=int(jpeg_quality))
+    else:
+        Image.fromarray(gray, mode="L").save(buf, format="PNG")
+    path.write_bytes(buf.getvalue())
+
+
+def _class_dirs(layout: str, y: int) -> str:
+    if layout == "mastery":
+        return "Cancer" if y else "Non-Cancer"
+    return "malignant" if y else "benign"
+
+
+def _names(naming: str, idx: int, n_aug: int) -> Tuple[str, List[Tuple[str, str]]]:
+    # Returns the source stem and (augmenter, stem) for each copy.
+    if naming == "mastery":
+        stem = f"IMG ({idx})"
+        augs = [AUGMENTERS[(idx + k) % len(AUGMENTERS)] for k in range(n_aug)]
+        return stem, [(a, f"{stem}_{a}") for a in augs]
+    stem = f"P{idx:05d}"
+    out = []
+    for k in range(n_aug):
+        style = SUFFIX_STYLES[(idx + k) % len(SUFFIX_STYLES)]
+        out.append((AUGMENTERS[(idx + k) % len(AUGMENTERS)], stem + style.format(k=k + 1)))
+    return stem, out
+
+
+def _make_source(job: Dict) -> List[Dict]:
+    rng = np.random.default_rng(job["seed"])
+    h, w = job["h"], job["w"]
+    gray = synthetic_mammogram(rng, h, w, malignant=bool(job["y"]), side=job["side"], view=job["view"])
+    out_dir, fmt, layout = Path(job["out"]), job["fmt"], job["layout"]
+    cls = _class_dirs(layout, job["y"])
+    patient = job["stem"]
+
+    if layout == "mastery":
+        orig_dirs = [("original", Path("Original Dataset") / cls)]
+        if job["augs"]:
+            orig_dirs.append(("augmented", Path("Augmented Dataset") / cls))
+        aug_dir = Path("Augmented Dataset") / cls
+    else:
+        orig_dirs = [("original", Path(cls))]
+        aug_dir = Path(cls)
+
+    rows = []
+    for origin, d in orig_dirs:
+        rel = (d / f"{job['stem']}.{fmt}").as_posix()
+        _save(out_dir / rel, gray, fmt, job["jpeg_quality"], patient, job["side"], job["view"])
+        rows.append({"rel": rel, "y": job["y"], "source": job["stem"], "origin": origin, "augmenter": None})
+    for aug, stem in job["augs"]:
+        rel = (aug_dir / f"{stem}.{fmt}").as_posix()
+        _save(out_dir / rel, augment(gray, aug, rng), fmt, job["jpeg_quality"], patient, job["side"], job["view"])
+        rows.append({"rel": rel, "y": job["y"], "source": job["stem"], "origin": "augmented", "augmenter": aug})
+    return rows
+
+
+def generate(
+    out: Path,
+    layout: str = "mastery",
+    naming: str = "mastery",
+    originals: int = 64,
+    cancer_frac: float = 0.5,
+    n_augment: int = 4,
+    size: Tuple[int, int] = (1024, 819),
+    size_jitter: float = 0.15,
+    formats: Tuple[str, ...] = ("jpg",),
+    jpeg_quality: int = 90,
+    workers: int = 1,
+    seed: int = 0,
+) -> Dict:
+    out = Path(out)
+    out.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_cancer = int(round(originals * cancer_frac))
+
+    jobs = []
+    for i in range(int(originals)):
+        stem, augs = _names(naming, i + 1, int(n_augment))
+        jh = 1.0 + rng.uniform(-size_jitter, size_jitter)
+        jw = 1.0 + rng.uniform(-size_jitter, size_jitter)
+        jobs.append({
+            "out": str(out), "layout": layout, "stem": stem, "augs": augs,
+            "y": 1 if i < n_cancer else 0,
+            "h": max(64, int(size[0] * jh)), "w": max(64, int(size[1] * jw)),
+            "side": "L" if rng.random() < 0.5 else "R",
+            "view": "MLO" if rng.random() < 0.6 else "CC",
+            "fmt": formats[i % len(formats)],
+            "jpeg_quality": int(jpeg_quality),
+            "seed": int(rng.integers(0, 2**63 - 1)),
+        })
+
+    t0 = time.perf_counter()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=int(workers)) as ex:
+            rows = [r for rs in ex.map(_make_source, jobs, chunksize=4) for r in rs]
+    else:
+        rows = [r for j in jobs for r in _make_source(j)]
+
+    manifest = {
+        "layout": layout,
+        "naming": naming,
+        "dataset_kind": "mammogram_mastery" if layout == "mastery" else "folder_binary",
+        "originals": int(originals),
+        "augment": int(n_augment),
+        "formats": list(formats),
+        "seed": int(seed),
+        "files": rows,
+        "seconds": round(time.perf_counter() - t0, 3),
+    }
+    (out / "synthetic_manifest.json").write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    return manifest
+
+
+def verify(out: Path, manifest: Dict, limit: int = 64) -> Dict:
+    # Imported here so generating data does not need torch.
+    import src.CBISDDSM as mm
+
+    os.environ["ML_DATASET_DIR"] = str(Path(out).resolve())
+    cfg = mm.CbisDdsmConfig(dataset_kind=manifest["dataset_kind"], mm_use_cache=False)
+    # Scanning writes a dataset manifest and label indexes under the artifact
+    # dir; keep them out of the real one.
+    prev_ad = os.environ.get("ML_ARTIFACT_DIR")
+    with tempfile.TemporaryDirectory(prefix="mm-verify-") as ad:
+        os.environ["ML_ARTIFACT_DIR"] = ad
+        try:
+            samples = mm.build_samples(cfg)
+        finally:
+            if prev_ad is None:
+                os.environ.pop("ML_ARTIFACT_DIR", None)
+            else:
+                os.environ["ML_ARTIFACT_DIR"] = prev_ad
+
+    by_rel = {r["rel"].lower(): r for r in manifest["files"]}
+    mislabeled = [s.rel for s in samples if by_rel.get(s.rel.lower(), {}).get("y", s.y) != s.y]
+
+    groups_of: Dict[str, set] = {}
+    sources_of: Dict[str, set] = {}
+    for s in samples:
+        src = by_rel.get(s.rel.lower(), {}).get("source")
+        if src is None:
+            continue
+        groups_of.setdefault(src, set()).add(s.group_id)
+        sources_of.setdefault(s.group_id, set()).add(src)
+
+    sides = mm._stage_max_sides(224)
+    checked, dom_ok, q_ok = 0, 0, 0
+    rng = np.random.default_rng(0)
+    pick = rng.permutation(len(samples))[: max(0, int(limit))]
+    for i in pick:
+        s = samples[int(i)]
+        b = Path(s.path).read_bytes()
+        im, dec = mm.decode_image_bytes_reduced(b, filename=s.path, max_side=mm._decode_max_side(sides))
+        a = mm.analyze_image(mm._shrink(im, sides["analysis"]), src_size=(dec["src_w"], dec["src_h"]))
+        checked += 1
+        dom_ok += int(bool(a["dom"]["domain_ok"]))
+        q_ok += int(bool(a["q"]["quality_ok"]))
+
+    return {
+        "samples_found": len(samples),
+        "files_written": len(manifest["files"]),
+        "mislabeled": len(mislabeled),
+        "mislabeled_examples": mislabeled[:5],
+        "sources": len(groups_of),
+        "groups": len(sources_of),
+        "sources_split_across_groups": sum(1 for g in groups_of.values() if len(g) > 1),
+        "groups_merging_sources": sum(1 for v in sources_of.values() if len(v) > 1),
+        "domain_ok_rate": dom_ok / max(1, checked),
+        "quality_ok_rate": q_ok / max(1, checked),
+        "checked": checked,
+    }
+
+
+def main():
+    args = parse_args()
+    h, w = (int(v) for v in args.size.lower().split("x"))
+    formats = tuple(f.strip().lower().lstrip(".").replace("jpeg", "jpg") for f in args.formats.split(",") if f.strip())
+    for f in formats:
+        if f not in ("jpg", "png", "dcm"):
+            raise SystemExit(f"Unsupported format: {f}")
+
+    out = Path(args.out)
+    print(f"make_synthetic_dataset: writing {args.originals} sources x {1 + args.augment} files to {out}...", flush=True)
+    manifest = generate(
+        out,
+        layout=args.layout,
+        naming=args.naming,
+        originals=args.originals,
+        cancer_frac=args.cancer_frac,
+        n_augment=args.augment,
+        size=(h, w),
+        size_jitter=args.size_jitter,
+        formats=formats,
+        jpeg_quality=args.jpeg_quality,
+        workers=args.workers,
+        seed=args.seed,
+    )
+    print(f"make_synthetic_dataset: {len(manifest['files'])} files in {manifest['seconds']:.1f}s", flush=True)
+    print(f"dataset_kind={manifest['dataset_kind']} (pass as --dataset-dir {out} --dataset-kind {manifest['dataset_kind']})", flush=True)
+
+    if args.verify:
+        print(json.dumps(verify(out, manifest, args.verify_limit), indent=2), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import bisect
+import math
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from src.env import _env_bool
+
+ENABLED = _env_bool("ML_METRICS", True)
+
+_STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _fmt(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _child(self, labels: Dict[str, str]):
+        key = self._key(labels)
+        c = self._children.get(key)
+        if c is None:
+            with self._lock:
+                c = self._children.get(key)
+                if c is None:
+                    c = self._children[key] = self._new_child()
+        return c
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+
+class _Value:
+    __slots__ = ("lock", "value")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        if not ENABLED:
+            return
+        c = self._child(labels)
+        with c.lock:
+            c.value += amount
+
+    def _samples(self):
+        for key, c in sorted(self._children.items()):
+            yield f"{self.name}{_labels(self.labelnames, key)} {_fmt(c.value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        if not ENABLED:
+            return
+        c = self._child(labels)
+        with c.lock:
+            c.value = float(value)
+
+
+class _Buckets:
+    __slots__ = ("lock", "counts", "sum", "count")
+
+    def __init__(self, n: int):
+        self.lock = threading.Lock()
+        self.counts = [0] * n
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = _STAGE_BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+
+    def _new_child(self):
+        return _Buckets(len(self.buckets) + 1)
+
+    def observe(self, value: float, **labels) -> None:
+        if not ENABLED:
+            return
+        i = bisect.bisect_left(self.buckets, value)
+        c = self._child(labels)
+        with c.lock:
+            c.counts[i] += 1
+            c.sum += value
+            c.count += 1
+
+    def _samples(self):
+        for key, c in sorted(self._children.items()):
+            with c.lock:
+                counts, total, n = list(c.counts), c.sum, c.count
+            acc = 0
+            for le, k in zip(self.buckets + (math.inf,), counts):
+                acc += k
+                lbl = _labels(self.labelnames, key, 'le="%s"' % _fmt(le))
+                yield f"{self.name}_bucket{lbl} {acc}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {_fmt(total)}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {n}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, m: _Metric) -> _Metric:
+        self._metrics.append(m)
+        return m
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+PREDICTIONS = REGISTRY.register(Counter(
+    "ml_predictions_total", "Predictions by outcome (label, rejection or error).", ["outcome"]))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "ml_request_seconds", "End-to-end latency of one predicted image.", ["endpoint"]))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "ml_stage_seconds", "Wall time of each prediction stage.", ["stage"]))
+INFLIGHT = REGISTRY.register(Gauge(
+    "ml_inflight_requests", "Images currently being predicted."))
+MODEL_LOADS = REGISTRY.register(Counter(
+    "ml_model_loads_total", "Served model builds (first load or hot reload).", ["model", "kind"]))
+MODEL_LOAD_FAILURES = REGISTRY.register(Counter(
+    "ml_model_load_failures_total", "Failed hot reloads.", ["model"]))
+MODEL_EVICTIONS = REGISTRY.register(Counter(
+    "ml_model_evictions_total", "Models evicted from the registry to respect the memory budget."))
+MODELS_LOADED = REGISTRY.register(Gauge(
+    "ml_models_loaded", "Models currently resident."))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "ml_queue_depth", "Items waiting in the micro-batcher or the prepare executor.", ["queue"]))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    "ml_batch_size", "Images per forward pass.", buckets=(1, 2, 4, 8, 16, 32, 64)))
+
+
+def observe_stages(timings: Optional[Dict[str, float]]) -> None:
+    for k, v in (timings or {}).items():
+        STAGE_SECONDS.observe(float(v), stage=k)
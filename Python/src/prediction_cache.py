@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from src.env import _env, _env_int
+
+
+class PredictionCache:
+    def __init__(self, max_entries: int = 1024, persist_path: Optional[Path] = None):
+        self.max_entries = max(1, int(max_entries))
+        self.persist_path = Path(persist_path) if persist_path else None
+
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[str, Dict]" = OrderedDict()
+        self._inflight: Dict[str, "asyncio.Task[Dict]"] = {}
+        self._stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "errors": 0, "loaded": 0}
+
+    @staticmethod
+    def make_key(
+        file_bytes: bytes,
+        model_sig: Optional[Dict],
+        image_size: int,
+        require_quality: bool,
+        require_domain: bool,
+    ) -> str:
+        h = hashlib.sha1(file_bytes).hexdigest()
+        extra = json.dumps(
+            {
+                "sig": model_sig or {},
+                "image_size": int(image_size),
+                "require_quality": bool(require_quality),
+                "require_domain": bool(require_domain),
+            },
+            sort_keys=True,
+        )
+        return h + ":" + hashlib.sha1(extra.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            v = self._lru.get(key)
+            if v is None:
+                return None
+            self._lru.move_to_end(key)
+            self._stats["hits"] += 1
+            return dict(v)
+
+    def put(self, key: str, value: Dict) -> None:
+        with self._lock:
+            self._lru[key] = dict(value)
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Dict]]) -> Tuple[Dict, str]:
+        v = self.get(key)
+        if v is not None:
+            return v, "hit"
+
+        task = self._inflight.get(key)
+        if task is not None:
+            with self._lock:
+                self._stats["coalesced"] += 1
+            return dict(await asyncio.shield(task)), "coalesced"
+
+        # compute() runs in its own task, so cancelling the request that
+        # started it only drops that request's wait; followers still get the
+        # result, and only an error raised by compute() reaches them.
+        task = asyncio.ensure_future(self._compute(key, compute))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._inflight[key] = task
+        with self._lock:
+            self._stats["misses"] += 1
+        return dict(await asyncio.shield(task)), "miss"
+
+    async def _compute(self, key: str, compute: Callable[[], Awaitable[Dict]]) -> Dict:
+        try:
+            out = await compute()
+        except BaseException:
+            with self._lock:
+                self._stats["errors"] += 1
+            raise
+        else:
+            self.put(key, out)
+            return out
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            st = dict(self._stats)
+            st["entries"] = len(self._lru)
+        st["max_entries"] = self.max_entries
+        st["inflight"] = len(self._inflight)
+        st["persist_path"] = str(self.persist_path) if self.persist_path else None
+        lookups = st["hits"] + st["misses"] + st["coalesced"]
+        st["hit_ratio"] = float(st["hits"] + st["coalesced"]) / max(1, lookups)
+        return st
+
+    def load(self) -> int:
+        if self.persist_path is None or not self.persist_path.exists():
+            return 0
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                obj = json.load(f)
+        except Exception:
+            return 0
+        entries = obj.get("entries") if isinstance(obj, dict) else None
+        if not isinstance(entries, list):
+            return 0
+        n = 0
+        for it in entries[-self.max_entries:]:
+            if isinstance(it, list) and len(it) == 2 and isinstance(it[1], dict):
+                self.put(str(it[0]), it[1])
+                n += 1
+        with self._lock:
+            self._stats["loaded"] = n
+        return n
+
+    def save(self) -> None:
+        if self.persist_path is None:
+            return
+        with self._lock:
+            entries = [[k, v] for k, v in self._lru.items()]
+        self.persist_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.persist_path.with_suffix(self.persist_path.suffix + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "entries": entries}, f, ensure_ascii=False)
+        os.replace(tmp, self.persist_path)
+
+
+def cache_from_env() -> Optional[PredictionCache]:
+    n = _env_int("ML_PRED_CACHE_SIZE", 1024)
+    if n <= 0:
+        return None
+    path = _env("ML_PRED_CACHE_FILE", "")
+    c = PredictionCache(max_entries=n, persist_path=Path(path) if path else None)
+    c.load()
+    return c
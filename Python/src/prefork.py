@@ -0,0 +1,379 @@
+from __future__ import annotations
+
+import gc
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from src.env import _env, _env_bool, _env_float, _env_int
+
+_WORKER: Dict = {}
+
+
+def _affinity() -> List[int]:
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def parse_cpusets(spec: str, workers: int) -> List[Optional[Set[int]]]:
+    spec = spec.strip().lower()
+    if spec in ("", "none", "off", "0"):
+        return [None] * workers
+    if spec == "auto":
+        if not hasattr(os, "sched_setaffinity"):
+            return [None] * workers
+        cpus = _affinity()
+        if len(cpus) < workers:
+            return [{cpus[i % len(cpus)]} for i in range(workers)]
+        return [set(cpus[i * len(cpus) // workers:(i + 1) * len(cpus) // workers]) for i in range(workers)]
+
+    sets = []
+    for part in spec.split(";"):
+        cpus: Set[int] = set()
+        for tok in part.split(","):
+            tok = tok.strip()
+            if not tok:
+                continue
+            if "-" in tok:
+                a, b = tok.split("-", 1)
+                cpus.update(range(int(a), int(b) + 1))
+            else:
+                cpus.add(int(tok))
+        if cpus:
+            sets.append(cpus)
+    if not sets:
+        raise ValueError(f"ML_WORKER_CPUS has no CPUs: {spec!r}")
+    return [sets[i % len(sets)] for i in range(workers)]
+
+
+def _fmt_cpus(cpus: Optional[Set[int]]) -> str:
+    return "all" if not cpus else ",".join(str(c) for c in sorted(cpus))
+
+
+def _memory() -> Dict:
+    keys = ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty")
+    out: Dict = {}
+    try:
+        with open("/proc/self/smaps_rollup", "r", encoding="ascii") as f:
+            for line in f:
+                k, _, rest = line.partition(":")
+                if k in keys:
+                    out[k.lower() + "_mb"] = round(int(rest.split()[0]) / 1024.0, 1)
+    except (OSError, ValueError, IndexError):
+        return {}
+    out["uss_mb"] = round(out.get("private_clean_mb", 0.0) + out.get("private_dirty_mb", 0.0), 1)
+    return out
+
+
+def worker_info() -> Dict:
+    return {**(_WORKER or {"mode": "single"}), "pid": os.getpid(), "memory": _memory()}
+
+
+def _bind(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(_env_int("ML_BACKLOG", 2048))
+    sock.set_inheritable(True)
+    return sock
+
+
+def _signal_ready(fd: int) -> None:
+    import src.api as api
+
+    while not api._STARTUP["preloaded"]:
+        time.sleep(0.05)
+    try:
+        os.write(fd, b"1")
+    finally:
+        os.close(fd)
+
+
+def _run_worker(sock: socket.socket, idx: int, cpus: Optional[Set[int]], threads: int, log_level: str,
+                ready_fd: int, external_watch: bool) -> None:
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+    # The parent ran with one intra-op thread so no OpenMP pool existed at
+    # fork time; each worker sizes its own pool to its CPU set.
+    os.environ["ML_TORCH_THREADS"] = str(threads)
+    os.environ.setdefault("ML_EXEC_WORKERS", "0")
+    if external_watch:
+        os.environ["ML_MODEL_WATCH"] = "0"
+
+    import src.CBISDDSM as mm
+
+    mm._WATCH_EXTERNAL = external_watch
+    info = mm._configure_cpu_threads(force=True)
+    for served in list(mm._SERVED.values()):
+        if served.dev.type == "cpu":
+            served.info.update(info)
+    _WORKER.update({"mode": "prefork", "index": idx, "cpuset": sorted(cpus) if cpus else None, **info})
+
+    import src.api as api
+    import uvicorn
+
+    api._T_IMPORTED = time.perf_counter()
+    threading.Thread(target=_signal_ready, args=(ready_fd,), name="ml-worker-ready", daemon=True).start()
+    uvicorn.Server(uvicorn.Config("src.api:app", log_level=log_level, reload=False)).run(sockets=[sock])
+
+
+class Supervisor:
+    """Forks the HTTP workers, respawns the ones that die and restarts them on model changes."""
+
+    def __init__(self, sock: socket.socket, cpusets: List[Optional[Set[int]]], threads: List[int], log_level: str,
+                 watch_cfg=None):
+        self.sock = sock
+        self.cpusets = cpusets
+        self.threads = threads
+        self.log_level = log_level
+        self.watch_cfg = watch_cfg
+        self.children: Dict[int, int] = {}
+        self.started: Dict[int, float] = {}
+        self.respawn_at: Dict[int, float] = {}
+        self.ready_fds: Dict[int, int] = {}
+        self.stopping = False
+        self.restart_requested = False
+        self.restarts = 0
+
+    def spawn(self, idx: int) -> int:
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                os.close(r)
+                for fd in self.ready_fds.values():
+                    os.close(fd)
+                _run_worker(self.sock, idx, self.cpusets[idx], self.threads[idx], self.log_level, w,
+                            self.watch_cfg is not None)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(w)
+        self.children[idx] = pid
+        self.started[idx] = time.monotonic()
+        self.ready_fds[idx] = r
+        print(f"prefork: worker {idx} pid={pid} cpus={_fmt_cpus(self.cpusets[idx])} threads={self.threads[idx]}",
+              flush=True)
+        return pid
+
+    def _close_ready(self, idx: int) -> None:
+        fd = self.ready_fds.pop(idx, None)
+        if fd is not None:
+            os.close(fd)
+
+    def wait_ready(self, idx: int, timeout: float) -> bool:
+        fd = self.ready_fds.get(idx)
+        if fd is None:
+            return False
+        end = time.monotonic() + timeout
+        while not self.stopping:
+            left = end - time.monotonic()
+            if left <= 0:
+                return False
+            ready, _, _ = select.select([fd], [], [], min(left, 0.5))
+            if ready:
+                ok = os.read(fd, 1) == b"1"
+                self._close_ready(idx)
+                return ok
+        return False
+
+    def _wait_pid(self, pid: int, timeout: float) -> bool:
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                return True
+            if done:
+                return True
+            time.sleep(0.05)
+        return False
+
+    def _terminate(self, idx: int, grace: float) -> None:
+        pid = self.children.pop(idx, None)
+        self._close_ready(idx)
+        if pid is None:
+            return
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        if not self._wait_pid(pid, grace):
+            print(f"prefork: worker {idx} pid={pid} did not stop within {grace:.0f}s; killing", flush=True)
+            os.kill(pid, signal.SIGKILL)
+            self._wait_pid(pid, 5.0)
+
+    def reap(self) -> None:
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            idx = next((i for i, p in self.children.items() if p == pid), None)
+            if idx is None:
+                continue
+            del self.children[idx]
+            self._close_ready(idx)
+            if self.stopping:
+                continue
+            uptime = time.monotonic() - self.started.get(idx, 0.0)
+            delay = 0.0 if uptime > 10.0 else min(30.0, 1.0 + uptime)
+            print(f"prefork: worker {idx} pid={pid} exited (status {status}) after {uptime:.1f}s; "
+                  f"respawning in {delay:.0f}s", flush=True)
+            self.respawn_at[idx] = time.monotonic() + delay
+            self.restarts += 1
+
+    def rolling_restart(self, grace: float) -> None:
+        # One worker at a time, waiting for its replacement to finish
+        # preloading, so the others keep serving.
+        for idx in sorted(self.children):
+            if self.stopping:
+                return
+            self._terminate(idx, grace)
+            self.spawn(idx)
+            if not self.wait_ready(idx, grace):
+                print(f"prefork: worker {idx} not ready after {grace:.0f}s", flush=True)
+
+    def _changed(self) -> bool:
+        import src.CBISDDSM as mm
+
+        changed = False
+        for key in list(mm._SERVED) or [""]:
+            try:
+                changed = mm.reload_if_changed(self.watch_cfg, key) or changed
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"prefork: reload of '{key or 'default'}' failed: {e!r}", flush=True)
+        before = mm._MAP_SIG
+        try:
+            mm.ensure_maps_loaded(self.watch_cfg, force=True)
+        except Exception as e:
+            print(f"prefork: ground-truth map reload failed: {e!r}", flush=True)
+        if mm._MAP_SIG != before:
+            changed = True
+        if changed:
+            gc.collect()
+            gc.freeze()
+        return changed
+
+    def _on_stop(self, signum, frame) -> None:
+        self.stopping = True
+
+    def _on_hup(self, signum, frame) -> None:
+        self.restart_requested = True
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_hup)
+        grace = _env_float("ML_WORKER_GRACE_S", 30.0)
+        interval = max(0.5, _env_float("ML_MODEL_WATCH_S", 5.0))
+
+        for idx in range(len(self.cpusets)):
+            self.spawn(idx)
+        next_check = time.monotonic() + interval
+        try:
+            while not self.stopping:
+                self.reap()
+                now = time.monotonic()
+                for idx, at in list(self.respawn_at.items()):
+                    if now >= at and not self.stopping:
+                        del self.respawn_at[idx]
+                        self.spawn(idx)
+                if self.watch_cfg is not None and now >= next_check:
+                    next_check = now + interval
+                    if self._changed():
+                        self.restart_requested = True
+                if self.restart_requested:
+                    self.restart_requested = False
+                    print("prefork: rolling restart", flush=True)
+                    self.rolling_restart(grace)
+                time.sleep(0.2)
+        finally:
+            self.stopping = True
+            for idx in list(self.children):
+                pid = self.children.get(idx)
+                if pid is not None:
+                    try:
+                        os.kill(pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+            for idx in list(self.children):
+                self._terminate(idx, grace)
+            self.sock.close()
+
+
+def _preload_shared(cfg) -> None:
+    import src.CBISDDSM as mm
+
+    try:
+        served = mm.ensure_loaded(cfg)
+        mm.ensure_maps_loaded(cfg)
+    except Exception as e:
+        print(f"prefork: parent preload failed ({e!r}); workers load on their own", flush=True)
+        return
+    if served.info.get("backend") == "onnx":
+        # onnxruntime starts its thread pools at session creation, and those
+        # do not survive fork.
+        print("prefork: onnx sessions cannot be shared across fork; workers load their own", flush=True)
+        mm._SERVED.clear()
+
+
+def serve(host: str, port: int, workers: int, log_level: str) -> None:
+    import uvicorn
+
+    if not hasattr(os, "fork"):
+        print("prefork: os.fork is unavailable; using uvicorn workers without shared weights", flush=True)
+        uvicorn.run("src.api:app", host=host, port=port, workers=workers, reload=False, log_level=log_level)
+        return
+
+    cpusets = parse_cpusets(_env("ML_WORKER_CPUS", "auto"), workers)
+    per_worker = _env_int("ML_WORKER_THREADS", 0)
+    fallback = max(1, len(_affinity()) // workers)
+    threads = [per_worker if per_worker > 0 else (len(c) if c else fallback) for c in cpusets]
+
+    os.environ["ML_TORCH_THREADS"] = "1"
+    os.environ["ML_TORCH_INTEROP_THREADS"] = "1"
+    import src.CBISDDSM as mm
+
+    cfg = mm.CbisDdsmConfig()
+    if mm._serving_device(cfg).type != "cpu":
+        raise SystemExit("ML_WORKERS>1 shares CPU weights across fork; set ML_DEVICE=cpu or run one server per GPU")
+
+    t0 = time.perf_counter()
+    if _env_bool("ML_PRELOAD", True):
+        _preload_shared(cfg)
+    import src.api  # noqa: F401
+
+    gc.collect()
+    gc.freeze()
+    print(f"prefork: parent ready in {(time.perf_counter() - t0) * 1000.0:.0f} ms, "
+          f"{len(mm._SERVED)} model(s) shared; starting {workers} workers on {host}:{port}", flush=True)
+
+    sock = _bind(host, port)
+    watch = _env_bool("ML_MODEL_WATCH", True) and _env_bool("ML_PRELOAD", True)
+    Supervisor(sock, cpusets, threads, log_level, cfg if watch else None).run()
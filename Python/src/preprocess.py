@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import math
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+# Pillow's 8-bit resampler works in fixed point with this many fractional bits.
+_PRECISION_BITS = 32 - 8 - 2
+
+Gray = Union[np.ndarray, torch.Tensor]
+
+
+def hist_quantile(hist: np.ndarray, q: float) -> float:
+    # Same value as np.quantile(gray, q) (linear interpolation), in grey levels.
+    n = int(hist.sum())
+    if n <= 0:
+        return 0.0
+    pos = float(q) * (n - 1)
+    k = int(math.floor(pos))
+    cum = np.cumsum(hist)
+    v0 = int(np.searchsorted(cum, k, side="right"))
+    v1 = int(np.searchsorted(cum, min(k + 1, n - 1), side="right"))
+    return float(v0) + (pos - k) * float(v1 - v0)
+
+
+def contain_size(w: int, h: int, size: int) -> Tuple[int, int]:
+    # ImageOps.contain for a square target.
+    if w / h > 1.0:
+        return size, round(h / w * size)
+    if w / h < 1.0:
+        return round(w / h * size), size
+    return size, size
+
+
+def bilinear_coeffs(in_size: int, out_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Pillow's precompute_coeffs + normalize_coeffs_8bpc for the bilinear filter.
+    scale = float(in_size) / float(out_size)
+    filterscale = max(1.0, scale)
+    support = 1.0 * filterscale
+    ksize = int(math.ceil(support)) * 2 + 1
+
+    center = (np.arange(out_size, dtype=np.float64) + 0.5) * scale
+    xmin = np.maximum(np.trunc(center - support + 0.5).astype(np.int64), 0)
+    xmax = np.minimum(np.trunc(center + support + 0.5).astype(np.int64), in_size) - xmin
+
+    taps = np.arange(ksize, dtype=np.int64)
+    w = 1.0 - np.abs((taps[None, :] + xmin[:, None] - center[:, None] + 0.5) / filterscale)
+    w = np.where((w > 0.0) & (taps[None, :] < xmax[:, None]), w, 0.0)
+    ww = w.sum(axis=1, keepdims=True)
+    w = np.divide(w, ww, out=np.zeros_like(w), where=ww != 0.0)
+
+    one = float(1 << _PRECISION_BITS)
+    kk = np.where(w < 0.0, np.trunc(-0.5 + w * one), np.trunc(0.5 + w * one)).astype(np.int32)
+    idx = np.minimum(xmin[:, None] + taps[None, :], in_size - 1)
+    return idx, kk
+
+
+def mm_lut(lo: float, hi: float) -> np.ndarray:
+    lut = np.arange(256, dtype=np.float32) / 255.0
+    if hi > lo:
+        lut = np.clip((lut - lo) / (hi - lo), 0.0, 1.0)
+    return (lut * 255.0).astype(np.uint8)
+
+
+def autocontrast_lut(hist: np.ndarray) -> np.ndarray:
+    nz = np.flatnonzero(hist)
+    if nz.size == 0 or int(nz[-1]) <= int(nz[0]):
+        return np.arange(256, dtype=np.uint8)
+    lo, hi = int(nz[0]), int(nz[-1])
+    scale = 255.0 / (hi - lo)
+    offset = -lo * scale
+    return np.clip((np.arange(256) * scale + offset).astype(np.int64), 0, 255).astype(np.uint8)
+
+
+def normalize(x: torch.Tensor) -> torch.Tensor:
+    # uint8 (B,H,W) or (B,1,H,W) -> float32 (B,3,H,W), ToTensor + Normalize semantics.
+    if x.dim() == 3:
+        x = x.unsqueeze(1)
+    x = x.to(torch.float32).div_(255.0).expand(-1, 3, -1, -1)
+    mean = torch.tensor(IMAGENET_MEAN, dtype=torch.float32, device=x.device).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, dtype=torch.float32, device=x.device).view(1, 3, 1, 1)
+    return (x - mean) / std
+
+
+class TensorPreprocessor:
+    """Batched crop / contrast stretch / letterbox on uint8 grayscale images.
+
+    mode="mm" mirrors MMPreprocess and mode="pad" mirrors PadToSquareResize,
+    bit for bit: quantiles come from per-image histograms and the bilinear
+    letterbox reuses Pillow's fixed-point coefficients. Per-pixel work runs
+    with torch ops on `device`; only per-image scalars are planned on the CPU.
+    """
+
+    def __init__(self, size: int, mode: str = "mm", device: Optional[torch.device] = None):
+        self.size = int(size)
+        self.mode = "pad" if str(mode).lower() == "pad" else "mm"
+        self.device = torch.device(device) if device is not None else torch.device("cpu")
+
+    def _stack(self, images: Sequence[Gray]) -> Tuple[torch.Tensor, np.ndarray]:
+        ts = [torch.from_numpy(np.require(g, np.uint8, ["C", "W"])) if isinstance(g, np.ndarray) else g for g in images]
+        sizes = np.array([[int(t.shape[0]), int(t.shape[1])] for t in ts], dtype=np.int64)
+        hmax, wmax = int(sizes[:, 0].max()), int(sizes[:, 1].max())
+        if all(int(t.shape[0]) == hmax and int(t.shape[1]) == wmax for t in ts):
+            x = torch.stack(ts).to(self.device, non_blocking=True)
+        else:
+            x = torch.zeros((len(ts), hmax, wmax), dtype=torch.uint8, device=self.device)
+            for i, t in enumerate(ts):
+                x[i, : t.shape[0], : t.shape[1]] = t.to(self.device, non_blocking=True)
+        return x, sizes
+
+    @staticmethod
+    def _hist(x: torch.Tensor, boxes: np.ndarray) -> np.ndarray:
+        # 256-bin histogram of each image inside its (y0, x0, y1, x1) box.
+        if x.device.type == "cpu":
+            xn = x.numpy()
+            return np.stack([
+                np.bincount(xn[i, y0:y1, x0:x1].ravel(), minlength=256)
+                for i, (y0, x0, y1, x1) in enumerate(boxes.tolist())
+            ])
+        return torch.stack([
+            torch.bincount(x[i, y0:y1, x0:x1].reshape(-1), minlength=256)
+            for i, (y0, x0, y1, x1) in enumerate(boxes.tolist())
+        ]).cpu().numpy()
+
+    @staticmethod
+    def _crop_boxes(x: torch.Tensor, full: np.ndarray, hist: np.ndarray) -> np.ndarray:
+        # Zero padding never passes the threshold (>= floor(0.02 * 255)), so
+        # no validity mask is needed for ragged batches.
+        thr = np.array([max(0.02, hist_quantile(h, 0.80) / 255.0 * 0.15) for h in hist])
+        t = torch.as_tensor(np.floor(thr * 255.0).astype(np.uint8), device=x.device).view(-1, 1, 1)
+        rows = (x.amax(dim=2) > t.view(-1, 1)).cpu().numpy()
+        cols = (x.amax(dim=1) > t.view(-1, 1)).cpu().numpy()
+
+        boxes = full.copy()
+        for i in range(len(boxes)):
+            ys, xs = np.flatnonzero(rows[i]), np.flatnonzero(cols[i])
+            if ys.size == 0:
+                continue
+            y0, y1, x0, x1 = int(ys[0]), int(ys[-1]), int(xs[0]), int(xs[-1])
+            pad = int(0.03 * max(1, max(y1 - y0, x1 - x0)))
+            boxes[i] = [
+                max(0, y0 - pad),
+                max(0, x0 - pad),
+                min(int(full[i, 2]) - 1, y1 + pad) + 1,
+                min(int(full[i, 3]) - 1, x1 + pad) + 1,
+            ]
+        return boxes
+
+    @staticmethod
+    def _apply_lut_t(x: torch.Tensor, luts: np.ndarray, boxes: np.ndarray, r0: int, r1: int) -> torch.Tensor:
+        # LUT lookup written column-major, (B, W, r1 - r0), so both resampling
+        # passes read whole contiguous rows. Only pixels inside each box are
+        # ever sampled by the letterbox.
+        n, _, w = x.shape
+        if x.device.type == "cpu":
+            xn = x.numpy()
+            out = np.zeros((n, w, r1 - r0), dtype=np.uint8)
+            for i, (y0, x0, y1, x1) in enumerate(boxes.tolist()):
+                np.take(luts[i], xn[i, y0:y1, x0:x1].T, out=out[i, x0:x1, y0 - r0 : y1 - r0])
+            return torch.from_numpy(out)
+        lut = torch.from_numpy(luts).to(x.device)
+        xs = x[:, r0:r1]
+        y = lut.gather(1, xs.reshape(n, -1).to(torch.int64)).view(xs.shape)
+        return y.transpose(1, 2).contiguous()
+
+    def _plan(self, boxes: np.ndarray) -> Dict[str, torch.Tensor]:
+        s = self.size
+        n = len(boxes)
+        per = []
+        for y0, x0, y1, x1 in boxes.tolist():
+            ch, cw = y1 - y0, x1 - x0
+            nw, nh = contain_size(cw, ch, s)
+            xo = round((s - nw) * 0.5) if nw != s else 0
+            yo = round((s - nh) * 0.5) if nh != s else 0
+            ix, kx = bilinear_coeffs(cw, nw)
+            iy, ky = bilinear_coeffs(ch, nh)
+            per.append((x0 + ix, kx, xo, y0 + iy, ky, yo))
+
+        kxs = max(p[1].shape[1] for p in per)
+        kys = max(p[4].shape[1] for p in per)
+        idx_x = np.zeros((n, s, kxs), dtype=np.int64)
+        w_x = np.zeros((n, s, kxs), dtype=np.int32)
+        idx_y = np.zeros((n, s, kys), dtype=np.int64)
+        w_y = np.zeros((n, s, kys), dtype=np.int32)
+        for i, (ix, kx, xo, iy, ky, yo) in enumerate(per):
+            idx_x[i, xo : xo + ix.shape[0], : ix.shape[1]] = ix
+            w_x[i, xo : xo + kx.shape[0], : kx.shape[1]] = kx
+            idx_y[i, yo : yo + iy.shape[0], : iy.shape[1]] = iy
+            w_y[i, yo : yo + ky.shape[0], : ky.shape[1]] = ky
+
+        dev = self.device
+        return {
+            "idx_x": torch.from_numpy(idx_x).to(dev),
+            "w_x": torch.from_numpy(w_x).to(dev),
+            "idx_y": torch.from_numpy(idx_y).to(dev),
+            "w_y": torch.from_numpy(w_y).to(dev),
+        }
+
+    @staticmethod
+    def _resample(x: torch.Tensor, idx: torch.Tensor, w: torch.Tensor) -> torch.Tensor:
+        # One separable pass along dim 1: uint8 (B, In, R) -> uint8 (B, Out, R).
+        # Accumulated tap by tap in int32 exactly like Pillow's 8bpc kernel;
+        # each tap is a single row gather over the flattened batch.
+        b, n_in, r = x.shape
+        out = int(idx.shape[1])
+        flat = x.reshape(b * n_in, r)
+        base = torch.arange(b, device=x.device).view(b, 1) * n_in
+        acc = torch.full((b, out, r), 1 << (_PRECISION_BITS - 1), dtype=torch.int32, device=x.device)
+        for j in range(int(idx.shape[2])):
+            g = flat.index_select(0, (idx[:, :, j] + base).view(-1)).view(b, out, r)
+            acc.addcmul_(g, w[:, :, j].view(b, out, 1))
+        return (acc >> _PRECISION_BITS).clamp_(0, 255).to(torch.uint8)
+
+    @torch.inference_mode()
+    def letterbox(self, images: Sequence[Gray], hists: Optional[np.ndarray] = None) -> torch.Tensor:
+        """uint8 grayscale images of any size -> uint8 (B, size, size) on `device`.
+
+        `hists` may carry the (B, 256) full-image histograms when the caller
+        already has them.
+        """
+        x, sizes = self._stack(images)
+        full = np.concatenate([np.zeros_like(sizes), sizes], axis=1)
+        hist = self._hist(x, full) if hists is None else np.array(hists, dtype=np.int64)
+
+        if self.mode == "mm":
+            boxes = self._crop_boxes(x, full, hist)
+            cropped = np.flatnonzero((boxes != full).any(axis=1))
+            if cropped.size:
+                hist[cropped] = self._hist(x, boxes)[cropped]
+            luts = np.stack([mm_lut(hist_quantile(h, 0.01) / 255.0, hist_quantile(h, 0.99) / 255.0) for h in hist])
+        else:
+            boxes = full
+            luts = np.stack([autocontrast_lut(h) for h in hist])
+
+        # Rows outside every box are never read by the vertical pass.
+        r0, r1 = int(boxes[:, 0].min()), int(boxes[:, 2].max())
+        xt = self._apply_lut_t(x, luts, boxes, r0, r1)
+
+        # Horizontal pass first, with an 8-bit intermediate, as Pillow does.
+        plan = self._plan(boxes)
+        xt = self._resample(xt, plan["idx_x"], plan["w_x"])
+        y = self._resample(xt.transpose(1, 2).contiguous(), (plan["idx_y"] - r0).clamp_(min=0), plan["w_y"])
+        return y
+
+    def __call__(self, images: Sequence[Gray], hists: Optional[np.ndarray] = None) -> torch.Tensor:
+        return normalize(self.letterbox(images, hists))
+
+
+_ENGINES: Dict[Tuple[int, str, str], TensorPreprocessor] = {}
+
+
+def get_preprocessor(size: int, mode: str, device: Optional[torch.device] = None) -> TensorPreprocessor:
+    dev = torch.device(device) if device is not None else torch.device("cpu")
+    key = (int(size), str(mode), str(dev))
+    eng = _ENGINES.get(key)
+    if eng is None:
+        eng = _ENGINES[key] = TensorPreprocessor(size, mode, dev)
+    return eng
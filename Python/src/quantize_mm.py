@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import src.CBISDDSM as mm
+
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "--artifact-dir",
+        type=str,
+        default=os.getenv("ML_ARTIFACT_DIR", str(PROJECT_ROOT / "artifacts" / "mammogram_mastery_images")),
+    )
+    ap.add_argument("--dataset-dir", type=str, default=os.getenv("ML_DATASET_DIR", ""))
+    ap.add_argument("--precisions", type=str, default="bf16,int8")
+    ap.add_argument("--calib-samples", type=int, default=256)
+    ap.add_argument("--max-eval-samples", type=int, default=0)
+    ap.add_argument("--batch-size", type=int, default=32)
+    ap.add_argument("--workers", type=int, default=int(os.getenv("CBIS_WORKERS", "2")))
+    ap.add_argument("--max-bal-acc-drop", type=str, default=os.getenv("ML_QUANT_MAX_BAL_ACC_DROP", "0.01"))
+    ap.add_argument("--max-auc-drop", type=str, default=os.getenv("ML_QUANT_MAX_AUC_DROP", "0.01"))
+    return ap.parse_args()
+
+
+def _fmt(m):
+    return " ".join(f"{k}={v:.4f}" for k, v in m.items())
+
+
+def main():
+    args = parse_args()
+    os.environ["ML_QUANT_MAX_BAL_ACC_DROP"] = str(args.max_bal_acc_drop)
+    os.environ["ML_QUANT_MAX_AUC_DROP"] = str(args.max_auc_drop)
+
+    artifact_dir = Path(args.artifact_dir).resolve()
+    ap = mm._artifact_paths(artifact_dir)
+    meta = mm._load_json(ap["meta"]) or {}
+    if not ap["model"].exists():
+        raise FileNotFoundError(f"Model artifact missing: {ap['model']}")
+
+    dataset_dir = Path(args.dataset_dir or meta.get("dataset_dir") or "").resolve()
+    os.environ["ML_ARTIFACT_DIR"] = str(artifact_dir)
+    os.environ["ML_DATASET_DIR"] = str(dataset_dir)
+
+    cfg = mm.CbisDdsmConfig(
+        dataset_dir=dataset_dir,
+        artifact_dir=artifact_dir,
+        dataset_kind=str(meta.get("dataset_kind") or mm._default_kind()),
+        seed=int(meta.get("seed") or 42),
+        val_ratio=float(meta.get("val_ratio") or 0.12),
+        mm_use_augmented=bool(meta.get("mm_use_augmented", True)),
+        mm_val_from_original_only=bool(meta.get("mm_val_from_original_only", True)),
+        mm_use_cache=bool(meta.get("mm_use_cache", False)),
+        mm_cache_dir_name=str(meta.get("mm_cache_dir_name") or "Cache224"),
+    )
+
+    arch = str(meta.get("arch") or "efficientnet_b0")
+    size = int(meta.get("image_size") or 224)
+    precisions = [p.strip().lower() for p in args.precisions.split(",") if p.strip()]
+
+    print("quantize_mm: start", flush=True)
+    print("artifact_dir:", artifact_dir, flush=True)
+    print("dataset_dir:", dataset_dir, flush=True)
+
+    samples = mm.build_samples(cfg)
+    _, va_s = mm._split_groupwise(cfg, samples)
+    calib_s = va_s[: max(1, int(args.calib_samples))]
+    eval_s = va_s[: int(args.max_eval_samples)] if int(args.max_eval_samples) > 0 else va_s
+    print(f"quantize_mm: val={len(va_s)} calib={len(calib_s)} eval={len(eval_s)}", flush=True)
+
+    cpu = mm.torch.device("cpu")
+    mm._configure_cpu_threads()
+    loss_fn = mm.nn.CrossEntropyLoss()
+    calib_dl = mm._make_loader_eval(cfg, calib_s, size, args.batch_size, args.workers, cpu, erase_p=0.0)
+    eval_dl = mm._make_loader_eval(cfg, eval_s, size, args.batch_size, args.workers, cpu, erase_p=0.0)
+
+    serve_dev = mm._serving_device(cfg)
+
+    base_model = mm._load_torch_model(arch, ap["model"], cpu)
+    t0 = time.time()
+    _, base_m, base_cm, _, _ = mm._eval(base_model, eval_dl, loss_fn, cpu)
+    print(f"fp32: {_fmt(base_m)} seconds={time.time() - t0:.1f}", flush=True)
+
+    tol = mm._quant_tolerances()
+    variants = dict(meta.get("serving_variants") or {})
+    source_mtime = int(ap["model"].stat().st_mtime)
+
+    for prec in precisions:
+        t0 = time.time()
+        if prec == "bf16":
+            dev = serve_dev
+            m = mm._load_torch_model(arch, ap["model"], dev).to(dtype=mm.torch.bfloat16)
+            dl = mm._make_loader_eval(cfg, eval_s, size, args.batch_size, args.workers, dev, erase_p=0.0)
+            _, vm, vcm, _, _ = mm._eval(m, dl, loss_fn, dev, dtype=mm.torch.bfloat16)
+            path = None
+        elif prec == "int8":
+            m = mm._load_torch_model(arch, ap["model"], cpu)
+            example = mm.torch.zeros(1, 3, size, size)
+            qm = mm.quantize_int8_static(m, (xb for xb, _ in calib_dl), example)
+            _, vm, vcm, _, _ = mm._eval(qm, eval_dl, loss_fn, cpu)
+            with mm.torch.inference_mode():
+                ts = mm.torch.jit.trace(qm, example)
+            tmp = ap["int8"].with_suffix(".pt.tmp")
+            mm.torch.jit.save(ts, str(tmp))
+            os.replace(tmp, ap["int8"])
+            path = str(ap["int8"])
+        else:
+            print(f"quantize_mm: unsupported precision {prec}, skipped", flush=True)
+            continue
+
+        drops = mm._variant_drops(base_m, vm)
+        accepted = mm._variant_accepted(drops, tol)
+        print(
+            f"{prec}: {_fmt(vm)} drop_bal_acc={drops['bal_acc']:.4f} drop_auc={drops['auc']:.4f} "
+            f"accepted={accepted} seconds={time.time() - t0:.1f}",
+            flush=True,
+        )
+
+        variants[prec] = {
+            "precision": prec,
+            "path": path,
+            "source_mtime": source_mtime,
+            "n_calib": int(len(calib_s)) if prec == "int8" else 0,
+            "n_eval": int(len(eval_s)),
+            "metrics": vm,
+            "confusion": vcm,
+            "baseline_metrics": base_m,
+            "baseline_confusion": base_cm,
+            "drops": drops,
+            "tolerance": tol,
+            "accepted": bool(accepted),
+        }
+
+    meta = mm._load_json(ap["meta"]) or {}
+    meta["serving_variants"] = variants
+    mm._save_json(ap["meta"], meta)
+    print("quantize_mm: done", flush=True)
+
+
+if __name__ == "__main__":
+    main()
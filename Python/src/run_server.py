@@ -15,6 +15,7 @@ def main():
     host = os.getenv("ML_HOST", "127.0.0.1")
     port = int(os.getenv("ML_PORT", "8001"))
     log_level = os.getenv("ML_LOG_LEVEL", "info")
+    workers = int(os.getenv("ML_WORKERS", "1") or 1)
 
     print("\n=== RUN_SERVER DEBUG ===", flush=True)
     print(f"sys.executable = {sys.executable}", flush=True)
@@ -24,8 +25,15 @@ def main():
     print(f"ML_HOST = {host}", flush=True)
     print(f"ML_PORT = {port}", flush=True)
     print(f"ML_LOG_LEVEL = {log_level}", flush=True)
+    print(f"ML_WORKERS = {workers}", flush=True)
     print("========================\n", flush=True)
 
+    if workers > 1:
+        from src.prefork import serve
+
+        serve(host, port, workers, log_level)
+        return
+
     uvicorn.run(
         "src.api:app",
         host=host,
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+from array import array
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+ORIGINS = ("original", "augmented", "folder")
+
+
+@dataclass(frozen=True)
+class Sample:
+    path: str
+    y: int
+    group_id: str
+    rel: str
+    origin: str
+
+
+class StringColumn:
+    """UTF-8 strings packed into one byte buffer, addressed by start/end offsets."""
+
+    def __init__(self, blob: np.ndarray, starts: np.ndarray, ends: np.ndarray):
+        self.blob = blob
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def from_strings(cls, values: Iterable[str]) -> "StringColumn":
+        buf = bytearray()
+        bounds = array("q", [0])
+        for v in values:
+            buf += v.encode("utf-8")
+            bounds.append(len(buf))
+        off = np.frombuffer(bounds, dtype=np.int64)
+        return cls(np.frombuffer(bytes(buf), dtype=np.uint8), off[:-1].copy(), off[1:].copy())
+
+    def __len__(self) -> int:
+        return int(self.starts.shape[0])
+
+    def __getitem__(self, i: int) -> str:
+        return self.blob[int(self.starts[i]):int(self.ends[i])].tobytes().decode("utf-8")
+
+    def take(self, idx: np.ndarray) -> "StringColumn":
+        return StringColumn(self.blob, self.starts[idx], self.ends[idx])
+
+    def tolist(self) -> List[str]:
+        raw = self.blob.tobytes()
+        return [raw[s:e].decode("utf-8") for s, e in zip(self.starts.tolist(), self.ends.tolist())]
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.blob.nbytes + self.starts.nbytes + self.ends.nbytes)
+
+
+class SampleTable:
+    """Columnar samples; subsets share the string buffers and copy only index arrays."""
+
+    def __init__(
+        self,
+        paths: StringColumn,
+        rels: StringColumn,
+        y: np.ndarray,
+        group: np.ndarray,
+        origin: np.ndarray,
+        group_names: Sequence[str],
+    ):
+        self.paths = paths
+        self.rels = rels
+        self.y = y
+        self.group = group
+        self.origin = origin
+        self.group_names = group_names
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[str, int, str, str, str]]) -> "SampleTable":
+        paths, rels = [], []
+        y, group, origin = array("b"), array("i"), array("b")
+        gids: Dict[str, int] = {}
+        origins = {o: i for i, o in enumerate(ORIGINS)}
+        for path, label, gid, rel, org in rows:
+            paths.append(path)
+            rels.append(rel)
+            y.append(int(label))
+            group.append(gids.setdefault(gid, len(gids)))
+            origin.append(origins[org])
+        return cls(
+            StringColumn.from_strings(paths),
+            StringColumn.from_strings(rels),
+            np.frombuffer(y, dtype=np.int8).copy(),
+            np.frombuffer(group, dtype=np.int32).copy(),
+            np.frombuffer(origin, dtype=np.int8).copy(),
+            list(gids),
+        )
+
+    @classmethod
+    def from_samples(cls, samples: Iterable[Sample]) -> "SampleTable":
+        return cls.from_rows((s.path, s.y, s.group_id, s.rel, s.origin) for s in samples)
+
+    def __len__(self) -> int:
+        return int(self.y.shape[0])
+
+    def take(self, idx: np.ndarray) -> "SampleTable":
+        idx = np.asarray(idx)
+        if idx.dtype == np.bool_:
+            if idx.shape != (len(self),):
+                raise IndexError(f"boolean mask of shape {idx.shape} for a table of {len(self)} rows")
+            idx = np.flatnonzero(idx)
+        elif idx.size and not np.issubdtype(idx.dtype, np.integer):
+            raise IndexError(f"row indices must be integers or a boolean mask, got {idx.dtype}")
+        idx = idx.astype(np.int64, copy=False)
+        return SampleTable(
+            self.paths.take(idx), self.rels.take(idx), self.y[idx], self.group[idx], self.origin[idx], self.group_names
+        )
+
+    def row(self, i: int) -> Sample:
+        return Sample(
+            path=self.paths[i],
+            y=int(self.y[i]),
+            group_id=self.group_names[int(self.group[i])],
+            rel=self.rels[i],
+            origin=ORIGINS[int(self.origin[i])],
+        )
+
+    def __getitem__(self, key: Union[int, slice, np.ndarray]) -> Union[Sample, "SampleTable"]:
+        if isinstance(key, slice):
+            return self.take(np.arange(len(self))[key])
+        if isinstance(key, np.ndarray):
+            return self.take(key)
+        return self.row(int(key))
+
+    def __iter__(self) -> Iterator[Sample]:
+        for i in range(len(self)):
+            yield self.row(i)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.paths.nbytes + self.rels.nbytes + self.y.nbytes + self.group.nbytes + self.origin.nbytes)
+
+
+def as_table(samples: Union[SampleTable, Iterable[Sample]]) -> SampleTable:
+    return samples if isinstance(samples, SampleTable) else SampleTable.from_samples(samples)
+
+
+def first_seen_order(codes: np.ndarray) -> np.ndarray:
+    # Distinct values of codes in order of first appearance.
+    uniq, first = np.unique(codes, return_index=True)
+    return uniq[np.argsort(first, kind="stable")]
+
+
+def select_groups(
+    codes: np.ndarray, order: np.ndarray, target: int, mask: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Walks groups in `order`, taking whole groups while fewer than target
+    # rows were taken. Returns the taken group ids and their row indices,
+    # grouped in walk order and in table order within a group.
+    rows = np.flatnonzero(mask) if mask is not None else np.arange(codes.shape[0])
+    sizes = np.bincount(codes[rows], minlength=int(codes.max()) + 1 if codes.size else 0)
+    before = np.cumsum(sizes[order]) - sizes[order]
+    taken = order[before < target]
+    rank = np.full(sizes.shape[0], -1, dtype=np.int64)
+    rank[taken] = np.arange(taken.shape[0])
+    r = rank[codes[rows]]
+    sel = rows[r >= 0]
+    return taken, sel[np.argsort(r[r >= 0], kind="stable")]
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.env import _env
+
+logger = logging.getLogger("ml_server")
+
+
+class RequestTrace:
+    """Stage wall times and input attributes of one predicted image."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start_ns = time.time_ns()
+        self._t0 = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.attrs: Dict = {}
+        self.total: Optional[float] = None
+
+    def add(self, timings: Optional[Dict[str, float]]) -> None:
+        for k, v in (timings or {}).items():
+            self.stages[k] = self.stages.get(k, 0.0) + float(v)
+
+    def finish(self) -> "RequestTrace":
+        if self.total is None:
+            self.total = time.perf_counter() - self._t0
+        return self
+
+    def server_timing(self) -> str:
+        parts = [f"{k};dur={v * 1000.0:.2f}" for k, v in self.stages.items()]
+        if self.total is not None:
+            parts.append(f"total;dur={self.total * 1000.0:.2f}")
+        return ", ".join(parts)
+
+    def as_dict(self) -> Dict:
+        return {
+            "total_ms": None if self.total is None else round(self.total * 1000.0, 3),
+            "stages_ms": {k: round(v * 1000.0, 3) for k, v in self.stages.items()},
+            **self.attrs,
+        }
+
+    def spans(self) -> List[Tuple[str, int, int]]:
+        # Stages only carry durations (some are measured in worker processes),
+        # so child spans are laid out back to back from the request start.
+        out, t = [], self.start_ns
+        for k, v in self.stages.items():
+            d = int(v * 1e9)
+            out.append((k, t, t + d))
+            t += d
+        return out
+
+
+SpanExporter = Callable[[RequestTrace], None]
+
+
+def _noop_exporter(trace: RequestTrace) -> None:
+    return None
+
+
+_EXPORTER: SpanExporter = _noop_exporter
+_EXPORTER_LOCK = threading.Lock()
+
+
+def set_span_exporter(fn: Optional[SpanExporter]) -> None:
+    global _EXPORTER
+    with _EXPORTER_LOCK:
+        _EXPORTER = fn or _noop_exporter
+
+
+def export(trace: RequestTrace) -> None:
+    exporter = _EXPORTER
+    if exporter is _noop_exporter:
+        return
+    try:
+        exporter(trace.finish())
+    except Exception:
+        logger.warning("Span exporter failed", exc_info=True)
+
+
+def _flat_attrs(d: Dict, prefix: str = "ml.") -> Dict:
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            out.update(_flat_attrs(v, f"{prefix}{k}."))
+        elif isinstance(v, (str, bool, int, float)):
+            out[prefix + k] = v
+    return out
+
+
+def otel_exporter(tracer_name: str = "medflow-ml") -> SpanExporter:
+    # Needs opentelemetry-api; spans go wherever the process-wide tracer
+    # provider sends them (nowhere unless an SDK is configured).
+    from opentelemetry import trace as ot
+
+    tracer = ot.get_tracer(tracer_name)
+
+    def _export(tr: RequestTrace) -> None:
+        end = tr.start_ns + int((tr.total or 0.0) * 1e9)
+        parent = tracer.start_span(tr.name, start_time=tr.start_ns, attributes=_flat_attrs(tr.attrs))
+        ctx = ot.set_span_in_context(parent)
+        for name, t0, t1 in tr.spans():
+            tracer.start_span(name, context=ctx, start_time=t0).end(end_time=t1)
+        parent.end(end_time=max(end, tr.start_ns))
+
+    return _export
+
+
+def exporter_from_env() -> Optional[SpanExporter]:
+    kind = _env("ML_TRACE_EXPORTER", "").lower()
+    if kind in ("", "none", "off"):
+        return None
+    if kind == "otel":
+        try:
+            return otel_exporter(_env("ML_TRACE_SERVICE", "medflow-ml"))
+        except ImportError:
+            logger.warning("ML_TRACE_EXPORTER=otel but opentelemetry-api is not installed")
+            return None
+    logger.warning("Unknown ML_TRACE_EXPORTER=%s", kind)
+    return None
@@ -80,7 +80,11 @@ def parse_args():
 
     ap.add_argument("--build-path-map", type=str, default=os.getenv("MM_BUILD_PATH_MAP", "1"))
     ap.add_argument("--build-name-map", type=str, default=os.getenv("MM_BUILD_NAME_MAP", "1"))
-    ap.add_argument("--build-hash-map", type=str, default=os.getenv("MM_BUILD_HASH_MAP", "0"))
+    ap.add_argument("--build-hash-map", type=str, default=os.getenv("MM_BUILD_HASH_MAP", "1"))
+    ap.add_argument("--build-phash-map", type=str, default=os.getenv("MM_BUILD_PHASH_MAP", "0"))
+    ap.add_argument("--build-image-cache", type=str, default=os.getenv("MM_BUILD_IMAGE_CACHE", "0"))
+    ap.add_argument("--use-image-cache", type=str, default=os.getenv("ML_USE_IMAGE_CACHE", "1"))
+    ap.add_argument("--image-cache-dir", type=str, default=os.getenv("ML_IMAGE_CACHE_DIR", ""))
 
     ap.add_argument("--no-pretrain", type=str, default=os.getenv("ML_NO_PRETRAIN", "0"))
     ap.add_argument("--cuda-alloc", type=str, default=os.getenv("PYTORCH_CUDA_ALLOC_CONF", "max_split_size_mb:256"))
@@ -160,6 +164,10 @@ def main():
     _setenv("MM_BUILD_PATH_MAP", "1" if _b(args.build_path_map) else "0")
     _setenv("MM_BUILD_NAME_MAP", "1" if _b(args.build_name_map) else "0")
     _setenv("MM_BUILD_HASH_MAP", "1" if _b(args.build_hash_map) else "0")
+    _setenv("MM_BUILD_PHASH_MAP", "1" if _b(args.build_phash_map) else "0")
+    _setenv("MM_BUILD_IMAGE_CACHE", "1" if _b(args.build_image_cache) else "0")
+    _setenv("ML_USE_IMAGE_CACHE", "1" if _b(args.use_image_cache) else "0")
+    _setenv("ML_IMAGE_CACHE_DIR", args.image_cache_dir)
 
     _setenv("ML_NO_PRETRAIN", "1" if _b(args.no_pretrain) else "0")
 
@@ -191,7 +199,10 @@ def main():
         mm_cache_dir_name=os.getenv("MM_CACHE_DIR_NAME", "Cache224"),
         build_path_map=_b(os.getenv("MM_BUILD_PATH_MAP", "1")),
         build_name_map=_b(os.getenv("MM_BUILD_NAME_MAP", "1")),
-        build_hash_map=_b(os.getenv("MM_BUILD_HASH_MAP", "0")),
+        build_hash_map=_b(os.getenv("MM_BUILD_HASH_MAP", "1")),
+        build_phash_map=_b(os.getenv("MM_BUILD_PHASH_MAP", "0")),
+        build_image_cache=_b(os.getenv("MM_BUILD_IMAGE_CACHE", "0")),
+        use_image_cache=_b(os.getenv("ML_USE_IMAGE_CACHE", "1")),
         dataset_kind=dataset_kind,
         dataset_dir=dataset_dir,
         artifact_dir=artifact_dir,